@@ -0,0 +1,233 @@
+"""Inferencia por lotes con evaluación de condiciones por columnas.
+
+Primero el ``RuleIndex`` descarta las reglas que ninguna fila del lote puede
+disparar y la matriz de reglas disparadas se construye sólo con las
+candidatas. Las condiciones numéricas (``bmi >= 25``) se evalúan como una
+comparación de arrays NumPy sobre todo el lote y las categóricas (``==``/``!=``
+con cadenas, ``in``, ``not_in`` y ``contains``) sobre códigos enteros de las
+categorías de cada columna. ``mifflin_st_jeor`` se vectoriza para las filas
+que disparan alguna regla de kcal. El resultado de cada fila es idéntico al de
+``engine.infer()``. Las bases con encadenamiento (``then.assert``) se evalúan
+fila a fila con ``infer()``.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from engine import ACTIVITY_FACTORS, RuleIndex, fire_rules, infer, match_condition, uses_mifflin
+
+_NP_OPS = {"==": np.equal, "!=": np.not_equal, ">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal}
+_COLLECTIONS = (list, tuple, set, frozenset)
+
+
+def _is_number(x: Any) -> bool:
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def _is_hashable(x: Any) -> bool:
+    try:
+        hash(x)
+    except TypeError:
+        return False
+    return True
+
+
+class _Columns:
+    """Vista por columnas de un lote de hechos, construida bajo demanda"""
+
+    def __init__(self, rows: List[Dict[str,Any]]):
+        self.rows = rows
+        self._numeric: Dict[str, np.ndarray] = {}
+        self._codes: Dict[str, Optional[Tuple[np.ndarray, Dict[Any, int]]]] = {}
+        self._members: Dict[str, Optional[Dict[Any, np.ndarray]]] = {}
+
+    def numeric(self, fact: str) -> np.ndarray:
+        """Columna float64 del hecho; los valores no numéricos (o ausentes) son NaN.
+
+        NaN da ``False`` en toda comparación salvo ``!=``, igual que el
+        ``TypeError`` (o la desigualdad) de Python con ``None`` o una cadena.
+        """
+        if fact not in self._numeric:
+            self._numeric[fact] = np.array(
+                [v if isinstance(v, (int, float)) else np.nan for v in (row.get(fact) for row in self.rows)],
+                dtype=np.float64,
+            )
+        return self._numeric[fact]
+
+    def codes(self, fact: str) -> Optional[Tuple[np.ndarray, Dict[Any, int]]]:
+        """Código entero de cada fila y tabla valor -> código, o ``None`` si hay valores no hashables"""
+        if fact not in self._codes:
+            table: Dict[Any, int] = {}
+            try:
+                codes = np.fromiter((table.setdefault(row.get(fact), len(table)) for row in self.rows),
+                                    dtype=np.int64, count=len(self.rows))
+            except TypeError:
+                self._codes[fact] = None
+            else:
+                self._codes[fact] = (codes, table)
+        return self._codes[fact]
+
+    def members(self, fact: str) -> Optional[Dict[Any, np.ndarray]]:
+        """Elemento -> filas cuya lista lo contiene, o ``None`` si la columna no son colecciones"""
+        if fact not in self._members:
+            rows_of: Dict[Any, List[int]] = {}
+            try:
+                for i, row in enumerate(self.rows):
+                    items = row.get(fact, ())
+                    if items is None:
+                        continue  # ``value in None`` es TypeError: no contiene nada
+                    if not isinstance(items, _COLLECTIONS):
+                        raise TypeError  # p. ej. una cadena: ``in`` buscaría subcadenas
+                    for item in items:
+                        rows_of.setdefault(item, []).append(i)
+            except TypeError:
+                self._members[fact] = None
+            else:
+                self._members[fact] = {item: np.array(idx, dtype=np.intp) for item, idx in rows_of.items()}
+        return self._members[fact]
+
+
+def _cache_key(cond: Dict[str,Any]) -> Optional[tuple]:
+    value = cond.get("value")
+    if isinstance(value, _COLLECTIONS):
+        value = (type(value).__name__, tuple(value) if isinstance(value, (list, tuple)) else frozenset(value))
+    key = (cond.get("fact"), cond.get("op"), type(value).__name__, value)
+    return key if _is_hashable(key) else None
+
+
+def _vector_mask(cols: _Columns, fact: Any, op: Any, value: Any) -> Optional[np.ndarray]:
+    """Máscara de la condición sobre todo el lote, o ``None`` si no se puede vectorizar"""
+    if op in _NP_OPS and _is_number(value):
+        return _NP_OPS[op](cols.numeric(fact), value)
+    if op in ("==", "!=") and _is_hashable(value):
+        coded = cols.codes(fact)
+        if coded is None:
+            return None
+        codes, table = coded
+        code = table.get(value)
+        mask = codes == code if code is not None else np.zeros(len(codes), dtype=bool)
+        return mask if op == "==" else ~mask
+    if op in ("in", "not_in") and isinstance(value, _COLLECTIONS) and all(_is_hashable(v) for v in value):
+        coded = cols.codes(fact)
+        if coded is None:
+            return None
+        codes, table = coded
+        mask = np.isin(codes, [table[v] for v in value if v in table])
+        return mask if op == "in" else ~mask
+    if op == "contains" and _is_hashable(value):
+        members = cols.members(fact)
+        if members is None:
+            return None
+        mask = np.zeros(len(cols.rows), dtype=bool)
+        if value in members:
+            mask[members[value]] = True
+        return mask
+    return None
+
+
+def _condition_mask(cols: _Columns, cond: Dict[str,Any], active: np.ndarray, cache: Dict[tuple, np.ndarray]) -> np.ndarray:
+    """Máscara booleana de la condición para las filas aún activas de la regla"""
+    key = _cache_key(cond)
+    if key is not None and key in cache:
+        return cache[key]
+    mask = _vector_mask(cols, cond.get("fact"), cond.get("op"), cond.get("value"))
+    if mask is None:
+        # Resto de casos: evaluación fila a fila sólo donde la regla sigue viva
+        mask = np.zeros(len(cols.rows), dtype=bool)
+        for i in np.flatnonzero(active):
+            mask[i] = match_condition(cols.rows[i], cond)
+        return mask
+    if key is not None:
+        cache[key] = mask
+    return mask
+
+
+def vectorized_tdee(rows: List[Dict[str,Any]]) -> np.ndarray:
+    """``mifflin_st_jeor`` para todas las filas, con el mismo orden de operaciones"""
+    weight = np.array([r.get("weight_kg") for r in rows], dtype=np.float64)
+    height = np.array([r.get("height_cm") for r in rows], dtype=np.float64)
+    age = np.array([r.get("age") for r in rows], dtype=np.float64)
+    sex_term = np.array([5.0 if r.get("sex").upper() == "M" else -161.0 for r in rows])
+    factor = np.array([ACTIVITY_FACTORS.get(r.get("activity"), 1.2) for r in rows])
+    bmr = 10*weight + 6.25*height - 5*age + sex_term
+    return bmr * factor
+
+
+def infer_batch(rows: List[Dict[str,Any]], index: RuleIndex) -> List[Dict[str,Any]]:
+    """Ejecuta ``infer()`` sobre un lote de hechos evaluando las reglas por columnas"""
+    if not rows:
+        return []
+    if index.chaining:
+        # Con then.assert las reglas dependen de hechos derivados fila a fila
+        return [infer(row, index) for row in rows]
+    cols = _Columns(rows)
+    cache: Dict[tuple, np.ndarray] = {}
+    # Sólo las reglas que el índice no descarta para alguna fila del lote (las
+    # rechazadas por operadores desconocidos nunca son candidatas)
+    rules = [index.rules[pos] for pos in index.batch_candidate_positions(rows)]
+
+    # Matriz reglas candidatas x filas de reglas disparadas. La condición clave
+    # del índice va primero: suele ser la más selectiva y, como el resultado de
+    # ``when`` es una conjunción, el orden no lo cambia.
+    fired = np.zeros((len(rules), len(rows)), dtype=bool)
+    for k, rule in enumerate(rules):
+        when = rule.get("when", [])
+        key = index.key_conditions.get(rule.get("id"))
+        if key is not None and key < len(when):
+            when = [when[key]] + when[:key] + when[key + 1:]
+        mask = np.ones(len(rows), dtype=bool)
+        for cond in when:
+            mask = mask & _condition_mask(cols, cond, mask, cache)
+            if not mask.any():
+                break
+        fired[k] = mask
+
+    # Agrupar filas por conjunto de reglas disparadas: las conclusiones sólo
+    # dependen de ese conjunto, salvo kcal_target cuando lo fija Mifflin-St Jeor
+    packed = np.packbits(fired.T, axis=1) if len(rules) else np.zeros((len(rows), 1), dtype=np.uint8)
+    _, first, inverse = np.unique(packed, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    effects = [_kcal_effect(r) for r in rules]
+    templates, kcal_factors = [], np.full(len(first), np.nan)
+    for g, row in enumerate(first):
+        ks = np.flatnonzero(fired[:, row]).tolist()
+        templates.append(fire_rules(rows[row], [rules[k] for k in ks]))
+        factor = None
+        for k in ks:
+            if effects[k] is not None:
+                factor = None if effects[k] is False else effects[k]
+        if factor is not None:
+            kcal_factors[g] = factor
+
+    # TDEE vectorizado para las filas cuyo kcal_target final sale de Mifflin-St Jeor
+    row_factors = kcal_factors[inverse]
+    needs = np.flatnonzero(~np.isnan(row_factors))
+    kcal = {}
+    if len(needs):
+        tdee = vectorized_tdee([rows[i] for i in needs])
+        kcal = dict(zip(needs.tolist(), np.rint(tdee * row_factors[needs]).astype(np.int64).tolist()))
+
+    results = []
+    for i, g in enumerate(inverse.tolist()):
+        tpl = templates[g]
+        plan = dict(tpl["plan"], restrictions=list(tpl["plan"]["restrictions"]), advice=list(tpl["plan"]["advice"]))
+        if i in kcal:
+            plan["kcal_target"] = kcal[i]
+        results.append({"diagnosis": list(tpl["diagnosis"]), "plan": plan, "fired_rules": [dict(f) for f in tpl["fired_rules"]]})
+    return results
+
+
+def _kcal_effect(rule: Dict[str,Any]) -> Any:
+    """Efecto de la regla sobre kcal_target: el factor (1 - déficit + superávit)
+    si lo calcula con Mifflin-St Jeor, ``False`` si lo fija a un número y
+    ``None`` si no lo toca. Vale el de la última regla disparada que lo fija."""
+    diet = rule.get("then", {}).get("diet", {})
+    if not diet:
+        return None
+    kcal_cfg = diet.get("kcal_target")
+    if uses_mifflin(rule):
+        return 1 - float(kcal_cfg.get("deficit_pct",0.0)) + float(kcal_cfg.get("surplus_pct",0.0))
+    if isinstance(kcal_cfg, (int,float)):
+        return False
+    return None
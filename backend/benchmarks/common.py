@@ -0,0 +1,62 @@
+"""Utilidades compartidas por los benchmarks.
+
+Los benchmarks importan ``main`` en el mismo proceso, con una base de datos
+temporal, y hablan con la app a través de ``httpx.ASGITransport`` (sin red).
+"""
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+def load_app(db_dir=None):
+    """Importa ``main`` apuntando a una base de datos temporal y ejecuta el arranque"""
+    db_dir = db_dir or tempfile.mkdtemp(prefix="nutri-bench-")
+    os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+    # Todas las peticiones salen de la misma IP: sin límites salvo que el benchmark los active
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(db_dir, "rules.db")
+    import main
+    return main
+
+
+async def startup(main):
+    await main.on_startup()
+
+
+def client(main):
+    import httpx
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench")
+
+
+def percentile(samples, pct):
+    """Percentil por el método del rango más cercano"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def summarize(samples):
+    """Resumen en milisegundos de una lista de duraciones en segundos"""
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3) if samples else 0.0,
+    }
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,74 @@
+"""Coste por regla del ``when`` compilado frente al intérprete.
+
+Evalúa cada regla de una base sintética contra una población de pacientes de
+dos formas: ``all(match_condition(...))`` (intérprete) y el predicado de
+``compile_when``. Comprueba que ambas dan el mismo resultado y reporta ns por
+evaluación de regla, el coste de compilar y el efecto en ``infer()``.
+
+    python benchmarks/compiled_conditions.py --rules 1000 --population 500
+"""
+import argparse
+import json
+import time
+
+import common  # noqa: F401  (añade backend/ al sys.path)
+from engine import RuleIndex, compile_when, infer, match_condition
+from synth import generate_rules, generate_facts
+
+
+def interpreted(rule):
+    when = rule.get("when", [])
+    return lambda facts: all(match_condition(facts, c) for c in when)
+
+
+def per_eval_ns(predicates, population):
+    t0 = time.perf_counter()
+    for facts in population:
+        for pred in predicates:
+            pred(facts)
+    return (time.perf_counter() - t0) / (len(predicates) * len(population)) * 1e9
+
+
+def run(args):
+    rules = generate_rules(args.rules, [], seed=args.seed)
+    population = generate_facts(args.population, seed=args.seed)
+
+    t0 = time.perf_counter()
+    compiled = [compile_when(r["when"]) for r in rules]
+    compile_us = (time.perf_counter() - t0) / len(rules) * 1e6
+    slow = [interpreted(r) for r in rules]
+    for facts in population[:50]:
+        assert [p(facts) for p in compiled] == [p(facts) for p in slow]
+
+    interp_ns = per_eval_ns(slow, population)
+    compiled_ns = per_eval_ns(compiled, population)
+
+    index = RuleIndex(rules)
+    sample = population[: max(1, args.population // 5)]
+    t0 = time.perf_counter()
+    for facts in sample:
+        infer(facts, rules)
+    linear_ms = (time.perf_counter() - t0) / len(sample) * 1000
+    for facts in sample:
+        infer(facts, index)  # primera pasada: compila las reglas candidatas
+    t0 = time.perf_counter()
+    for facts in sample:
+        infer(facts, index)
+    indexed_ms = (time.perf_counter() - t0) / len(sample) * 1000
+
+    print(json.dumps({
+        "rules": args.rules,
+        "population": args.population,
+        "rule_eval_ns": {"interpreted": round(interp_ns, 1), "compiled": round(compiled_ns, 1),
+                         "speedup": round(interp_ns / compiled_ns, 2)},
+        "compile_us_per_rule": round(compile_us, 2),
+        "infer_ms": {"interpreted_linear": round(linear_ms, 3), "compiled_indexed": round(indexed_ms, 3)},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, default=1000)
+    parser.add_argument("--population", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
@@ -0,0 +1,116 @@
+"""Throughput de los helpers de base de datos: conexión nueva vs pool.
+
+Compara el modo anterior (``sqlite3.connect`` en cada llamada, journal por
+defecto) con ``db.ConnectionPool`` (WAL + pragmas) ejecutando desde varios
+hilos los helpers del login (``get_user_by_email``) y el CRUD de reglas
+(``save_rule``/``update_rule``/``delete_rule`` + ``load_rules``). También mide
+/auth/login de extremo a extremo con ``--rounds`` rondas de pbkdf2.
+
+    python benchmarks/db_throughput.py --threads 4 --seconds 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from common import client, load_app
+
+RULE = {"id": "B0", "name": "Bench", "priority": 1, "when": [{"fact": "bmi", "op": ">=", "value": 40}], "then": {"diagnosis": ["X"]}}
+
+
+def run_threads(fn, threads, seconds):
+    """Ejecuta ``fn(thread_id, i)`` en bucle desde varios hilos; devuelve ops/s"""
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(tid):
+        i = 0
+        while time.perf_counter() < deadline:
+            fn(tid, i)
+            i += 1
+        counts[tid] = i
+
+    ts = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return round(sum(counts) / seconds, 1)
+
+
+def bench_mode(main, mode, db_dir, args):
+    path = os.path.join(db_dir, f"{mode}.db")
+    if mode == "legacy":
+        main.get_conn = lambda: sqlite3.connect(path)
+    else:
+        pool = main.ConnectionPool(path)
+        main.get_conn = pool.connection
+    main.init_db()
+    with main.get_conn() as con:
+        con.execute("INSERT INTO users (email,name,password_hash,role) VALUES (?,?,?,?)",
+                    ("bench@nutri.com", "Bench", main.hash_password("bench123"), "patient"))
+        con.commit()
+
+    def login_lookup(tid, i):
+        assert main.get_user_by_email("bench@nutri.com")
+
+    def rule_crud(tid, i):
+        rule = dict(RULE, id=f"B{tid}-{i}")
+        main.save_rule(rule)
+        main.update_rule(dict(rule, priority=2))
+        main.load_rules()
+        main.delete_rule(rule["id"])
+
+    # Lectores del login mientras otros hilos escriben reglas
+    def mixed(tid, i):
+        if tid % 2:
+            rule_crud(tid, i)
+        else:
+            login_lookup(tid, i)
+
+    return {
+        "login_lookup_ops_s": run_threads(login_lookup, args.threads, args.seconds),
+        "rule_crud_cycles_s": run_threads(rule_crud, args.threads, args.seconds),
+        "mixed_ops_s": run_threads(mixed, args.threads, args.seconds),
+    }
+
+
+async def login_throughput(main, args):
+    await main.on_startup()
+    sem = asyncio.Semaphore(args.concurrency)
+    async with client(main) as http:
+        async def one():
+            async with sem:
+                r = await http.post("/auth/login", data={"username": "pro@nutri.com", "password": "nutri123"})
+            assert r.status_code == 200, r.text
+        await one()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.logins)))
+        return round(args.logins / (time.perf_counter() - t0), 1)
+
+
+def main_(args):
+    db_dir = tempfile.mkdtemp(prefix="nutri-db-bench-")
+    if args.rounds:
+        os.environ["PBKDF2_ROUNDS"] = str(args.rounds)
+    main = load_app(db_dir)
+    pooled_get_conn = main.get_conn
+    report = {mode: bench_mode(main, mode, db_dir, args) for mode in ("legacy", "pooled")}
+    main.get_conn = pooled_get_conn
+    report["login_end_to_end_req_s"] = asyncio.run(login_throughput(main, args))
+    report["config"] = {"threads": args.threads, "seconds": args.seconds, "pbkdf2_rounds": main.PBKDF2_ROUNDS}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=0, help="rondas pbkdf2 para el login de extremo a extremo")
+    main_(parser.parse_args())
@@ -0,0 +1,111 @@
+"""Coste del historial de inferencias y de las consultas de estadísticas.
+
+1. Por inferencia: ``HistoryWriter.record()`` (buffer en memoria) frente a
+   escribir la fila y sus agregados en su propia transacción.
+2. ``/infer`` de extremo a extremo sin historial y con escritura diferida.
+3. Con ``--rows`` inferencias en el historial: ``/stats/diagnoses`` y
+   ``/stats/bmi`` (tablas de agregados) frente a la misma consulta recorriendo
+   ``inference_history``.
+
+    python benchmarks/history_overhead.py --rows 200000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import client, load_app, startup, summarize
+from synth import generate_facts
+
+RAW_DIAGNOSES_SQL = (
+    "SELECT date(ts, 'unixepoch') AS day, d.value, COUNT(1) FROM inference_history, json_each(diagnosis) AS d "
+    "WHERE ts>=? GROUP BY 1, 2"
+)
+RAW_BMI_SQL = "SELECT CAST(bmi AS INTEGER), COUNT(1) FROM inference_history WHERE ts>=? GROUP BY 1"
+
+
+def per_call_us(fn, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+async def sample(fn, n):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        await fn(i)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+async def run(args):
+    main = load_app()
+    await startup(main)
+    history = main.history
+    history._stop.set()  # el benchmark vacía el buffer a mano
+    facts = generate_facts(args.population, seed=0)
+    results = [main.infer(f, main.rule_cache.get().index) for f in facts]
+    pairs = list(zip(facts, results))
+
+    record_us = per_call_us(lambda i: history.record(*pairs[i % len(pairs)]), args.calls)
+    history.flush()
+    sync_us = per_call_us(lambda i: history._write([(time.time(), *pairs[i % len(pairs)])]), min(args.calls, 2000))
+
+    token = main.create_access_token({"sub": "1", "role": "nutritionist"})
+    headers = {"Authorization": f"Bearer {token}"}
+    async with client(main) as http:
+        async def post_infer(i):
+            r = await http.post("/infer", json=facts[i % len(facts)])
+            assert r.status_code == 200, r.text
+
+        main.HISTORY_ENABLED = False
+        off = summarize(await sample(post_infer, args.requests))
+        main.HISTORY_ENABLED = True
+        on = summarize(await sample(post_infer, args.requests))
+        history.flush()
+
+        # Historial sintético repartido en los últimos 30 días
+        now = time.time()
+        for start in range(0, args.rows, 5000):
+            batch = [(now - (i % 30) * 86400, *pairs[i % len(pairs)]) for i in range(start, min(args.rows, start + 5000))]
+            history._write(batch)
+
+        async def get(path):
+            async def call(_):
+                r = await http.get(path, headers=headers)
+                assert r.status_code == 200, r.text
+            return summarize(await sample(call, args.queries))
+
+        rollup_diag = await get("/stats/diagnoses?days=30")
+        rollup_bmi = await get("/stats/bmi?days=30")
+
+    since = now - 30 * 86400
+
+    def raw(sql):
+        samples = []
+        for _ in range(max(3, args.queries // 10)):
+            t0 = time.perf_counter()
+            with history._conn() as con:
+                con.execute(sql, (since,)).fetchall()
+            samples.append(time.perf_counter() - t0)
+        return summarize(samples)
+
+    print(json.dumps({
+        "per_inference_us": {"write_behind_record": round(record_us, 2), "sync_transaction": round(sync_us, 1)},
+        "http_/infer": {"history_off": off, "write_behind": on},
+        "history_rows": args.rows,
+        "stats_diagnoses": {"rollup_http": rollup_diag, "raw_scan_sql": raw(RAW_DIAGNOSES_SQL)},
+        "stats_bmi": {"rollup_http": rollup_bmi, "raw_scan_sql": raw(RAW_BMI_SQL)},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--population", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=20000, help="llamadas a record()")
+    parser.add_argument("--requests", type=int, default=1000, help="peticiones /infer por variante")
+    parser.add_argument("--rows", type=int, default=200000, help="filas de historial para las consultas")
+    parser.add_argument("--queries", type=int, default=50)
+    asyncio.run(run(parser.parse_args()))
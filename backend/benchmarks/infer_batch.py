@@ -0,0 +1,52 @@
+"""``infer_batch()`` frente a ``infer()`` indexado fila a fila.
+
+Sobre ``--rows`` pacientes sintéticos y bases de ``--rules`` reglas (las
+semilla más reglas sintéticas con condiciones numéricas y categóricas), mide
+el tiempo de inferir el lote entero por columnas y paciente a paciente, y
+comprueba que los resultados son idénticos.
+
+    python benchmarks/infer_batch.py --rows 20000 --rules 10,100,1000
+"""
+import argparse
+import json
+import time
+
+from common import load_app
+from synth import generate_facts, generate_rules
+
+
+def best_of(fn, repeat):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main(args):
+    from batch import infer_batch
+    from engine import RuleIndex, infer
+    seed_rules = load_app().SEED_RULES
+    facts = generate_facts(args.rows, seed=0)
+    report = {"rows": args.rows, "seconds": {}}
+    for n in args.rules:
+        index = RuleIndex(generate_rules(n, seed_rules, seed=0))
+        serial_s, serial = best_of(lambda: [infer(f, index) for f in facts], args.repeat)
+        batch_s, batch = best_of(lambda: infer_batch(facts, index), args.repeat)
+        if serial != batch:
+            raise SystemExit(f"❌ infer_batch no coincide con infer() con {n} reglas")
+        report["seconds"][f"{n}_rules"] = {
+            "serial_infer": round(serial_s, 3),
+            "infer_batch": round(batch_s, 3),
+            "speedup": round(serial_s / batch_s, 2),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--rules", type=lambda s: [int(x) for x in s.split(",")], default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
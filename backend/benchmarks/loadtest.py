@@ -0,0 +1,381 @@
+"""Prueba de carga de un servidor real con el modelo Gemini falso.
+
+Arranca gunicorn con la misma configuración que el despliegue
+(``gunicorn.conf.py``, que usan el ``Procfile`` y ``render.yaml``) cambiando
+sólo ``--workers N`` y la dirección, sobre una base de datos temporal y
+``GEMINI_BACKEND=fake`` (latencia ``--gemini-latency``), y
+lanza ``--concurrency`` usuarios virtuales en bucle cerrado durante
+``--duration`` segundos con una mezcla de:
+
+- ``login``: ``POST /auth/login``
+- ``me``: ``GET /auth/me``
+- ``infer``: ``POST /infer`` con pacientes sintéticos
+- ``rules``: ``GET /rules`` y, en ``--rules-write-ratio`` de los casos, un ciclo
+  ``POST``/``PUT``/``DELETE /rules`` sobre una regla temporal
+- ``analyze``: ``POST /analyze-image/upload``; sólo ``--analyze-hit-ratio``
+  de las peticiones repite foto y prompt (acierto en la cache de análisis), el
+  resto paga la latencia del modelo
+
+Para cada combinación de workers y concurrencia informa del throughput total y,
+por ruta, peticiones por segundo, códigos de error y p50/p95/p99, y marca el
+punto de saturación: la primera concurrencia que no mejora el throughput al
+menos un ``--saturation-gain``. Con ``--target`` se usa un servidor ya
+arrancado en lugar de gunicorn. ``--baseline``/``--threshold`` comparan el p50
+por ruta con una ejecución anterior, como ``suite.py``.
+
+Por defecto prueba 1, 2 y los workers de producción (``workers`` de
+``gunicorn.conf.py``).
+
+    python benchmarks/loadtest.py --workers 1,2,4 --concurrency 8,32,64 --duration 20
+    python benchmarks/loadtest.py --mix infer=80,rules=20 --workers 4 --output load.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from common import BACKEND_DIR, summarize
+from suite import compare
+from synth import generate_facts
+
+DEFAULT_MIX = "login=2,me=20,infer=55,rules=18,analyze=5"
+NUTRITIONIST = {"username": "pro@nutri.com", "password": "nutri123"}
+ANALYZE_PROMPT = "Analiza este plato y estima sus calorías y macronutrientes"
+PATIENT = {"email": "loadtest@nutri.com", "name": "Paciente de carga", "password": "loadtest123"}
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"❌ Escenario desconocido en --mix: {name!r} (válidos: {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def make_images(n, seed=0):
+    """Fotos JPEG distintas (ruido de color) para que el análisis no acierte siempre en la cache"""
+    from PIL import Image
+    rng = random.Random(seed)
+    images = []
+    for _ in range(n):
+        img = Image.effect_noise((320, 240), rng.uniform(20, 80)).convert("RGB")
+        img = Image.merge("RGB", [band.point(lambda v, o=rng.randint(0, 255): (v + o) % 256) for band in img.split()])
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        images.append(buf.getvalue())
+    return images
+
+
+# ---------- ESCENARIOS ----------
+# Cada escenario hace una o varias peticiones y devuelve [(ruta, status, segundos)].
+
+async def timed(http, method, route, url=None, **kwargs):
+    t0 = time.perf_counter()
+    try:
+        r = await http.request(method, url or route, **kwargs)
+        status = r.status_code
+    except Exception:
+        status = 0  # error de transporte (timeout, conexión rechazada)
+    return route, status, time.perf_counter() - t0
+
+
+async def scenario_login(http, ctx, rng):
+    return [await timed(http, "POST", "POST /auth/login", "/auth/login", data=NUTRITIONIST)]
+
+
+async def scenario_me(http, ctx, rng):
+    return [await timed(http, "GET", "GET /auth/me", "/auth/me", headers=ctx["patient"])]
+
+
+async def scenario_infer(http, ctx, rng):
+    facts = ctx["facts"][rng.randrange(len(ctx["facts"]))]
+    return [await timed(http, "POST", "POST /infer", "/infer", json=facts, headers=ctx["patient"])]
+
+
+async def scenario_rules(http, ctx, rng):
+    if rng.random() >= ctx["rules_write_ratio"]:
+        return [await timed(http, "GET", "GET /rules", "/rules")]
+    rule = {
+        "id": f"LT-{uuid.uuid4().hex[:12]}",
+        "name": "Regla de carga",
+        "priority": 1,
+        "when": [{"fact": "bmi", "op": ">=", "value": round(rng.uniform(40, 60), 1)}],
+        "then": {"diagnosis": ["Prueba de carga"]},
+    }
+    headers = ctx["nutritionist"]
+    samples = [await timed(http, "POST", "POST /rules", "/rules", json=rule, headers=headers)]
+    rule["priority"] = 2
+    samples.append(await timed(http, "PUT", "PUT /rules/{id}", f"/rules/{rule['id']}", json=rule, headers=headers))
+    samples.append(await timed(http, "DELETE", "DELETE /rules/{id}", f"/rules/{rule['id']}", headers=headers))
+    return samples
+
+
+async def scenario_analyze(http, ctx, rng):
+    image = ctx["images"][rng.randrange(len(ctx["images"]))]
+    prompt = ANALYZE_PROMPT
+    if rng.random() >= ctx["analyze_hit_ratio"]:
+        prompt += f" (ref. {uuid.uuid4().hex[:8]})"  # la clave de la cache incluye el prompt
+    return [await timed(
+        http, "POST", "POST /analyze-image/upload", "/analyze-image/upload",
+        files={"file": ("comida.jpg", image, "image/jpeg")}, data={"prompt": prompt}, headers=ctx["patient"],
+    )]
+
+
+SCENARIOS = {
+    "login": scenario_login,
+    "me": scenario_me,
+    "infer": scenario_infer,
+    "rules": scenario_rules,
+    "analyze": scenario_analyze,
+}
+
+
+async def prepare(http, args):
+    """Tokens de un nutricionista y de un paciente, pacientes sintéticos y fotos"""
+    r = await http.post("/auth/register", json=PATIENT)
+    if r.status_code not in (200, 400):
+        raise SystemExit(f"❌ No se pudo registrar el paciente de carga: {r.status_code} {r.text}")
+    tokens = {}
+    for role, form in (("nutritionist", NUTRITIONIST), ("patient", {"username": PATIENT["email"], "password": PATIENT["password"]})):
+        r = await http.post("/auth/login", data=form)
+        if r.status_code != 200:
+            raise SystemExit(f"❌ Login de {role} fallido: {r.status_code} {r.text}")
+        tokens[role] = {"Authorization": f"Bearer {r.json()['access_token']}"}
+    return {
+        **tokens,
+        "facts": generate_facts(args.population, seed=args.seed),
+        "images": make_images(args.images, seed=args.seed) if "analyze" in args.mix else [],
+        "rules_write_ratio": args.rules_write_ratio,
+        "analyze_hit_ratio": args.analyze_hit_ratio,
+    }
+
+
+async def drive(http, ctx, mix, concurrency, duration, warmup=0.0, seed=0):
+    """Usuarios virtuales en bucle cerrado; devuelve las muestras tomadas tras el calentamiento"""
+    names, weights = list(mix), list(mix.values())
+    samples = []
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    measure_from, end = start + warmup, start + warmup + duration
+
+    async def user(i):
+        rng = random.Random(seed * 100003 + i)
+        while loop.time() < end:
+            name = rng.choices(names, weights)[0]
+            began = loop.time()
+            result = await SCENARIOS[name](http, ctx, rng)
+            if began >= measure_from:
+                samples.extend(result)
+
+    await asyncio.gather(*(user(i) for i in range(concurrency)))
+    return samples
+
+
+def report_level(samples, duration):
+    routes = {}
+    for route, status, seconds in samples:
+        routes.setdefault(route, []).append((status, seconds))
+    by_route = {}
+    for route, items in sorted(routes.items()):
+        stats = summarize([s for _, s in items])
+        errors = {}
+        for status, _ in items:
+            if not 200 <= status < 300:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        stats["rps"] = round(len(items) / duration, 1)
+        stats["errors"] = errors
+        by_route[route] = stats
+    ok = sum(1 for _, status, _ in samples if 200 <= status < 300)
+    return {
+        "rps": round(len(samples) / duration, 1),
+        "ok_rps": round(ok / duration, 1),
+        "error_ratio": round(1 - ok / len(samples), 4) if samples else 0.0,
+        "overall": summarize([s for _, _, s in samples]),
+        "routes": by_route,
+    }
+
+
+def saturation(levels, gain):
+    """Primera concurrencia cuyo throughput correcto no mejora ``gain`` respecto a la anterior"""
+    previous = None
+    for concurrency, level in levels.items():
+        if previous is not None and level["ok_rps"] < previous["ok_rps"] * (1 + gain):
+            return int(concurrency)
+        previous = level
+    return None
+
+
+# ---------- SERVIDOR ----------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+GUNICORN_CONF = os.path.join(BACKEND_DIR, "gunicorn.conf.py")
+
+
+def production_workers():
+    """Workers con los que arranca el despliegue (``Procfile`` y ``render.yaml``)"""
+    return runpy.run_path(GUNICORN_CONF)["workers"]
+
+
+def start_server(workers, port, db_dir, args):
+    env = dict(
+        os.environ,
+        DATABASE_URL="sqlite:///" + os.path.join(db_dir, "rules.db"),
+        JWT_SECRET_KEY=os.getenv("JWT_SECRET_KEY", "loadtest-secret"),
+        GEMINI_BACKEND="fake",
+        FAKE_GEMINI_LATENCY_SECONDS=str(args.gemini_latency),
+        RATE_LIMIT_ENABLED="0",  # todo el tráfico sale de 127.0.0.1
+    )
+    cmd = [
+        sys.executable, "-m", "gunicorn", "main:app", "-c", GUNICORN_CONF,
+        "--workers", str(workers), "--bind", f"127.0.0.1:{port}", "--log-level", "warning",
+    ]
+    log = open(os.path.join(db_dir, "server.log"), "w")
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT), log
+
+
+async def wait_ready(base_url, proc, timeout=60.0):
+    import httpx
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url, timeout=2.0) as http:
+        while time.monotonic() < deadline:
+            if proc is not None and proc.poll() is not None:
+                raise SystemExit(f"❌ El servidor terminó al arrancar (código {proc.returncode})")
+            try:
+                if (await http.get("/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise SystemExit(f"❌ El servidor no respondió en {timeout:.0f} s")
+
+
+def stop_server(proc, log):
+    proc.terminate()
+    try:
+        proc.wait(15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    log.close()
+
+
+async def run_workers(base_url, label, args):
+    import httpx
+    levels = {}
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=args.timeout,
+        limits=httpx.Limits(max_connections=max(args.concurrency_levels), max_keepalive_connections=max(args.concurrency_levels)),
+    ) as http:
+        ctx = await prepare(http, args)
+        for concurrency in args.concurrency_levels:
+            print(f"⏱️  {label}, {concurrency} usuarios...", file=sys.stderr)
+            samples = await drive(http, ctx, args.mix, concurrency, args.duration, args.warmup, args.seed)
+            levels[str(concurrency)] = report_level(samples, args.duration)
+            level = levels[str(concurrency)]
+            print(f"   {level['ok_rps']} ok/s, p99 {level['overall']['p99_ms']} ms, errores {level['error_ratio']:.1%}", file=sys.stderr)
+    return {"levels": levels, "saturation_concurrency": saturation(levels, args.saturation_gain)}
+
+
+async def run(args):
+    results = {}
+    if args.target:
+        results["external"] = await run_workers(args.target.rstrip("/"), args.target, args)
+    else:
+        for workers in args.worker_counts:
+            port = free_port()
+            with tempfile.TemporaryDirectory(prefix="nutri-load-") as db_dir:
+                proc, log = start_server(workers, port, db_dir, args)
+                try:
+                    base_url = f"http://127.0.0.1:{port}"
+                    try:
+                        await wait_ready(base_url, proc)
+                    except SystemExit:
+                        log.flush()
+                        with open(log.name) as f:
+                            print(f.read()[-4000:], file=sys.stderr)
+                        raise
+                    results[str(workers)] = await run_workers(base_url, f"{workers} workers", args)
+                finally:
+                    stop_server(proc, log)
+
+    flat = {
+        f"w{workers}.c{concurrency}.{route}": stats
+        for workers, result in results.items()
+        for concurrency, level in result["levels"].items()
+        for route, stats in level["routes"].items()
+    }
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "target": args.target or "gunicorn",
+            "mix": args.mix,
+            "duration_s": args.duration,
+            "gemini_latency_s": args.gemini_latency,
+            "production_workers": production_workers(),
+        },
+        "workers": results,
+        "results": flat,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(flat, json.load(f)["results"], args.threshold)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if report.get("regressions"):
+        print(f"❌ {len(report['regressions'])} rutas empeoran más de un {args.threshold:.0%}", file=sys.stderr)
+        raise SystemExit(1)
+
+
+def int_list(spec):
+    return [int(x) for x in spec.split(",") if x.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", dest="worker_counts", type=int_list, default=None,
+                        help="workers de gunicorn a probar (por defecto 1, 2 y los de gunicorn.conf.py)")
+    parser.add_argument("--concurrency", dest="concurrency_levels", type=int_list, default="8,32,64", help="usuarios virtuales")
+    parser.add_argument("--duration", type=float, default=20.0, help="segundos medidos por nivel")
+    parser.add_argument("--warmup", type=float, default=2.0, help="segundos sin medir antes de cada nivel")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="pesos por escenario")
+    parser.add_argument("--rules-write-ratio", type=float, default=0.05, help="fracción de 'rules' que crea/edita/borra")
+    parser.add_argument("--analyze-hit-ratio", type=float, default=0.2, help="fracción de análisis servidos por la cache")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="latencia total del modelo falso (s)")
+    parser.add_argument("--population", type=int, default=1000, help="pacientes sintéticos")
+    parser.add_argument("--images", type=int, default=10, help="fotos distintas para el análisis")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout por petición (s)")
+    parser.add_argument("--saturation-gain", type=float, default=0.1, help="mejora mínima de throughput entre niveles")
+    parser.add_argument("--target", help="URL de un servidor ya arrancado (no se lanza gunicorn)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="fichero JSON de resultados")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior para comparar")
+    parser.add_argument("--threshold", type=float, default=0.2, help="empeoramiento máximo del p50 (0.2 = 20%%)")
+    args = parser.parse_args()
+    if args.worker_counts is None:
+        args.worker_counts = sorted({1, 2, production_workers()})
+    asyncio.run(run(args))
@@ -0,0 +1,82 @@
+"""Latencia de /infer durante una ráfaga concurrente de logins.
+
+Mide el p50/p99 de /infer en reposo y mientras ``--logins`` peticiones a
+/auth/login se ejecutan en paralelo. Con el hashing en ``hash_executor`` el
+p99 de /infer debe mantenerse plano; ``--inline`` hashea en el event loop
+(comportamiento anterior) para comparar.
+
+    python benchmarks/login_storm.py --logins 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import client, load_app, startup, summarize
+
+FACTS = {"age": 30, "sex": "M", "height_cm": 175, "weight_kg": 90, "activity": "moderate", "conditions": [], "bmi": 29.4}
+
+
+async def measure_infer(http, n, stop=None):
+    samples = []
+    for _ in range(n):
+        if stop is not None and stop.is_set():
+            break
+        t0 = time.perf_counter()
+        r = await http.post("/infer", json=FACTS)
+        samples.append(time.perf_counter() - t0)
+        assert r.status_code == 200, r.text
+        await asyncio.sleep(0.001)
+    return samples
+
+
+async def login_storm(http, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async def one():
+        async with sem:
+            r = await http.post("/auth/login", data={"username": "pro@nutri.com", "password": "nutri123"})
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    await asyncio.gather(*(one() for _ in range(total)))
+    return statuses
+
+
+async def run(args):
+    main = load_app()
+    if args.inline:
+        async def inline(fn, *a):
+            return fn(*a)
+        main._run_hashing = inline
+    await startup(main)
+    async with client(main) as http:
+        await measure_infer(http, 50)  # calentamiento
+        idle = await measure_infer(http, args.samples)
+
+        t0 = time.perf_counter()
+        storm = asyncio.create_task(login_storm(http, args.logins, args.concurrency))
+        busy = []
+        while not storm.done():
+            busy += await measure_infer(http, 1)
+        statuses = await storm
+        storm_seconds = time.perf_counter() - t0
+
+    report = {
+        "mode": "inline" if args.inline else "executor",
+        "pbkdf2_rounds": main.PBKDF2_ROUNDS,
+        "hash_workers": main.HASH_WORKERS,
+        "infer_idle": summarize(idle),
+        "infer_during_storm": summarize(busy),
+        "logins": {"total": args.logins, "seconds": round(storm_seconds, 3), "statuses": statuses},
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--samples", type=int, default=300)
+    parser.add_argument("--inline", action="store_true", help="hashear en el event loop (comportamiento anterior)")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,68 @@
+"""Coste de la instrumentación por petición.
+
+Mide el coste de ``Histogram.observe``, de un ``logger.debug`` descartado por
+nivel y del ``MetricsMiddleware`` alrededor de una app ASGI trivial (diferencia
+por petición con y sin middleware). El objetivo es mantenerlo en pocos
+microsegundos.
+
+    python benchmarks/metrics_overhead.py --n 200000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import common  # noqa: F401  (añade backend/ al sys.path)
+from logs import setup_logging
+from metrics import Histogram, MetricsMiddleware
+
+
+def per_call_us(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+async def trivial_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def asgi_per_request_us(app, n):
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await app({"type": "http", "method": "GET", "path": "/x"}, receive, send)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def run(args):
+    hist = Histogram("bench_seconds", "bench", ("route",))
+    logger = setup_logging("nutriexpert.bench")
+    logger.setLevel("INFO")
+    observe_us = per_call_us(lambda: hist.observe(0.0042, "/infer"), args.n)
+    debug_us = per_call_us(lambda: logger.debug("descartado %s", 1), args.n)
+    bare = asyncio.run(asgi_per_request_us(trivial_app, args.n))
+    wrapped = asyncio.run(asgi_per_request_us(MetricsMiddleware(trivial_app), args.n))
+    report = {
+        "histogram_observe_us": round(observe_us, 3),
+        "logger_debug_filtered_us": round(debug_us, 3),
+        "middleware_overhead_us": round(wrapped - bare, 3),
+        "n": args.n,
+    }
+    print(json.dumps(report, indent=2))
+    if report["middleware_overhead_us"] > args.budget_us:
+        raise SystemExit(f"❌ Sobrecoste del middleware por encima de {args.budget_us} µs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=200000)
+    parser.add_argument("--budget-us", type=float, default=5.0)
+    run(parser.parse_args())
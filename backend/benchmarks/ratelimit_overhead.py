@@ -0,0 +1,114 @@
+"""Coste y exactitud del limitador de peticiones compartido.
+
+1. ``RateLimiter.take()`` por llamada con una y dos cubetas (usuario + IP).
+2. ``/infer`` de extremo a extremo con el limitador desactivado y activado
+   (límites altos, para que todas las peticiones se admitan).
+3. Varios procesos consumiendo la misma cubeta a la vez: el total admitido
+   debe ser exactamente la capacidad, como con varios workers de gunicorn.
+
+    python benchmarks/ratelimit_overhead.py --processes 4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+os.environ["RATE_LIMIT_ENABLED"] = "1"
+os.environ.setdefault("RATE_LIMIT_INFER_USER", "1000000/60")
+os.environ.setdefault("RATE_LIMIT_INFER_IP", "1000000/60")
+
+from common import client, load_app, startup, summarize  # noqa: E402
+from synth import generate_facts  # noqa: E402
+
+
+def per_call_us(fn, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+async def sample(fn, n):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        await fn(i)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def contend(path, capacity, attempts, out):
+    from ratelimit import Limit, RateLimiter
+    limiter = RateLimiter(path)
+    limit = Limit(capacity, capacity / 3600)  # sin relleno apreciable durante la prueba
+    out.put(sum(1 for _ in range(attempts) if limiter.take([("shared", limit)]) == 0))
+
+
+def multiprocess(args):
+    from ratelimit import RateLimiter
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ratelimit.db")
+        RateLimiter(path).init()
+        out = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=contend, args=(path, args.capacity, args.capacity, out))
+            for _ in range(args.processes)
+        ]
+        t0 = time.perf_counter()
+        for p in procs:
+            p.start()
+        admitted = [out.get() for _ in procs]
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - t0
+    attempts = args.capacity * args.processes
+    return {
+        "processes": args.processes,
+        "attempts": attempts,
+        "capacity": args.capacity,
+        "admitted": sum(admitted),
+        "admitted_per_process": admitted,
+        "takes_per_s": round(attempts / elapsed),
+    }
+
+
+async def run(args):
+    main = load_app()
+    await startup(main)
+    from ratelimit import Limit
+    limiter = main.rate_limiter
+    limit = Limit(1e9, 1e9)
+    one = per_call_us(lambda i: limiter.take([(f"bench:user:{i % 100}", limit)]), args.calls)
+    two = per_call_us(
+        lambda i: limiter.take([(f"bench:user:{i % 100}", limit), (f"bench:ip:{i % 10}", limit)]), args.calls
+    )
+
+    facts = generate_facts(args.population, seed=0)
+    async with client(main) as http:
+        async def post_infer(i):
+            r = await http.post("/infer", json=facts[i % len(facts)])
+            assert r.status_code == 200, r.text
+
+        main.RATE_LIMIT_ENABLED = False
+        off = summarize(await sample(post_infer, args.requests))
+        main.RATE_LIMIT_ENABLED = True
+        on = summarize(await sample(post_infer, args.requests))
+
+    print(json.dumps({
+        "take_us": {"one_bucket": round(one, 1), "user_and_ip": round(two, 1)},
+        "http_/infer": {"limiter_off": off, "limiter_on": on},
+        "multiprocess": multiprocess(args),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=5000, help="llamadas a take() por variante")
+    parser.add_argument("--population", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=1000, help="peticiones /infer por variante")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--capacity", type=int, default=500, help="capacidad de la cubeta compartida")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""Simulación de un borrador de reglas: serie frente a pool de procesos.
+
+Sobre ``--patients`` pacientes sintéticos y una base de ``--rules`` reglas,
+compara el tiempo de obtener el resumen de diferencias entre las reglas
+actuales y un borrador (umbrales de IMC desplazados y kcal de R2 cambiadas):
+
+- ``serial_infer``: ``infer()`` paciente a paciente con las dos bases, como
+  haría un endpoint síncrono
+- ``SimulationRunner`` sin procesos (los mismos lotes en un hilo)
+- ``SimulationRunner`` con ``--processes`` procesos
+
+y comprueba que todos los resúmenes coinciden. En una máquina con un solo
+núcleo el pool no puede ir más rápido que el hilo.
+
+    python benchmarks/rule_simulation.py --patients 200000 --processes 4
+"""
+import argparse
+import copy
+import json
+import os
+import tempfile
+import time
+
+from common import load_app
+from synth import generate_facts, generate_rules
+
+
+def make_draft(rules):
+    draft = copy.deepcopy(rules)
+    for rule in draft:
+        for cond in rule.get("when", []):
+            if cond.get("fact") == "bmi" and isinstance(cond.get("value"), (int, float)):
+                cond["value"] = round(cond["value"] + 1, 1)
+        kcal = rule.get("then", {}).get("diet", {}).get("kcal_target")
+        if isinstance(kcal, dict) and "deficit_pct" in kcal:
+            kcal["deficit_pct"] = round(kcal["deficit_pct"] + 0.05, 2)
+    return draft
+
+
+def serial(current, draft, population):
+    from engine import RuleIndex, infer
+    from simulation import diff_results, finalize_summary
+    ci, di = RuleIndex(current), RuleIndex(draft)
+    before = [infer(f, ci) for f in population]
+    after = [infer(f, di) for f in population]
+    return finalize_summary(diff_results(0, before, after))
+
+
+def pooled(current, draft, population, processes, shard_size, db_dir):
+    from simulation import DONE, SimulationRunner, SimulationStore
+    store = SimulationStore(os.path.join(db_dir, f"simulations-{processes}.db"))
+    store.init()
+    runner = SimulationRunner(store, processes=processes, shard_size=shard_size)
+    if processes > 0:
+        # Arranque de los procesos fuera de la medida (en el servidor el pool se reutiliza)
+        runner._get_executor().submit(pow, 1, 1).result()
+    sim_id = store.create("bench", len(population))
+    t0 = time.perf_counter()
+    runner.start(sim_id, current, draft, population)
+    while runner.running():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    runner.stop()
+    sim = store.get(sim_id)
+    assert sim["status"] == DONE, sim["error"]
+    return elapsed, sim["result"]
+
+
+def main(args):
+    current = generate_rules(args.rules, load_app().SEED_RULES, seed=0)
+    draft = make_draft(current)
+    population = generate_facts(args.patients, seed=args.seed)
+
+    report = {"patients": args.patients, "rules": len(current), "cpus": os.cpu_count(), "seconds": {}}
+    summaries = {}
+    if args.patients <= args.serial_max:
+        t0 = time.perf_counter()
+        summaries["serial_infer"] = serial(current, draft, population)
+        report["seconds"]["serial_infer"] = round(time.perf_counter() - t0, 3)
+    with tempfile.TemporaryDirectory(prefix="nutri-sim-") as db_dir:
+        for processes in sorted({0, args.processes}):
+            name = f"pool_{processes}_processes" if processes else "shards_in_thread"
+            elapsed, summaries[name] = pooled(current, draft, population, processes, args.shard_size, db_dir)
+            report["seconds"][name] = round(elapsed, 3)
+
+    reference = next(iter(summaries.values()))
+    report["identical_summaries"] = all(s == reference for s in summaries.values())
+    report["changed_patients"] = reference["changed"]
+    report["kcal_target"] = {k: v for k, v in reference["kcal_target"].items() if k != "delta_histogram"}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if not report["identical_summaries"]:
+        raise SystemExit("❌ Los resúmenes no coinciden")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100000)
+    parser.add_argument("--rules", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-size", type=int, default=5000)
+    parser.add_argument("--serial-max", type=int, default=200000, help="no medir infer() en serie por encima de este tamaño")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
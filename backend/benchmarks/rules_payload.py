@@ -0,0 +1,89 @@
+"""GET /rules pre-serializado frente a serializar en cada petición.
+
+Para cada tamaño de base de reglas compara, con un cliente ASGI en proceso:
+
+- ``legacy``: la implementación anterior (devolver ``{"rules": [...]}`` y que
+  FastAPI lo codifique), registrada en una ruta auxiliar del benchmark
+- ``GET /rules`` sin compresión, con gzip y condicional (``If-None-Match`` → 304)
+
+y el coste de codificar un resultado de ``/infer`` con ``json`` frente a
+``fastjson.dumps``.
+
+    python benchmarks/rules_payload.py --sizes 100,1000,10000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import client, load_app, startup, summarize
+from suite import replace_rules
+from synth import generate_facts, generate_rules
+
+
+async def sample(fn, n):
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+async def bench_size(main, http, size, args):
+    replace_rules(main, generate_rules(size, main.SEED_RULES, seed=0))
+    first = await http.get("/rules", headers={"Accept-Encoding": "gzip"})  # serializa la generación nueva
+    etag = first.headers["etag"]
+    results = {}
+
+    async def measure(name, path, headers, status=200):
+        sizes = []
+
+        async def call():
+            r = await http.get(path, headers=headers)
+            assert r.status_code == status, r.status_code
+            sizes.append(len(r.content) if r.headers.get("content-encoding") != "gzip" else int(r.headers["content-length"]))
+        stats = summarize(await sample(call, args.requests))
+        stats["bytes"] = sizes[-1]
+        results[name] = stats
+
+    await measure("legacy", "/bench/rules-legacy", {"Accept-Encoding": "identity"})
+    await measure("identity", "/rules", {"Accept-Encoding": "identity"})
+    await measure("gzip", "/rules", {"Accept-Encoding": "gzip"})
+    await measure("not_modified", "/rules", {"Accept-Encoding": "gzip", "If-None-Match": etag}, status=304)
+    return results
+
+
+async def run(args):
+    main = load_app()
+    await startup(main)
+    from fastjson import dumps, orjson
+
+    async def legacy_rules():
+        snapshot = main.rule_cache.get()
+        return {"rules": snapshot.rules}
+    main.app.add_api_route("/bench/rules-legacy", legacy_rules, methods=["GET"])
+
+    report = {"encoder": "orjson" if orjson else "json", "rules": {}}
+    async with client(main) as http:
+        for size in (int(s) for s in args.sizes.split(",")):
+            report["rules"][size] = await bench_size(main, http, size, args)
+
+    rules = main.load_rules()
+    results = [main.infer(f, rules) for f in generate_facts(200, seed=0)]
+    n = 20000
+
+    def per_call_us(fn):
+        t0 = time.perf_counter()
+        for i in range(n):
+            fn(results[i % len(results)])
+        return round((time.perf_counter() - t0) / n * 1e6, 2)
+    report["infer_encode_us"] = {"json": per_call_us(lambda r: json.dumps(r).encode()), "fastjson": per_call_us(dumps)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--requests", type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""Tiempo hasta el primer byte de /analyze-image/stream con el modelo falso.
+
+Arranca la app con ``GEMINI_BACKEND=fake`` (trozos con retardo, sin red) y la
+llama como aplicación ASGI para registrar cuándo llega cada evento SSE.
+Compara el primer ``chunk`` con el ``done`` final y con /analyze-image/upload,
+y comprueba que una desconexión del cliente cierra el stream del modelo y
+libera el cupo de Gemini.
+
+    python benchmarks/sse_stream.py --latency 2 --chunks 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from io import BytesIO
+
+from common import load_app, startup
+
+
+def photo() -> bytes:
+    """JPEG distinto en cada llamada para no acertar en la cache de análisis"""
+    from PIL import Image
+    noise = Image.frombytes("RGB", (16, 12), random.randbytes(16 * 12 * 3))
+    img = noise.resize((640, 480), Image.BILINEAR)
+    out = BytesIO()
+    img.save(out, "JPEG")
+    return out.getvalue()
+
+
+def multipart_request(path, token):
+    import httpx
+    req = httpx.Request("POST", "http://bench" + path, files={"file": ("plato.jpg", photo(), "image/jpeg")},
+                        headers={"Authorization": f"Bearer {token}"})
+    return req.read(), [(k.lower().encode(), v.encode()) for k, v in req.headers.items()]
+
+
+async def call(app, path, token, disconnect_after_chunks=None):
+    """Llama a la app y devuelve los instantes (desde el inicio) de cada evento recibido"""
+    body, headers = multipart_request(path, token)
+    disconnected = asyncio.Event()
+    sent = [False]
+    events, start = [], time.perf_counter()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "", "headers": headers,
+             "client": ("127.0.0.1", 5000), "server": ("bench", 80)}
+
+    async def receive():
+        if not sent[0]:
+            sent[0] = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            for block in message["body"].decode().split("\n\n"):
+                if block.startswith("event: "):
+                    events.append((block.split("\n")[0][7:], time.perf_counter() - start))
+                elif block.strip() and not events:
+                    events.append(("body", time.perf_counter() - start))
+            chunks = sum(1 for name, _ in events if name == "chunk")
+            if disconnect_after_chunks is not None and chunks >= disconnect_after_chunks:
+                disconnected.set()
+
+    await app(scope, receive, send)
+    return events
+
+
+async def run(args):
+    os.environ["GEMINI_BACKEND"] = "fake"
+    os.environ["FAKE_GEMINI_LATENCY_SECONDS"] = str(args.latency)
+    os.environ["FAKE_GEMINI_CHUNKS"] = str(args.chunks)
+    main = load_app()
+    await startup(main)
+    token = main.create_access_token({"sub": "pro@nutri.com", "role": "nutritionist"})
+
+    stream = await call(main.app, "/analyze-image/stream", token)
+    first_chunk = next(t for name, t in stream if name == "chunk")
+    done = next(t for name, t in stream if name == "done")
+    upload = await call(main.app, "/analyze-image/upload", token)
+
+    await call(main.app, "/analyze-image/stream", token, disconnect_after_chunks=1)
+    fake = main.gemini_model.last_stream
+    await asyncio.sleep(args.latency / args.chunks * 2)
+    slots_free = main.gemini_slots._value
+
+    report = {
+        "fake_latency_s": args.latency,
+        "chunks": args.chunks,
+        "stream_first_chunk_ms": round(first_chunk * 1000, 1),
+        "stream_done_ms": round(done * 1000, 1),
+        "first_chunk_fraction": round(first_chunk / done, 3),
+        "upload_response_ms": round(upload[0][1] * 1000, 1),
+        "disconnect": {"upstream_closed": fake.closed, "chunks_generated": fake.chunks_sent,
+                       "slots_free": slots_free, "slots_total": main.GEMINI_MAX_CONCURRENCY},
+    }
+    print(json.dumps(report, indent=2))
+    assert fake.closed and fake.chunks_sent < args.chunks, "la desconexión no canceló el stream del modelo"
+    assert slots_free == main.GEMINI_MAX_CONCURRENCY, "el cupo de Gemini no se liberó"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=2.0, help="latencia total del modelo falso (s)")
+    parser.add_argument("--chunks", type=int, default=8)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,120 @@
+"""Tiempo de importación y de arranque de un worker.
+
+Cada medida se hace en un proceso nuevo (la importación sólo se paga una vez
+por proceso):
+
+- ``import main`` (mediana de ``--repeat`` procesos) y qué dependencias pesadas
+  quedan cargadas tras importar (no deberían: Gemini, Pillow y NumPy se
+  importan en el primer uso)
+- arranque en frío: ``bootstrap()`` sobre una base de datos nueva (esquemas,
+  usuario demo y reglas iniciales)
+- arranque en caliente: el mismo directorio otra vez (sólo lee la marca)
+- ``--workers`` procesos arrancando a la vez sobre una base nueva, como los
+  workers de gunicorn: uno hace el bootstrap y ninguno falla con
+  "database is locked"
+
+Con ``--import-budget-ms`` / ``--boot-budget-ms`` termina con código 1 si la
+mediana supera el presupuesto.
+
+    python benchmarks/startup.py --workers 4 --import-budget-ms 1000 --boot-budget-ms 250
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ("google.generativeai", "PIL.Image", "numpy")
+
+
+def child(db_dir):
+    """Se ejecuta en el proceso hijo: importa la app, hace el bootstrap e imprime los tiempos"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    t0 = time.perf_counter()
+    from common import load_app
+    main = load_app(db_dir)
+    imported = time.perf_counter()
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    ran = main.bootstrap()
+    booted = time.perf_counter()
+    print(json.dumps({"import_ms": (imported - t0) * 1000, "bootstrap_ms": (booted - imported) * 1000,
+                      "bootstrapped": ran, "heavy_loaded": loaded}))
+
+
+def spawn(db_dir):
+    env = dict(os.environ, JWT_SECRET_KEY="benchmark-secret", JOB_WORKERS="0")
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", db_dir],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
+
+
+def collect(proc):
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise SystemExit(f"❌ El proceso hijo falló:\n{err}")
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def ms(values):
+    return round(statistics.median(values), 1)
+
+
+def run(args):
+    collect(spawn(tempfile.mkdtemp(prefix="nutri-boot-")))  # calienta __pycache__
+
+    imports, cold, warm, heavy = [], [], [], set()
+    for _ in range(args.repeat):
+        db_dir = tempfile.mkdtemp(prefix="nutri-boot-")
+        first = collect(spawn(db_dir))
+        second = collect(spawn(db_dir))
+        assert first["bootstrapped"] and not second["bootstrapped"]
+        imports += [first["import_ms"], second["import_ms"]]
+        cold.append(first["bootstrap_ms"])
+        warm.append(second["bootstrap_ms"])
+        heavy.update(first["heavy_loaded"])
+
+    db_dir = tempfile.mkdtemp(prefix="nutri-boot-")
+    t0 = time.perf_counter()
+    procs = [spawn(db_dir) for _ in range(args.workers)]
+    results = [collect(p) for p in procs]
+    wall = (time.perf_counter() - t0) * 1000
+
+    report = {
+        "import_ms_p50": ms(imports),
+        "heavy_modules_loaded_at_import": sorted(heavy),
+        "bootstrap_cold_ms_p50": ms(cold),
+        "bootstrap_warm_ms_p50": ms(warm),
+        "concurrent": {
+            "workers": args.workers,
+            "bootstrapped_by": sum(r["bootstrapped"] for r in results),
+            "import_ms_max": round(max(r["import_ms"] for r in results), 1),
+            "bootstrap_ms_max": round(max(r["bootstrap_ms"] for r in results), 1),
+            "wall_ms": round(wall, 1),
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    if report["concurrent"]["bootstrapped_by"] != 1:
+        failures.append("el bootstrap no se ejecutó exactamente una vez")
+    if args.import_budget_ms and report["import_ms_p50"] > args.import_budget_ms:
+        failures.append(f"import {report['import_ms_p50']} ms > {args.import_budget_ms} ms")
+    if args.boot_budget_ms and report["bootstrap_warm_ms_p50"] > args.boot_budget_ms:
+        failures.append(f"arranque {report['bootstrap_warm_ms_p50']} ms > {args.boot_budget_ms} ms")
+    if failures:
+        print("❌ " + "; ".join(failures), file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        child(sys.argv[2])
+        raise SystemExit(0)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="procesos por medida")
+    parser.add_argument("--workers", type=int, default=4, help="procesos arrancando a la vez")
+    parser.add_argument("--import-budget-ms", type=float, default=0, help="presupuesto de 'import main' (p50)")
+    parser.add_argument("--boot-budget-ms", type=float, default=0, help="presupuesto del arranque en caliente (p50)")
+    run(parser.parse_args())
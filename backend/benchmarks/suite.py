@@ -0,0 +1,178 @@
+"""Suite de benchmarks del motor de inferencia y de los endpoints calientes.
+
+Para cada tamaño de base de reglas (por defecto 10, 1k, 10k y 100k, generadas
+con ``synth.py`` a partir de R1–R3) mide:
+
+- ``infer()`` con el índice de reglas y ``match_condition`` por tipo de operador
+- ``RuleIndex`` (construcción) y ``load_rules()`` desde SQLite
+- ``/infer`` y ``GET /rules`` de extremo a extremo con un cliente ASGI en proceso
+
+y una vez ``/auth/login``. Cada medida guarda p50/p95/p99/max en ms. El
+resultado se escribe como JSON; con ``--baseline`` se compara contra una
+ejecución anterior y el proceso termina con código 1 si algún p50 empeora más
+de ``--threshold``.
+
+    python benchmarks/suite.py --output bench.json
+    python benchmarks/suite.py --sizes 10,1000 --baseline bench.json --threshold 0.25
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+
+from common import client, load_app, startup, summarize
+from synth import generate_facts, generate_rules
+
+DEFAULT_SIZES = "10,1000,10000,100000"
+
+
+def sample(fn, seconds, min_n=5, max_n=100000):
+    """Ejecuta ``fn`` durante ``seconds`` (al menos ``min_n`` veces) y devuelve las duraciones"""
+    samples = []
+    deadline = time.perf_counter() + seconds
+    while len(samples) < max_n and (len(samples) < min_n or time.perf_counter() < deadline):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+async def sample_async(fn, seconds, min_n=5, max_n=100000):
+    samples = []
+    deadline = time.perf_counter() + seconds
+    while len(samples) < max_n and (len(samples) < min_n or time.perf_counter() < deadline):
+        t0 = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def replace_rules(main, rules):
+    """Sustituye la base de reglas en una sola transacción y avanza la generación"""
+    with main.get_conn() as con:
+        cur = con.cursor()
+        cur.execute("DELETE FROM rules")
+        cur.executemany(
+            "INSERT INTO rules (id,name,priority,json) VALUES (?,?,?,?)",
+            ((r["id"], r.get("name"), int(r.get("priority", 0)), json.dumps(r)) for r in rules),
+        )
+        main._bump_rules_generation(cur)
+
+
+def bench_match_condition(engine, facts, seconds):
+    conditions = {
+        "numeric": {"fact": "bmi", "op": ">=", "value": 25},
+        "in": {"fact": "activity", "op": "in", "value": ["light", "moderate"]},
+        "contains": {"fact": "conditions", "op": "contains", "value": "hipertension"},
+    }
+    results = {}
+    for kind, cond in conditions.items():
+        # Lotes de 1000 llamadas para que el reloj no domine la medida
+        batch = [facts[i % len(facts)] for i in range(1000)]
+        samples = sample(lambda: [engine.match_condition(f, cond) for f in batch], seconds)
+        results[f"match_condition.{kind}"] = summarize([s / len(batch) for s in samples])
+    return results
+
+
+async def bench_size(main, engine, size, facts, args):
+    rules = generate_rules(size, main.SEED_RULES, seed=args.seed)
+    replace_rules(main, rules)
+    results = {}
+
+    results["load_rules"] = summarize(sample(main.load_rules, args.seconds, min_n=3))
+    loaded = main.load_rules()
+    results["rule_index.build"] = summarize(sample(lambda: engine.RuleIndex(loaded), args.seconds, min_n=3))
+
+    index = engine.RuleIndex(loaded)
+    it = iter(range(10**12))
+    results["infer"] = summarize(sample(lambda: engine.infer(facts[next(it) % len(facts)], index), args.seconds))
+
+    async with client(main) as http:
+        await http.post("/infer", json=facts[0])  # recarga la cache de reglas
+        it = iter(range(10**12))
+
+        async def post_infer():
+            r = await http.post("/infer", json=facts[next(it) % len(facts)])
+            assert r.status_code == 200, r.text
+
+        async def get_rules():
+            r = await http.get("/rules")
+            assert r.status_code == 200, r.text
+
+        results["http./infer"] = summarize(await sample_async(post_infer, args.seconds))
+        results["http.GET /rules"] = summarize(await sample_async(get_rules, args.seconds, min_n=3))
+    return {f"{name}@{size}": value for name, value in results.items()}
+
+
+async def bench_login(main, args):
+    async with client(main) as http:
+        async def login():
+            r = await http.post("/auth/login", data={"username": "pro@nutri.com", "password": "nutri123"})
+            assert r.status_code == 200, r.text
+        return {"http./auth/login": summarize(await sample_async(login, args.seconds))}
+
+
+def compare(current, baseline, threshold):
+    """Claves cuyo p50 empeora más de ``threshold`` (fracción) respecto a la línea base"""
+    regressions = []
+    for name, stats in current.items():
+        base = baseline.get(name)
+        if not base or not base.get("p50_ms"):
+            continue
+        ratio = stats["p50_ms"] / base["p50_ms"]
+        if ratio > 1 + threshold:
+            regressions.append({"benchmark": name, "baseline_p50_ms": base["p50_ms"], "p50_ms": stats["p50_ms"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+async def run(args):
+    main = load_app()
+    import engine
+    await startup(main)
+    facts = generate_facts(args.population, seed=args.seed)
+
+    results = {}
+    results.update(bench_match_condition(engine, facts, args.seconds))
+    results.update(await bench_login(main, args))
+    for size in (int(s) for s in args.sizes.split(",")):
+        print(f"⏱️  {size} reglas...", file=sys.stderr)
+        results.update(await bench_size(main, engine, size, facts, args))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+            "population": args.population,
+            "seconds_per_benchmark": args.seconds,
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        report["regressions"] = compare(results, baseline, args.threshold)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if report.get("regressions"):
+        print(f"❌ {len(report['regressions'])} benchmarks empeoran más de un {args.threshold:.0%}", file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="tamaños de la base de reglas separados por comas")
+    parser.add_argument("--population", type=int, default=2000, help="pacientes sintéticos")
+    parser.add_argument("--seconds", type=float, default=1.0, help="tiempo por benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="fichero JSON de resultados")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior para comparar")
+    parser.add_argument("--threshold", type=float, default=0.2, help="empeoramiento máximo del p50 (0.2 = 20%%)")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,118 @@
+"""Generadores sintéticos de bases de reglas y de pacientes.
+
+``generate_rules`` parte de las reglas semilla (R1–R3) y añade variaciones con
+una mezcla de condiciones numéricas, ``in`` y ``contains`` hasta el tamaño
+pedido. ``generate_facts`` produce pacientes con distribuciones plausibles
+(altura por sexo, IMC sesgado hacia sobrepeso, comorbilidades con prevalencias
+realistas) que pasan la validación de ``Facts``. Ambos son deterministas para
+una misma semilla.
+"""
+import copy
+import random
+from typing import Any, Dict, List
+
+ACTIVITIES = ["sedentary", "light", "moderate", "active", "very_active"]
+ACTIVITY_WEIGHTS = [0.35, 0.25, 0.2, 0.15, 0.05]
+# Prevalencia aproximada de cada condición en la población adulta
+CONDITIONS = {
+    "hipertension": 0.30,
+    "diabetes_t2": 0.10,
+    "dislipidemia": 0.20,
+    "hipotiroidismo": 0.05,
+    "celiaquia": 0.01,
+    "enfermedad_renal": 0.04,
+    "gota": 0.03,
+    "embarazo": 0.02,
+}
+NUMERIC_FACTS = {
+    "bmi": (16.0, 42.0),
+    "age": (18, 85),
+    "weight_kg": (45.0, 140.0),
+    "height_cm": (150.0, 195.0),
+}
+RESTRICTIONS = ["sodio", "azucares_simples", "grasas_saturadas", "gluten", "purinas", "alcohol", "ultraprocesados"]
+ADVICE = ["Aumentar fibra", "Hidratación adecuada", "Repartir en 5 comidas", "Priorizar proteína magra",
+          "Controlar porciones", "Actividad física diaria", "Reducir sal de mesa"]
+
+
+def _numeric_condition(rng: random.Random) -> Dict[str, Any]:
+    fact = rng.choice(list(NUMERIC_FACTS))
+    lo, hi = NUMERIC_FACTS[fact]
+    value = round(rng.uniform(lo, hi), 1) if isinstance(lo, float) else rng.randint(lo, hi)
+    return {"fact": fact, "op": rng.choice(["<", "<=", ">", ">="]), "value": value}
+
+
+def _categorical_condition(rng: random.Random) -> Dict[str, Any]:
+    if rng.random() < 0.5:
+        return {"fact": "activity", "op": "in", "value": rng.sample(ACTIVITIES, rng.randint(1, 3))}
+    return {"fact": "sex", "op": "in", "value": [rng.choice(["M", "F"])]}
+
+
+def _contains_condition(rng: random.Random) -> Dict[str, Any]:
+    return {"fact": "conditions", "op": "contains", "value": rng.choice(list(CONDITIONS))}
+
+
+def _synthetic_rule(i: int, rng: random.Random) -> Dict[str, Any]:
+    # Primera condición variada para que el índice reparta las reglas entre
+    # umbrales numéricos y cubetas hash
+    first = rng.choices([_numeric_condition, _categorical_condition, _contains_condition], weights=[0.5, 0.2, 0.3])[0]
+    when = [first(rng)]
+    for _ in range(rng.randint(0, 2)):
+        when.append(rng.choice([_numeric_condition, _categorical_condition, _contains_condition])(rng))
+    if rng.random() < 0.6:
+        key = rng.choice(["deficit_pct", "surplus_pct"])
+        kcal_target: Any = {"method": "mifflin_st_jeor", key: round(rng.uniform(0.05, 0.25), 2)}
+    else:
+        kcal_target = rng.randrange(1400, 3200, 50)
+    carb = round(rng.uniform(0.35, 0.55), 2)
+    prot = round(rng.uniform(0.15, 0.30), 2)
+    return {
+        "id": f"S{i}",
+        "name": f"Regla sintética {i}",
+        "priority": rng.randint(0, 30),
+        "when": when,
+        "then": {
+            "diagnosis": [f"Hallazgo {i % 97}"],
+            "diet": {
+                "kcal_target": kcal_target,
+                "macro_split": {"carb_pct": carb, "prot_pct": prot, "fat_pct": round(1 - carb - prot, 2)},
+                "advice": rng.sample(ADVICE, rng.randint(0, 2)),
+                "restrictions": rng.sample(RESTRICTIONS, rng.randint(0, 2)),
+            },
+            "explain": " y ".join(f"{c['fact']} {c['op']} {c['value']}" for c in when),
+        },
+    }
+
+
+def generate_rules(n: int, seed_rules: List[Dict[str, Any]], seed: int = 0) -> List[Dict[str, Any]]:
+    """Base de ``n`` reglas: las semilla más reglas sintéticas"""
+    rng = random.Random(seed)
+    rules = copy.deepcopy(seed_rules[:n])
+    for i in range(len(rules), n):
+        rules.append(_synthetic_rule(i, rng))
+    return rules
+
+
+def generate_facts(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Población de ``n`` pacientes válidos para el modelo ``Facts``"""
+    rng = random.Random(seed)
+    population = []
+    for _ in range(n):
+        sex = rng.choice(["M", "F"])
+        height = min(max(rng.gauss(176 if sex == "M" else 163, 7), 140), 210)
+        bmi = min(max(rng.lognormvariate(3.25, 0.18), 15.0), 55.0)
+        weight = bmi * (height / 100) ** 2
+        age = rng.randint(18, 85)
+        conditions = [c for c, p in CONDITIONS.items() if rng.random() < p * (1.5 if age > 50 else 1.0)]
+        if sex == "M" and "embarazo" in conditions:
+            conditions.remove("embarazo")
+        population.append({
+            "age": age,
+            "sex": sex,
+            "height_cm": round(height, 1),
+            "weight_kg": round(weight, 1),
+            "activity": rng.choices(ACTIVITIES, weights=ACTIVITY_WEIGHTS)[0],
+            "conditions": conditions,
+            "bmi": round(bmi, 1),
+        })
+    return population
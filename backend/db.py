@@ -0,0 +1,96 @@
+"""Pool de conexiones SQLite por worker.
+
+Cada worker reutiliza un pequeño conjunto de conexiones en lugar de abrir una
+nueva en cada helper. Las conexiones usan WAL (los lectores no esperan al
+escritor), ``synchronous=NORMAL``, una cache de páginas mayor y mmap. El módulo
+``sqlite3`` cachea las sentencias preparadas por conexión (``cached_statements``),
+así que reutilizar conexiones también reutiliza los statements más usados.
+"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "64"))
+SQLITE_CACHED_STATEMENTS = 256
+
+if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise RuntimeError(f"❌ SQLITE_SYNCHRONOUS inválido: {SQLITE_SYNCHRONOUS}")
+
+
+class ConnectionPool:
+    """Pool LIFO de conexiones SQLite compartidas entre los hilos de un worker.
+
+    ``connection()`` entrega una conexión dentro de una transacción: hace commit
+    al salir sin errores y rollback si hay una excepción. El pool se reinicia
+    si detecta que el proceso se ha bifurcado (workers de gunicorn), porque una
+    conexión SQLite no debe cruzar un ``fork``.
+    """
+
+    def __init__(self, path: str, size: int = SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._pid = os.getpid()
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(
+            self.path,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+        )
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        con.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        con.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA foreign_keys=ON")
+        return con
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Las conexiones heredadas pertenecen al proceso padre: se descartan
+                    self._idle = queue.LifoQueue(maxsize=self.size)
+                    self._pid = os.getpid()
+
+    def acquire(self) -> sqlite3.Connection:
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, con: sqlite3.Connection):
+        if self._pid != os.getpid() or con.in_transaction:
+            con.close()
+            return
+        try:
+            self._idle.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        con = self.acquire()
+        try:
+            with con:
+                yield con
+        finally:
+            self.release(con)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,661 @@
+"""Motor de inferencia de NutriExpert.
+
+Contiene las utilidades de energía, la evaluación de condiciones y el índice
+de reglas usado por ``infer()``. No depende de FastAPI para poder reutilizarse
+desde scripts y procesos auxiliares.
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import heapq
+import operator
+import random
+import threading
+import time
+
+# ---------- ENERGY UTILS ----------
+# Factores de actividad para TDEE
+ACTIVITY_FACTORS = {"sedentary":1.2,"light":1.375,"moderate":1.55,"active":1.725,"very_active":1.9}
+
+def mifflin_st_jeor(sex: str, age: int, height_cm: float, weight_kg: float, activity: str) -> float:
+
+    # Calcular TMB (Tasa Metabólica Basal)
+    bmr = 10*weight_kg + 6.25*height_cm - 5*age + (5 if sex.upper()=="M" else -161)
+
+    # Multiplicar por factor de actividad = TDEE
+    return bmr * ACTIVITY_FACTORS.get(activity,1.2)
+
+# ---------- CONDICIONES ----------
+OPS = {"==": operator.eq, "!=": operator.ne, ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+KNOWN_OPS = set(OPS) | {"in", "not_in", "contains"}
+
+def match_condition(facts: Dict[str,Any], cond: Dict[str,Any]) -> bool:
+    fact, op, value = cond.get("fact"), cond.get("op"), cond.get("value")
+    try:
+        if op in OPS: return OPS[op](facts.get(fact), value)
+        if op == "in": return facts.get(fact) in value
+        if op == "not_in": return facts.get(fact) not in value
+        if op == "contains": return value in facts.get(fact, [])
+    except TypeError:
+        # Hecho ausente o de otro tipo (p. ej. un hecho derivado aún sin afirmar)
+        return False
+    return False
+
+# ---------- COMPILACIÓN DE CONDICIONES ----------
+
+class UnknownOperatorError(ValueError):
+    """La condición usa un operador que el motor no conoce (p. ej. ``=``)"""
+
+
+# Expresión de cada operador sobre ``get`` (facts.get), el hecho ``_f`` y el valor ``_c``
+_OP_SOURCE = {
+    "==": "get({f}) == {c}", "!=": "get({f}) != {c}",
+    ">": "get({f}) > {c}", ">=": "get({f}) >= {c}", "<": "get({f}) < {c}", "<=": "get({f}) <= {c}",
+    "in": "get({f}) in {c}", "not_in": "get({f}) not in {c}", "contains": "{c} in get({f}, ())",
+}
+_factories: Dict[tuple, Callable] = {}
+
+
+def _factory(ops: tuple) -> Callable:
+    """Fábrica de predicados para una secuencia de operadores.
+
+    El código generado sólo depende de los operadores; hechos y valores se
+    pasan como argumentos y quedan ligados en el closure, así que cada forma
+    distinta de ``when`` se compila con ``exec`` una única vez.
+    """
+    factory = _factories.get(ops)
+    if factory is None:
+        params = ", ".join(f"_f{i}, _c{i}" for i in range(len(ops)))
+        expr = " and ".join(_OP_SOURCE[op].format(f=f"_f{i}", c=f"_c{i}") for i, op in enumerate(ops)) or "True"
+        source = (
+            f"def factory({params}):\n"
+            f"    def when(facts):\n"
+            f"        get = facts.get\n"
+            f"        try:\n"
+            f"            return {expr}\n"
+            f"        except TypeError:\n"
+            f"            return False\n"
+            f"    return when\n"
+        )
+        namespace: Dict[str,Any] = {}
+        exec(compile(source, f"<when {' '.join(ops)}>", "exec"), namespace)
+        factory = _factories[ops] = namespace["factory"]
+    return factory
+
+
+def compile_when(when: List[Dict[str,Any]]) -> Callable[[Dict[str,Any]], bool]:
+    """Compila el ``when`` de una regla en un predicado ``when(facts) -> bool``.
+
+    Equivale a ``all(match_condition(facts, c) for c in when)`` (con el mismo
+    cortocircuito) pero sin interpretar cada condición en cada llamada. Lanza
+    ``UnknownOperatorError`` si algún operador no existe.
+    """
+    args = []
+    for cond in when:
+        args += [cond.get("fact"), cond.get("value")]
+    return _factory(check_operators(when))(*args)
+
+
+def check_operators(when: List[Dict[str,Any]]) -> tuple:
+    """Operadores del ``when``; lanza ``UnknownOperatorError`` si alguno no existe"""
+    ops = tuple(cond.get("op") for cond in when)
+    for op in ops:
+        if not isinstance(op, str) or op not in KNOWN_OPS:
+            raise UnknownOperatorError(f"Operador desconocido: {op!r}")
+    return ops
+
+
+def _never(facts: Dict[str,Any]) -> bool:
+    return False
+
+# ---------- ÍNDICE DE REGLAS ----------
+_NUMERIC_OPS = ("<", "<=", ">", ">=")
+
+def _is_number(x: Any) -> bool:
+    return isinstance(x, (int, float))
+
+def _is_hashable(x: Any) -> bool:
+    try:
+        hash(x)
+    except TypeError:
+        return False
+    return True
+
+
+class _Thresholds:
+    """Umbrales ordenados de un (hecho, operador) numérico"""
+
+    def __init__(self, op: str, entries: List[tuple]):
+        self.op = op
+        entries.sort(key=lambda e: e[0])
+        self.values = [e[0] for e in entries]
+        self.positions = [e[1] for e in entries]
+
+    def candidates(self, x: Any) -> Iterable[int]:
+        if not _is_number(x):
+            # Sin orden numérico: la verificación completa decide
+            return self.positions
+        if self.op == "<":    # x < v  -> v > x
+            return self.positions[bisect_right(self.values, x):]
+        if self.op == "<=":   # x <= v -> v >= x
+            return self.positions[bisect_left(self.values, x):]
+        if self.op == ">":    # x > v  -> v < x
+            return self.positions[:bisect_left(self.values, x)]
+        return self.positions[:bisect_right(self.values, x)]   # x >= v -> v <= x
+
+
+class RuleIndex:
+    """Índice de reglas para el emparejamiento en ``infer()``.
+
+    Cada regla se indexa por su primera condición indexable: los umbrales
+    numéricos (``<``, ``<=``, ``>``, ``>=``) van a listas ordenadas por hecho y
+    las condiciones ``==``, ``in`` y ``contains`` a cubetas hash. Las reglas sin
+    condición indexable se evalúan siempre. El índice sólo descarta reglas que
+    no pueden cumplirse; los candidatos se verifican con el predicado compilado
+    de cada regla (``predicate(pos)``), que se compila la primera vez que la
+    regla llega a evaluarse. Las reglas con operadores desconocidos o con un
+    ``then.assert`` que no es un objeto (p. ej. guardado antes de validarse)
+    no se disparan nunca y quedan en ``rejected`` con el motivo.
+    """
+
+    def __init__(self, rules: List[Dict[str,Any]]):
+        # Mismo orden que la agenda original (sort estable por prioridad)
+        self.rules = sorted(rules, key=lambda r: r.get("priority",0), reverse=True)
+        self._always: List[int] = []
+        self._eq: Dict[str, Dict[Any, List[int]]] = defaultdict(lambda: defaultdict(list))
+        self._eq_unhashable: Dict[str, List[int]] = defaultdict(list)
+        self._contains: Dict[str, Dict[Any, List[int]]] = defaultdict(lambda: defaultdict(list))
+        self._contains_all: Dict[str, List[int]] = defaultdict(list)
+        # id de regla -> posición en ``when`` de la condición usada como clave
+        self.key_conditions: Dict[Any, int] = {}
+        # hecho -> reglas cuyo ``when`` lo referencia (para reevaluar al derivarlo)
+        self.dependents: Dict[str, List[int]] = defaultdict(list)
+        self.chaining = False
+        self.predicates: List[Optional[Callable[[Dict[str,Any]], bool]]] = [None] * len(self.rules)
+        self._condition_predicates: List[Optional[List[Callable[[Dict[str,Any]], bool]]]] = [None] * len(self.rules)
+        self.rejected: Dict[Any, str] = {}
+        numeric: Dict[tuple, List[tuple]] = defaultdict(list)
+
+        for pos, rule in enumerate(self.rules):
+            when = rule.get("when", [])
+            try:
+                check_operators(when)
+            except UnknownOperatorError as e:
+                self.predicates[pos] = _never
+                self.rejected[rule.get("id")] = str(e)
+                continue
+            assertion = rule.get("then", {}).get("assert")
+            if assertion is not None and not isinstance(assertion, dict):
+                self.predicates[pos] = _never
+                self.rejected[rule.get("id")] = "then.assert debe ser un objeto {hecho: valor}"
+                continue
+            self.chaining = self.chaining or bool(asserted_facts(rule))
+            for fact in {c.get("fact") for c in when}:
+                self.dependents[fact].append(pos)
+            for i, cond in enumerate(when):
+                fact, op, value = cond.get("fact"), cond.get("op"), cond.get("value")
+                self.key_conditions[rule.get("id")] = i
+                if op in _NUMERIC_OPS and _is_number(value) and not isinstance(value, bool):
+                    numeric[(fact, op)].append((value, pos))
+                    break
+                if op == "==" and _is_hashable(value):
+                    self._eq[fact][value].append(pos)
+                    self._eq_unhashable[fact].append(pos)
+                    break
+                if op == "in" and isinstance(value, (list, tuple, set, frozenset)) and all(_is_hashable(v) for v in value):
+                    for v in value:
+                        self._eq[fact][v].append(pos)
+                    self._eq_unhashable[fact].append(pos)
+                    break
+                if op == "contains" and _is_hashable(value):
+                    self._contains[fact][value].append(pos)
+                    self._contains_all[fact].append(pos)
+                    break
+            else:
+                self.key_conditions.pop(rule.get("id"), None)
+                self._always.append(pos)
+
+        self._numeric = [(fact, _Thresholds(op, entries)) for (fact, op), entries in numeric.items()]
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def predicate(self, pos: int) -> Callable[[Dict[str,Any]], bool]:
+        """Predicado compilado de la regla en ``pos`` (se compila en el primer uso)"""
+        pred = self.predicates[pos]
+        if pred is None:
+            pred = self.predicates[pos] = compile_when(self.rules[pos].get("when", []))
+        return pred
+
+    def condition_predicates(self, pos: int) -> List[Callable[[Dict[str,Any]], bool]]:
+        """Un predicado compilado por condición de la regla en ``pos`` (para el
+        desglose del perfilado); vacío si la regla fue rechazada"""
+        preds = self._condition_predicates[pos]
+        if preds is None:
+            when = [] if self.predicate(pos) is _never else self.rules[pos].get("when", [])
+            preds = self._condition_predicates[pos] = [compile_when([cond]) for cond in when]
+        return preds
+
+    def candidates(self, facts: Dict[str,Any]) -> List[Dict[str,Any]]:
+        """Reglas que podrían dispararse con estos hechos, en orden de agenda"""
+        return [self.rules[pos] for pos in self.candidate_positions(facts)]
+
+    def candidate_positions(self, facts: Dict[str,Any]) -> List[int]:
+        selected = set(self._always)
+        for fact, thresholds in self._numeric:
+            selected.update(thresholds.candidates(facts.get(fact)))
+        for fact, buckets in self._eq.items():
+            x = facts.get(fact)
+            if _is_hashable(x):
+                selected.update(buckets.get(x, ()))
+            else:
+                selected.update(self._eq_unhashable[fact])
+        for fact, buckets in self._contains.items():
+            x = facts.get(fact, [])
+            if isinstance(x, (list, tuple, set, frozenset)):
+                for item in x:
+                    if _is_hashable(item):
+                        selected.update(buckets.get(item, ()))
+                    else:
+                        selected.update(self._contains_all[fact])
+                        break
+            else:
+                selected.update(self._contains_all[fact])
+        return sorted(selected)
+
+    def batch_candidate_positions(self, rows: List[Dict[str,Any]]) -> List[int]:
+        """Unión de ``candidate_positions`` de todas las filas de un lote.
+
+        Se calcula por hecho (extremos de cada columna numérica y valores
+        distintos de las categóricas) en lugar de fila a fila.
+        """
+        selected = set(self._always)
+        extremes: Dict[str, Optional[tuple]] = {}
+        for fact, thresholds in self._numeric:
+            if fact not in extremes:
+                values = [row.get(fact) for row in rows]
+                numbers = all(_is_number(x) and x == x for x in values)
+                extremes[fact] = (min(values), max(values)) if numbers and values else None if numbers else ()
+            bounds = extremes[fact]
+            if bounds is None:
+                continue  # lote vacío
+            if not bounds:
+                selected.update(thresholds.positions)
+                continue
+            # Los candidatos varían de forma monótona con x: basta con los extremos
+            selected.update(thresholds.candidates(bounds[0]))
+            selected.update(thresholds.candidates(bounds[1]))
+        for fact, buckets in self._eq.items():
+            try:
+                seen = {row.get(fact) for row in rows}
+            except TypeError:
+                selected.update(self._eq_unhashable[fact])
+                continue
+            for x in seen:
+                selected.update(buckets.get(x, ()))
+        for fact, buckets in self._contains.items():
+            items: set = set()
+            try:
+                for row in rows:
+                    x = row.get(fact, [])
+                    if not isinstance(x, (list, tuple, set, frozenset)):
+                        raise TypeError
+                    items.update(x)
+            except TypeError:
+                selected.update(self._contains_all[fact])
+                continue
+            for item in items:
+                selected.update(buckets.get(item, ()))
+        return sorted(selected)
+
+# ---------- INFERENCE ENGINE ----------
+
+def asserted_facts(rule: Dict[str,Any]) -> Dict[str,Any]:
+    """Hechos que la regla afirma en la memoria de trabajo (``then.assert``);
+    vacío si no es un objeto (``RuleIndex`` rechaza esas reglas)"""
+    assertion = rule.get("then", {}).get("assert")
+    return assertion if isinstance(assertion, dict) else {}
+
+
+def uses_mifflin(rule: Dict[str,Any]) -> bool:
+    """Indica si la regla calcula kcal_target con Mifflin-St Jeor"""
+    kcal_cfg = (rule.get("then", {}).get("diet") or {}).get("kcal_target")
+    return isinstance(kcal_cfg, dict) and kcal_cfg.get("method") == "mifflin_st_jeor"
+
+
+def fire_rules(facts: Dict[str,Any], matched: Iterable[Dict[str,Any]], tdee: Optional[float] = None):
+    """Aplica el ``then`` de las reglas ya emparejadas, en orden de agenda.
+
+    ``tdee`` permite pasar el gasto energético ya calculado (p. ej. vectorizado
+    por lotes); si es ``None`` se calcula con ``mifflin_st_jeor`` al necesitarlo.
+    """
+    diagnoses, plan, fired = [], {"kcal_target":None, "macro_split":None, "restrictions":[], "advice":[]}, []
+
+    for r in matched:
+        fired.append({"id": r["id"], "name": r.get("name"), "explain": r.get("then",{}).get("explain")})
+        then = r.get("then", {})
+        for d in then.get("diagnosis", []):
+            if d not in diagnoses: diagnoses.append(d)
+        diet = then.get("diet", {})
+        if diet:
+            kcal_cfg = diet.get("kcal_target")
+            if isinstance(kcal_cfg, dict) and kcal_cfg.get("method") == "mifflin_st_jeor":
+                if tdee is None:
+                    tdee = mifflin_st_jeor(facts.get("sex"), facts.get("age"), facts.get("height_cm"), facts.get("weight_kg"), facts.get("activity"))
+                plan["kcal_target"] = round(tdee * (1 - float(kcal_cfg.get("deficit_pct",0.0)) + float(kcal_cfg.get("surplus_pct",0.0))))
+            elif isinstance(kcal_cfg, (int,float)):
+                plan["kcal_target"] = int(kcal_cfg)
+            if diet.get("macro_split"): plan["macro_split"] = diet["macro_split"]
+            plan["restrictions"] += diet.get("restrictions", [])
+            plan["advice"] += diet.get("advice", [])
+
+    # Limpieza de resultados (eliminar duplicados)
+    plan["restrictions"] = sorted(list(set(plan["restrictions"])))
+    plan["advice"] = sorted(list(set(plan["advice"])))
+    # return {"diagnosis": diagnoses or (["Eutrófico (sin hallazgos)"] if 18.5 <= facts.get("bmi",0) < 25 else []), "plan": plan, "fired_rules": fired}
+    # Sin diagnóstico por defecto para IMC normal
+    return {"diagnosis": diagnoses, "plan": plan, "fired_rules": fired}
+
+
+def infer(facts: Dict[str,Any], rules, profiler: Optional["RuleProfiler"] = None):
+    """Motor de inferencia - Forward Chaining
+
+    ``rules`` puede ser la lista de reglas o un ``RuleIndex`` ya construido;
+    con el índice sólo se evalúan las reglas candidatas. Con ``profiler`` las
+    llamadas muestreadas registran tiempos por regla y condición.
+    """
+
+    if not isinstance(rules, RuleIndex) and any(asserted_facts(r) for r in rules):
+        rules = RuleIndex(rules)
+    if isinstance(rules, RuleIndex) and rules.chaining:
+        return _infer_chaining(facts, rules, profiler)
+
+    # PASO 1: Ordenar reglas por prioridad (mayor a menor)
+    if isinstance(rules, RuleIndex):
+        # PASO 2: CICLO DE INFERENCIA - sólo candidatas, con el predicado compilado
+        positions = rules.candidate_positions(facts)
+        if profiler is not None and profiler.should_sample():
+            matched = [rules.rules[pos] for pos in profiler.match(facts, rules, positions)]
+        else:
+            predicates = rules.predicates
+            matched = [rules.rules[pos] for pos in positions if (predicates[pos] or rules.predicate(pos))(facts)]
+    else:
+        agenda = sorted(rules, key=lambda r: r.get("priority",0), reverse=True)
+        # PASO 2: CICLO DE INFERENCIA - Evaluar cada regla
+        matched = [r for r in agenda if all(match_condition(facts, c) for c in r.get("when", []))]
+
+    # PASO 3: Aplicar conclusiones y retornar resultado
+    return fire_rules(facts, matched)
+
+
+_MISSING = object()
+
+
+def _infer_chaining(facts: Dict[str,Any], index: RuleIndex, profiler: Optional["RuleProfiler"] = None):
+    """Encadenamiento hacia delante con agenda para bases con ``then.assert``.
+
+    La agenda es un heap de posiciones en ``index.rules`` (ya ordenadas por
+    prioridad), así que siempre se dispara la activación de mayor prioridad.
+    Cada regla se dispara como mucho una vez (refracción), lo que garantiza
+    que el ciclo termina. Cuando una regla afirma un hecho que cambia la
+    memoria de trabajo, sólo se reevalúan las reglas que lo referencian: las
+    que ahora se cumplen entran en la agenda y las que dejan de cumplirse
+    salen de ella. Sin afirmaciones el resultado es el mismo que el de la
+    pasada única.
+    """
+    wm = dict(facts)
+    if profiler is not None and profiler.should_sample():
+        agenda = profiler.match(wm, index, index.candidate_positions(wm))
+    else:
+        agenda = [pos for pos in index.candidate_positions(wm) if index.predicate(pos)(wm)]
+    pending = set(agenda)
+    heapq.heapify(agenda)
+    fired, matched, derived = set(), [], {}
+
+    while agenda:
+        pos = heapq.heappop(agenda)
+        if pos not in pending:
+            continue  # activación retirada por un hecho derivado
+        pending.discard(pos)
+        fired.add(pos)
+        rule = index.rules[pos]
+        matched.append(rule)
+
+        changed = set()
+        for fact, value in asserted_facts(rule).items():
+            if wm.get(fact, _MISSING) != value:
+                wm[fact] = derived[fact] = value
+                changed.add(fact)
+        affected = set()
+        for fact in changed:
+            affected.update(index.dependents.get(fact, ()))
+        for dep in affected - fired:
+            if index.predicate(dep)(wm):
+                if dep not in pending:
+                    pending.add(dep)
+                    heapq.heappush(agenda, dep)
+            else:
+                pending.discard(dep)
+
+    result = fire_rules(wm, matched)
+    if derived:
+        result["derived_facts"] = derived
+    return result
+
+
+def find_assert_cycles(rules: List[Dict[str,Any]]) -> List[List[Any]]:
+    """Ciclos de encadenamiento entre reglas (ids), p. ej. ``[R5, R7]``.
+
+    Hay una arista A -> B si A afirma un hecho que B usa en su ``when`` y B
+    también afirma hechos; sólo esas reglas pueden formar un ciclo. Se
+    devuelven las componentes fuertemente conexas con más de una regla (una
+    regla que lee el hecho que ella misma afirma no cuenta: la refracción
+    impide que se vuelva a disparar).
+    """
+    asserting = [r for r in rules if asserted_facts(r)]
+    readers: Dict[str, List[int]] = defaultdict(list)
+    for i, r in enumerate(asserting):
+        for fact in {c.get("fact") for c in r.get("when", [])}:
+            readers[fact].append(i)
+    edges = [sorted({j for fact in asserted_facts(r) for j in readers.get(fact, ()) if j != i})
+             for i, r in enumerate(asserting)]
+
+    # Tarjan iterativo
+    counter, order, low, on_stack, stack, cycles = 0, {}, {}, set(), [], []
+    for root in range(len(asserting)):
+        if root in order:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, child = work.pop()
+            if child == 0:
+                order[node] = low[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack.add(node)
+            if child < len(edges[node]):
+                work.append((node, child + 1))
+                nxt = edges[node][child]
+                if nxt not in order:
+                    work.append((nxt, 0))
+                elif nxt in on_stack:
+                    low[node] = min(low[node], order[nxt])
+                continue
+            if low[node] == order[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1:
+                    cycles.append([asserting[m].get("id") for m in sorted(component)])
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+    return cycles
+
+# ---------- PERFILADO DE REGLAS ----------
+
+class _RuleStats:
+    __slots__ = ("name", "when", "since", "evaluations", "matches", "first_rejections", "time_ns",
+                 "cond_evals", "cond_passed", "cond_time_ns")
+
+    def __init__(self, rule: Dict[str,Any], since: int):
+        self.name = rule.get("name")
+        self.when = rule.get("when", [])
+        self.since = since
+        self.evaluations = self.matches = self.first_rejections = self.time_ns = 0
+        self.cond_evals = [0] * len(self.when)
+        self.cond_passed = [0] * len(self.when)
+        self.cond_time_ns = [0] * len(self.when)
+
+
+class RuleProfiler:
+    """Perfilado por regla y por condición del emparejamiento de ``infer()``.
+
+    Registra, para las reglas que llegan a evaluarse (las candidatas del
+    índice), cuántas veces se evalúan, cuántas se disparan, el tiempo acumulado
+    y cuántas descarta ya la primera condición del ``when``. Con
+    ``sample_rate`` < 1 sólo se perfila esa fracción de las llamadas. Las
+    medidas de una llamada se vuelcan bajo el lock una sola vez. Los datos son
+    del proceso actual; si una regla cambia de condiciones sus contadores se
+    reinician.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, enabled: bool = True):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.calls = 0
+        self._stats: Dict[Any, _RuleStats] = {}
+        self._lock = threading.Lock()
+
+    def should_sample(self) -> bool:
+        return self.enabled and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self._stats.clear()
+
+    def match(self, facts: Dict[str,Any], index: RuleIndex, positions: List[int]) -> List[int]:
+        """Igual que el emparejamiento de ``infer()``: posiciones de ``positions``
+        cuyo predicado compilado se cumple.
+
+        El tiempo de la regla es el de su predicado compilado, el mismo que se
+        usa sin perfilado. El desglose por condición evalúa después cada
+        condición con su propio predicado compilado (con cortocircuito) y sólo
+        sirve para repartir el coste y medir la selectividad.
+        """
+        clock = time.perf_counter_ns
+        matched, records = [], []
+        for pos in positions:
+            predicate = index.predicate(pos)
+            t0 = clock()
+            ok = predicate(facts)
+            elapsed = clock() - t0
+            times = []
+            for cond in index.condition_predicates(pos):
+                t0 = clock()
+                passed = cond(facts)
+                times.append(clock() - t0)
+                if not passed:
+                    break
+            records.append((index.rules[pos], elapsed, times, ok))
+            if ok:
+                matched.append(pos)
+
+        with self._lock:
+            self.calls += 1
+            for rule, elapsed, times, ok in records:
+                when = rule.get("when", [])
+                st = self._stats.get(rule.get("id"))
+                if st is None or (st.when is not when and st.when != when):
+                    st = self._stats[rule.get("id")] = _RuleStats(rule, self.calls - 1)
+                st.when, st.name = when, rule.get("name")
+                st.evaluations += 1
+                st.matches += ok
+                st.first_rejections += (not ok and len(times) == 1)
+                st.time_ns += elapsed
+                for i, dt in enumerate(times):
+                    st.cond_evals[i] += 1
+                    st.cond_time_ns[i] += dt
+                    st.cond_passed[i] += ok or i < len(times) - 1
+        return matched
+
+    def report(self, key_conditions: Optional[Dict[Any,int]] = None, limit: int = 50, min_samples: int = 30) -> Dict[str,Any]:
+        """Reglas ordenadas por tiempo acumulado, con sugerencias de reordenación"""
+        key_conditions = key_conditions or {}
+        with self._lock:
+            calls = self.calls
+            items = sorted(self._stats.items(), key=lambda kv: kv[1].time_ns, reverse=True)[:limit]
+            rules = [_rule_report(rule_id, st, calls, key_conditions.get(rule_id), min_samples) for rule_id, st in items]
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "profiled_calls": calls, "rules": rules}
+
+
+def _ratio(num: float, den: float) -> Optional[float]:
+    return round(num / den, 4) if den else None
+
+
+def _rule_report(rule_id: Any, st: _RuleStats, calls: int, key_pos: Optional[int], min_samples: int) -> Dict[str,Any]:
+    conditions = []
+    for i, cond in enumerate(st.when):
+        conditions.append({
+            "position": i,
+            "fact": cond.get("fact"), "op": cond.get("op"), "value": cond.get("value"),
+            "indexed": i == key_pos,
+            "evaluations": st.cond_evals[i],
+            "pass_rate": _ratio(st.cond_passed[i], st.cond_evals[i]),
+            "avg_us": round(st.cond_time_ns[i] / st.cond_evals[i] / 1000, 3) if st.cond_evals[i] else None,
+        })
+    report = {
+        "id": rule_id,
+        "name": st.name,
+        "evaluations": st.evaluations,
+        "matches": st.matches,
+        "match_rate": _ratio(st.matches, st.evaluations),
+        # Llamadas en las que el índice ni siquiera propuso la regla
+        "index_skip_rate": _ratio(calls - st.since - st.evaluations, calls - st.since),
+        "first_condition_reject_rate": _ratio(st.first_rejections, st.evaluations),
+        "total_ms": round(st.time_ns / 1e6, 3),
+        "avg_us": round(st.time_ns / st.evaluations / 1000, 3) if st.evaluations else None,
+        "conditions": conditions,
+    }
+    suggestion = _suggest_order(st, key_pos, min_samples)
+    if suggestion:
+        report["suggested_order"], report["estimated_saving_pct"] = suggestion
+    return report
+
+
+def _expected_cost(order: List[int], cost: List[float], pass_rate: List[float]) -> float:
+    """Coste esperado de evaluar las condiciones en ``order`` con cortocircuito"""
+    total, reach = 0.0, 1.0
+    for i in order:
+        total += reach * cost[i]
+        reach *= pass_rate[i]
+    return total
+
+
+def _suggest_order(st: _RuleStats, key_pos: Optional[int], min_samples: int, min_saving: float = 0.1):
+    """Orden de condiciones que minimiza el coste esperado según la selectividad medida.
+
+    Se ordena por ``coste / (1 - tasa de paso)`` ascendente, el orden óptimo
+    para una conjunción de condiciones independientes. La condición clave del
+    índice se mantiene delante para que el índice siga usándola. Las tasas de
+    las condiciones posteriores están medidas sólo sobre las filas que pasaron
+    las anteriores, así que la sugerencia es orientativa.
+    """
+    n = len(st.when)
+    if n < 2 or any(e < min_samples for e in st.cond_evals):
+        return None
+    cost = [st.cond_time_ns[i] / st.cond_evals[i] for i in range(n)]
+    pass_rate = [st.cond_passed[i] / st.cond_evals[i] for i in range(n)]
+    rest = [i for i in range(n) if i != key_pos]
+    rest.sort(key=lambda i: cost[i] / (1 - pass_rate[i]) if pass_rate[i] < 1 else float("inf"))
+    order = ([key_pos] if key_pos is not None else []) + rest
+    current = _expected_cost(list(range(n)), cost, pass_rate)
+    proposed = _expected_cost(order, cost, pass_rate)
+    if order == list(range(n)) or not current or (current - proposed) / current < min_saving:
+        return None
+    return order, round((current - proposed) / current * 100, 1)
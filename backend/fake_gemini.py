@@ -0,0 +1,128 @@
+"""Modelo Gemini falso para desarrollo, benchmarks y pruebas de carga.
+
+Implementa la parte de ``genai.GenerativeModel`` que usa el backend
+(``generate_content`` con y sin ``stream=True``) y devuelve un análisis fijo
+por trozos con retardos configurables, sin red ni API key. Se activa con
+``GEMINI_BACKEND=fake``. Con ``failures`` (``FAKE_GEMINI_FAILURES``) las
+primeras llamadas fallan como un 503 de la API, para probar los reintentos.
+"""
+import os
+import threading
+import time
+from typing import Iterator, List, Optional
+
+FAKE_ANALYSIS = (
+    "**Alimentos identificados:** arroz blanco (~150 g), pechuga de pollo a la plancha (~120 g), "
+    "ensalada de lechuga y tomate (~80 g).\n\n"
+    "**Estimación nutricional:** 520 kcal aproximadamente; proteínas 38 g, carbohidratos 62 g, "
+    "grasas 11 g, fibra 4 g.\n\n"
+    "**Valoración:** plato equilibrado con buena fuente de proteína magra. El arroz blanco aporta "
+    "la mayor parte de la energía.\n\n"
+    "**Recomendaciones:** sustituir parte del arroz por integral o legumbres para aumentar la fibra "
+    "y añadir una fuente de grasa saludable como aceite de oliva o aguacate."
+)
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeUnavailableError(Exception):
+    """Error transitorio del modelo, como el 503 de la API cuando está saturada"""
+
+
+class FakeCancelledError(Exception):
+    """Lo que lanza la llamada gRPC al iterarla después de ``cancel()``"""
+
+
+class FakeCall:
+    """Trozos con retardo y la forma de la llamada gRPC en streaming (iterador con ``cancel()``)"""
+
+    def __init__(self, chunks: List[str], first_chunk_delay: float, chunk_delay: float):
+        self._chunks = chunks
+        self._first_chunk_delay = first_chunk_delay
+        self._chunk_delay = chunk_delay
+        self._cancelled = threading.Event()
+        self.sent = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> bool:
+        self._cancelled.set()
+        return True
+
+    def __iter__(self) -> "FakeCall":
+        return self
+
+    def __next__(self) -> FakeResponse:
+        if self.sent >= len(self._chunks) and not self.cancelled:
+            raise StopIteration
+        if self._cancelled.wait(self._first_chunk_delay if self.sent == 0 else self._chunk_delay):
+            raise FakeCancelledError("Locally cancelled by application!")
+        self.sent += 1
+        return FakeResponse(self._chunks[self.sent - 1])
+
+
+class FakeStreamResponse:
+    """Respuesta en streaming con la forma de ``GenerateContentResponse`` (google-generativeai 0.8).
+
+    Como la del SDK, no tiene ``cancel()`` ni ``close()``: la llamada en curso
+    está en ``_iterator`` y sólo se corta cancelando ésta desde otro hilo.
+    """
+
+    def __init__(self, chunks: List[str], first_chunk_delay: float, chunk_delay: float):
+        self._iterator = FakeCall(chunks, first_chunk_delay, chunk_delay)
+
+    @property
+    def closed(self) -> bool:
+        return self._iterator.cancelled
+
+    @property
+    def chunks_sent(self) -> int:
+        return self._iterator.sent
+
+    def __iter__(self) -> Iterator[FakeResponse]:
+        # Como en el SDK, el error de la llamada (p. ej. cancelada) se propaga al iterar
+        yield from self._iterator
+
+
+class FakeGenerativeModel:
+    """Sustituto local de ``genai.GenerativeModel``"""
+
+    def __init__(self, text: str = FAKE_ANALYSIS, chunks: int = 8, first_chunk_delay: float = 0.25, chunk_delay: float = 0.25,
+                 failures: int = 0):
+        self.text = text
+        self.chunks = max(1, chunks)
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.failures = failures
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+        self.last_stream: Optional[FakeStreamResponse] = None
+
+    @classmethod
+    def from_env(cls) -> "FakeGenerativeModel":
+        """``FAKE_GEMINI_LATENCY_SECONDS`` es la latencia total, repartida entre ``FAKE_GEMINI_CHUNKS`` trozos"""
+        latency = float(os.getenv("FAKE_GEMINI_LATENCY_SECONDS", "2.0"))
+        chunks = int(os.getenv("FAKE_GEMINI_CHUNKS", "8"))
+        failures = int(os.getenv("FAKE_GEMINI_FAILURES", "0"))
+        return cls(chunks=chunks, first_chunk_delay=latency / chunks, chunk_delay=latency / chunks, failures=failures)
+
+    def _split(self) -> List[str]:
+        size = -(-len(self.text) // self.chunks)
+        return [self.text[i:i + size] for i in range(0, len(self.text), size)]
+
+    def generate_content(self, contents, stream: bool = False):
+        with self._calls_lock:
+            self.calls += 1
+            call = self.calls
+        if call <= self.failures:
+            raise FakeUnavailableError("503 The model is overloaded. Please try again later.")
+        if stream:
+            self.last_stream = FakeStreamResponse(self._split(), self.first_chunk_delay, self.chunk_delay)
+            return self.last_stream
+        time.sleep(self.first_chunk_delay + self.chunk_delay * (self.chunks - 1))
+        return FakeResponse(self.text)
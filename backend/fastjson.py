@@ -0,0 +1,38 @@
+"""Serialización JSON rápida para las respuestas calientes.
+
+Usa ``orjson`` si está instalado (varias veces más rápido que ``json`` y
+devuelve ``bytes`` directamente) y, si no, ``json`` de la librería estándar
+con separadores compactos. ``orjson`` no acepta claves no textuales ni enteros
+de más de 64 bits; en ese caso se recurre también a ``json``.
+"""
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # orjson.JSONEncodeError
+            pass
+    return _stdlib_dumps(obj)
+
+
+class FastJSONResponse(JSONResponse):
+    """``JSONResponse`` que serializa con ``dumps``; ``content`` puede ser ya ``bytes``"""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
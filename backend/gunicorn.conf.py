@@ -0,0 +1,12 @@
+"""Configuración de gunicorn del despliegue.
+
+La usan el ``Procfile``, ``render.yaml`` y ``benchmarks/loadtest.py`` (que sólo
+cambia el número de workers y la dirección), para que el número de workers y
+el tipo de worker estén en un único sitio. ``WEB_CONCURRENCY`` ajusta los
+workers sin tocar el comando de arranque.
+"""
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
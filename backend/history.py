@@ -0,0 +1,326 @@
+"""Historial de inferencias con escritura diferida y agregados precalculados.
+
+``/infer`` sólo añade el resultado a un buffer en memoria (``record()``, O(1),
+sin tocar SQLite). Un hilo por worker vacía el buffer cada
+``flush_interval`` segundos, o antes si llega a ``batch_size``, en una única
+transacción que inserta las filas en ``inference_history`` y suma sus
+contribuciones a las tablas de agregados diarios:
+
+- ``history_daily``: inferencias, suma de IMC y de kcal objetivo por día
+- ``history_diagnosis_daily``: diagnósticos por día
+- ``history_bmi_daily``: histograma de IMC por día (cubetas de 1 punto)
+
+Los agregados se actualizan con ``INSERT ... ON CONFLICT DO UPDATE`` sumando,
+así que varios workers escriben en ellos sin coordinarse, y los endpoints de
+estadísticas leen esas tablas sin recorrer el historial. Si el worker muere se
+pierde como mucho lo que había en el buffer; si el buffer se llena
+(``max_pending``) las inferencias nuevas se descartan y se cuentan.
+
+Cada fila guarda también los hechos completos (``facts``), que
+``population()`` devuelve como población para simular borradores de reglas.
+Las filas de ``inference_history`` se borran al superar ``retention_seconds``
+(el mismo hilo purga cada ``purge_interval`` segundos, por tandas); los
+agregados diarios no se purgan y siguen sirviendo las estadísticas.
+"""
+import json
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from db import ConnectionPool
+
+logger = logging.getLogger("nutriexpert.history")
+
+BMI_BUCKET_WIDTH = 1
+PURGE_BATCH_SIZE = 5000
+
+
+def _day(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+class HistoryWriter:
+    """Buffer de escritura diferida del historial y consultas sobre los agregados"""
+
+    def __init__(self, path: str, flush_interval: float = 1.0, batch_size: int = 500, max_pending: int = 50000,
+                 retention_seconds: float = 0.0, purge_interval: float = 3600.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self.purge_interval = purge_interval
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.purged = 0
+        self._last_purge = 0.0
+        self._buffer: List[tuple] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pool = ConnectionPool(path)
+
+    def _conn(self):
+        return self._pool.connection()
+
+    def init(self):
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS inference_history (
+                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  ts REAL NOT NULL,
+                  age INTEGER,
+                  sex TEXT,
+                  bmi REAL,
+                  activity TEXT,
+                  conditions TEXT NOT NULL,
+                  diagnosis TEXT NOT NULL,
+                  kcal_target REAL,
+                  fired_rules TEXT NOT NULL,
+                  facts TEXT
+                )
+                """
+            )
+            columns = {row[1] for row in cur.execute("PRAGMA table_info(inference_history)")}
+            if "facts" not in columns:  # historiales creados antes de guardar los hechos completos
+                cur.execute("ALTER TABLE inference_history ADD COLUMN facts TEXT")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_inference_history_ts ON inference_history (ts)")
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history_daily (
+                  day TEXT PRIMARY KEY,
+                  inferences INTEGER NOT NULL,
+                  bmi_sum REAL NOT NULL,
+                  kcal_count INTEGER NOT NULL,
+                  kcal_sum REAL NOT NULL
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history_diagnosis_daily (
+                  day TEXT NOT NULL,
+                  diagnosis TEXT NOT NULL,
+                  count INTEGER NOT NULL,
+                  PRIMARY KEY (day, diagnosis)
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history_bmi_daily (
+                  day TEXT NOT NULL,
+                  bucket INTEGER NOT NULL,
+                  count INTEGER NOT NULL,
+                  PRIMARY KEY (day, bucket)
+                )
+                """
+            )
+            con.commit()
+
+    # ---------- ESCRITURA ----------
+
+    def record(self, facts: Dict[str, Any], result: Dict[str, Any]) -> bool:
+        """Encola una inferencia; devuelve ``False`` si se descartó por buffer lleno"""
+        with self._lock:
+            if len(self._buffer) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._buffer.append((time.time(), facts, result))
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wake.set()
+        return True
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """Escribe lo acumulado en una transacción; devuelve cuántas filas escribió"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("❌ Error escribiendo el historial de inferencias")
+                with self._lock:
+                    room = max(0, self.max_pending - len(self._buffer))
+                    self._buffer[:0] = batch[:room]
+                    self.dropped += len(batch) - room
+                return 0
+            self.written += len(batch)
+            self.flushes += 1
+            return len(batch)
+
+    def _write(self, batch: List[tuple]):
+        rows = []
+        daily: Dict[str, List[float]] = {}
+        diagnoses: Counter = Counter()
+        buckets: Counter = Counter()
+        for ts, facts, result in batch:
+            day = _day(ts)
+            bmi = facts.get("bmi")
+            kcal = result.get("plan", {}).get("kcal_target")
+            rows.append((
+                ts, facts.get("age"), facts.get("sex"), bmi, facts.get("activity"),
+                json.dumps(facts.get("conditions", []), ensure_ascii=False),
+                json.dumps(result.get("diagnosis", []), ensure_ascii=False),
+                kcal,
+                json.dumps([r["id"] for r in result.get("fired_rules", [])], ensure_ascii=False),
+                json.dumps(facts, ensure_ascii=False),
+            ))
+            totals = daily.setdefault(day, [0, 0.0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += bmi or 0.0
+            if kcal is not None:
+                totals[2] += 1
+                totals[3] += kcal
+            for d in result.get("diagnosis", []):
+                diagnoses[(day, d)] += 1
+            if bmi is not None:
+                buckets[(day, math.floor(bmi / BMI_BUCKET_WIDTH) * BMI_BUCKET_WIDTH)] += 1
+
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.executemany(
+                "INSERT INTO inference_history (ts,age,sex,bmi,activity,conditions,diagnosis,kcal_target,fired_rules,facts) "
+                "VALUES (?,?,?,?,?,?,?,?,?,?)",
+                rows,
+            )
+            cur.executemany(
+                "INSERT INTO history_daily (day,inferences,bmi_sum,kcal_count,kcal_sum) VALUES (?,?,?,?,?) "
+                "ON CONFLICT(day) DO UPDATE SET inferences=inferences+excluded.inferences, "
+                "bmi_sum=bmi_sum+excluded.bmi_sum, kcal_count=kcal_count+excluded.kcal_count, "
+                "kcal_sum=kcal_sum+excluded.kcal_sum",
+                ((day, *totals) for day, totals in daily.items()),
+            )
+            cur.executemany(
+                "INSERT INTO history_diagnosis_daily (day,diagnosis,count) VALUES (?,?,?) "
+                "ON CONFLICT(day,diagnosis) DO UPDATE SET count=count+excluded.count",
+                ((day, d, n) for (day, d), n in diagnoses.items()),
+            )
+            cur.executemany(
+                "INSERT INTO history_bmi_daily (day,bucket,count) VALUES (?,?,?) "
+                "ON CONFLICT(day,bucket) DO UPDATE SET count=count+excluded.count",
+                ((day, b, n) for (day, b), n in buckets.items()),
+            )
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Detiene el hilo y escribe lo que quede en el buffer"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            if self.retention_seconds > 0 and time.time() - self._last_purge >= self.purge_interval:
+                self._last_purge = time.time()
+                try:
+                    self.purge()
+                except Exception:
+                    logger.exception("❌ Error purgando el historial de inferencias")
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Borra las filas más antiguas que ``retention_seconds``; devuelve cuántas.
+
+        Se borra por tandas de ``PURGE_BATCH_SIZE`` filas, cada una en su
+        transacción, para no bloquear a los demás workers que escriben.
+        """
+        if self.retention_seconds <= 0:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.retention_seconds
+        deleted = 0
+        while True:
+            with self._conn() as con:
+                cur = con.execute(
+                    "DELETE FROM inference_history WHERE id IN "
+                    "(SELECT id FROM inference_history WHERE ts<? ORDER BY ts LIMIT ?)",
+                    (cutoff, PURGE_BATCH_SIZE),
+                )
+                con.commit()
+            deleted += cur.rowcount
+            if cur.rowcount < PURGE_BATCH_SIZE:
+                break
+        self.purged += deleted
+        if deleted:
+            logger.info("🧹 Historial purgado: %d inferencias anteriores a %s", deleted, _day(cutoff))
+        return deleted
+
+    # ---------- CONSULTAS (sólo tablas de agregados) ----------
+
+    def daily(self, since: str) -> List[Dict[str, Any]]:
+        with self._conn() as con:
+            rows = con.execute(
+                "SELECT day, inferences, bmi_sum, kcal_count, kcal_sum FROM history_daily WHERE day>=? ORDER BY day",
+                (since,),
+            ).fetchall()
+        return [
+            {
+                "day": day,
+                "inferences": n,
+                "avg_bmi": round(bmi_sum / n, 2) if n else None,
+                "avg_kcal_target": round(kcal_sum / kcal_n) if kcal_n else None,
+                "with_kcal_target": kcal_n,
+            }
+            for day, n, bmi_sum, kcal_n, kcal_sum in rows
+        ]
+
+    def diagnoses(self, since: str) -> List[Dict[str, Any]]:
+        with self._conn() as con:
+            rows = con.execute(
+                "SELECT day, diagnosis, count FROM history_diagnosis_daily WHERE day>=? ORDER BY day, count DESC, diagnosis",
+                (since,),
+            ).fetchall()
+        return [{"day": day, "diagnosis": d, "count": n} for day, d, n in rows]
+
+    def bmi_histogram(self, since: str, width: int = 1) -> List[Dict[str, Any]]:
+        with self._conn() as con:
+            rows = con.execute(
+                "SELECT (bucket/?)*?, SUM(count) FROM history_bmi_daily WHERE day>=? GROUP BY 1 ORDER BY 1",
+                (width, width, since),
+            ).fetchall()
+        return [{"bmi_from": b, "bmi_to": b + width, "count": n} for b, n in rows]
+
+    def population(self, since: float, limit: int) -> List[Dict[str, Any]]:
+        """Hechos distintos inferidos desde ``since`` (los más recientes primero), para simulaciones"""
+        with self._conn() as con:
+            rows = con.execute(
+                "SELECT facts FROM inference_history WHERE ts>=? AND facts IS NOT NULL "
+                "GROUP BY facts ORDER BY MAX(id) DESC LIMIT ?",
+                (since, limit),
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "purged": self.purged,
+            "max_pending": self.max_pending,
+        }
@@ -0,0 +1,264 @@
+"""Preprocesado de fotos de comida y cache de resultados de análisis.
+
+Las fotos de móvil llegan a resolución completa y con metadatos EXIF. Antes de
+la llamada a Gemini se reducen a un lado máximo acotado, se corrige la
+orientación, se descarta el EXIF y se recodifican como JPEG. La imagen ya
+normalizada es la que se usa como clave de la cache de análisis.
+
+Pillow se importa en la primera imagen, no al cargar el worker.
+"""
+import hashlib
+import os
+import threading
+import time
+from io import BytesIO
+from typing import BinaryIO, Optional, Tuple, Union
+
+from db import ConnectionPool
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+
+class InvalidImageError(ValueError):
+    """El archivo recibido no es una imagen que Pillow pueda abrir"""
+
+
+def normalize_image(source: Union[bytes, BinaryIO], max_side: int = IMAGE_MAX_SIDE) -> bytes:
+    """Reduce, elimina EXIF y recodifica la imagen como JPEG.
+
+    ``source`` puede ser el contenido en bytes o un archivo abierto (p. ej. el
+    archivo temporal de un ``UploadFile``), que se lee sin cargarlo entero.
+    """
+    from PIL import Image, ImageOps
+    fp = BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    try:
+        img = Image.open(fp)
+        # En JPEG, draft() decodifica directamente a una escala reducida
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise InvalidImageError(f"Imagen no válida: {e}")
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    out = BytesIO()
+    # Sin exif=... Pillow no copia los metadatos al nuevo JPEG
+    img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+# ---------- CACHE DE ANÁLISIS ----------
+
+def dhash(image_data: bytes) -> int:
+    """Hash perceptual (dHash de 64 bits) para detectar casi-duplicados"""
+    return image_signature(image_data)[0]
+
+
+def _dhash_of(img) -> int:
+    from PIL import Image
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    px = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (px[row*9 + col] > px[row*9 + col + 1])
+    return value
+
+
+def image_signature(image_data: bytes) -> Tuple[int, bytes, int, int]:
+    """dHash, color medio de cada cuadrante (12 bytes RGB), ancho y alto"""
+    from PIL import Image
+    with Image.open(BytesIO(image_data)) as img:
+        color = img.convert("RGB").resize((2, 2), Image.BOX).tobytes()
+        return _dhash_of(img), color, img.width, img.height
+
+
+# Un dHash con muy pocos (o muchísimos) bits a 1 sale de imágenes casi
+# uniformes o degradados: muchas fotos distintas comparten ese hash o uno muy
+# cercano, así que para ellas sólo vale la coincidencia exacta.
+_MIN_HASH_BITS = 8
+# Segunda comprobación de un casi-duplicado: color medio por cuadrante y proporción
+_MAX_COLOR_DIFF = 24
+_MAX_ASPECT_DIFF = 0.05
+
+
+def _low_entropy(phash: int) -> bool:
+    ones = bin(phash).count("1")
+    return min(ones, 64 - ones) < _MIN_HASH_BITS
+
+
+def _similar(color: bytes, width: int, height: int, cand_color: Optional[bytes], cand_width: Optional[int],
+             cand_height: Optional[int]) -> bool:
+    if not cand_color or not cand_width or not cand_height or len(cand_color) != len(color):
+        return False  # entradas anteriores a guardar la firma: sólo coincidencia exacta
+    if max(abs(a - b) for a, b in zip(color, cand_color)) > _MAX_COLOR_DIFF:
+        return False
+    aspect, cand_aspect = width / height, cand_width / cand_height
+    return abs(aspect - cand_aspect) <= _MAX_ASPECT_DIFF * max(aspect, cand_aspect)
+
+
+_BANDS = 8
+
+def _bands(phash: int):
+    """Bandas de 8 bits del dHash, indexadas para buscar casi-duplicados"""
+    return [(phash >> (8*b)) & 0xFF for b in range(_BANDS)]
+
+
+def _signed64(value: int) -> int:
+    """SQLite sólo guarda enteros con signo de 64 bits"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class ImageAnalysisCache:
+    """Cache de resultados de análisis direccionada por contenido.
+
+    La clave exacta es el SHA-256 de la imagen normalizada más el prompt. Si no
+    hay coincidencia exacta se busca un casi-duplicado con el mismo prompt cuyo
+    dHash esté a distancia de Hamming <= ``max_distance``: el hash se parte en
+    ocho bandas de 8 bits indexadas, y por el principio del palomar cualquier
+    hash a distancia <= 7 comparte al menos una banda con el buscado. El
+    candidato además debe tener un color medio por cuadrante y una proporción
+    parecidos, y los hashes de poca entropía (imágenes casi uniformes, cuyo
+    dHash es 0 o casi) sólo admiten la coincidencia exacta. Las entradas
+    caducan tras ``ttl_seconds`` y se expulsan por LRU cuando el tamaño total
+    supera ``max_bytes``.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int, max_distance: int = 4):
+        if not 0 <= max_distance < _BANDS:
+            raise ValueError(f"max_distance debe estar entre 0 y {_BANDS - 1}")
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pool = ConnectionPool(path)
+
+    def _conn(self):
+        return self._pool.connection()
+
+    def init(self):
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS image_cache (
+                  key TEXT PRIMARY KEY,
+                  prompt_hash TEXT NOT NULL,
+                  phash INTEGER NOT NULL,
+                  band0 INTEGER NOT NULL,
+                  band1 INTEGER NOT NULL,
+                  band2 INTEGER NOT NULL,
+                  band3 INTEGER NOT NULL,
+                  band4 INTEGER NOT NULL,
+                  band5 INTEGER NOT NULL,
+                  band6 INTEGER NOT NULL,
+                  band7 INTEGER NOT NULL,
+                  result TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  created_at REAL NOT NULL,
+                  last_access REAL NOT NULL,
+                  color BLOB,
+                  width INTEGER,
+                  height INTEGER
+                )
+                """
+            )
+            columns = {row[1] for row in cur.execute("PRAGMA table_info(image_cache)")}
+            for column, kind in (("color", "BLOB"), ("width", "INTEGER"), ("height", "INTEGER")):
+                if column not in columns:  # caches creadas antes de guardar la firma de color
+                    cur.execute(f"ALTER TABLE image_cache ADD COLUMN {column} {kind}")
+            for band in range(_BANDS):
+                cur.execute(f"CREATE INDEX IF NOT EXISTS idx_image_cache_band{band} ON image_cache (prompt_hash, band{band})")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_access ON image_cache (last_access)")
+            con.commit()
+
+    @staticmethod
+    def _keys(image_data: bytes, prompt: str):
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        key = hashlib.sha256(image_data + b"\0" + prompt_hash.encode()).hexdigest()
+        return key, prompt_hash, image_signature(image_data)
+
+    def get(self, image_data: bytes, prompt: str) -> Optional[str]:
+        """Resultado cacheado para la imagen y el prompt, o ``None``"""
+        key, prompt_hash, (phash, color, width, height) = self._keys(image_data, prompt)
+        now = time.time()
+        min_created = now - self.ttl_seconds
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.execute("SELECT key, result FROM image_cache WHERE key=? AND created_at>=?", (key, min_created))
+            row = cur.fetchone()
+            near = False
+            if row is None and not _low_entropy(phash):
+                bands_sql = " OR ".join(f"band{b}=?" for b in range(_BANDS))
+                cur.execute(
+                    "SELECT key, result, phash, color, width, height FROM image_cache WHERE prompt_hash=? "
+                    f"AND created_at>=? AND ({bands_sql})",
+                    (prompt_hash, min_created, *_bands(phash)),
+                )
+                best = None
+                for cand_key, result, cand_phash, cand_color, cand_width, cand_height in cur.fetchall():
+                    distance = bin((cand_phash & 0xFFFFFFFFFFFFFFFF) ^ phash).count("1")
+                    if (distance <= self.max_distance and (best is None or distance < best[0])
+                            and _similar(color, width, height, cand_color, cand_width, cand_height)):
+                        best = (distance, cand_key, result)
+                if best is not None:
+                    row, near = best[1:], True
+            if row is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+            cur.execute("UPDATE image_cache SET last_access=? WHERE key=?", (now, row[0]))
+            con.commit()
+        with self._lock:
+            self.hits += 1
+            if near:
+                self.near_hits += 1
+        return row[1]
+
+    def put(self, image_data: bytes, prompt: str, result: str):
+        key, prompt_hash, (phash, color, width, height) = self._keys(image_data, prompt)
+        size = len(result.encode("utf-8")) + len(key) + len(prompt_hash)
+        now = time.time()
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.execute(
+                "INSERT OR REPLACE INTO image_cache (key,prompt_hash,phash,"
+                + ",".join(f"band{b}" for b in range(_BANDS))
+                + ",result,size,created_at,last_access,color,width,height) VALUES ("
+                + ",".join("?" * (_BANDS + 10)) + ")",
+                (key, prompt_hash, _signed64(phash), *_bands(phash), result, size, now, now, color, width, height),
+            )
+            # Caducados primero, después LRU hasta volver al tamaño máximo
+            cur.execute("DELETE FROM image_cache WHERE created_at<?", (now - self.ttl_seconds,))
+            cur.execute("SELECT COALESCE(SUM(size),0) FROM image_cache")
+            (total,) = cur.fetchone()
+            if total > self.max_bytes:
+                cur.execute("SELECT key, size FROM image_cache ORDER BY last_access")
+                evict = []
+                for old_key, old_size in cur.fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((old_key,))
+                    total -= old_size
+                cur.executemany("DELETE FROM image_cache WHERE key=?", evict)
+            con.commit()
+
+    def stats(self) -> dict:
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.execute("SELECT COUNT(1), COALESCE(SUM(size),0) FROM image_cache")
+            entries, total = cur.fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_duplicate_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": total,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,293 @@
+"""Cola persistente de análisis de imagen con un pool de workers local.
+
+``POST /analyze-image/jobs`` guarda el trabajo (prompt e imagen normalizada) en
+SQLite y responde en el acto con su id. Un pool de hilos en cada worker de
+gunicorn reclama trabajos con un único ``UPDATE ... RETURNING`` (atómico entre
+procesos), llama al modelo y guarda el resultado. Los fallos se reintentan con
+backoff exponencial y jitter hasta ``max_attempts``; un trabajo cuyo worker
+murió se recupera cuando vence su ``lease`` (o pasa a ``failed`` si ya agotó
+los intentos). El número de intento identifica cada reclamación: un worker que
+perdió el lease no puede sobrescribir el resultado del que lo reclamó después.
+
+El modelo se inyecta como ``handler(prompt, image_data) -> str``, de modo que
+``FakeGenerativeModel`` (``GEMINI_BACKEND=fake``) puede sustituir a Gemini sin
+servicios externos.
+"""
+import logging
+import random
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+from db import ConnectionPool
+from metrics import JOBS_PROCESSED
+
+logger = logging.getLogger("nutriexpert.jobs")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+_PUBLIC_COLUMNS = "id, user, status, attempts, result, error, created_at, updated_at"
+
+
+class PermanentJobError(Exception):
+    """Error que no se arregla reintentando (p. ej. la imagen no es válida)"""
+
+
+class JobQueue:
+    """Trabajos de análisis en SQLite, compartidos por todos los workers.
+
+    Estados: ``queued`` → ``running`` → ``done`` | ``failed``. Un trabajo
+    reintentable vuelve a ``queued`` con ``run_after`` en el futuro. La imagen
+    se borra al terminar; el resultado se conserva ``retention_seconds``.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3, lease_seconds: float = 300,
+                 backoff_base: float = 2.0, backoff_max: float = 60.0, retention_seconds: float = 86400):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention_seconds = retention_seconds
+        self._pool = ConnectionPool(path)
+
+    def _conn(self):
+        return self._pool.connection()
+
+    def init(self):
+        with self._conn() as con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS analysis_jobs (
+                  id TEXT PRIMARY KEY,
+                  user TEXT NOT NULL,
+                  status TEXT NOT NULL,
+                  prompt TEXT NOT NULL,
+                  image BLOB,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  run_after REAL NOT NULL,
+                  lease_until REAL,
+                  result TEXT,
+                  error TEXT,
+                  created_at REAL NOT NULL,
+                  updated_at REAL NOT NULL
+                )
+                """
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_ready ON analysis_jobs (status, run_after)")
+            con.commit()
+
+    def enqueue(self, user: str, prompt: str, image_data: bytes, result: Optional[str] = None) -> str:
+        """Crea un trabajo y devuelve su id; con ``result`` se crea ya terminado (acierto de cache)"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._conn() as con:
+            if result is None:
+                con.execute(
+                    "INSERT INTO analysis_jobs (id,user,status,prompt,image,run_after,created_at,updated_at) "
+                    "VALUES (?,?,?,?,?,?,?,?)",
+                    (job_id, user, QUEUED, prompt, image_data, now, now, now),
+                )
+            else:
+                con.execute(
+                    "INSERT INTO analysis_jobs (id,user,status,prompt,result,run_after,created_at,updated_at) "
+                    "VALUES (?,?,?,?,?,?,?,?)",
+                    (job_id, user, DONE, prompt, result, now, now, now),
+                )
+        return job_id
+
+    def claim(self) -> Optional[Dict]:
+        """Reclama el siguiente trabajo listo (o con el lease vencido) y lo marca ``running``.
+
+        Cada sentencia es un ``UPDATE``: SQLite toma el lock de escritura antes
+        de leer, así que dos workers nunca reclaman el mismo trabajo. Los
+        trabajos con el lease vencido que ya agotaron sus intentos (su worker
+        murió en el último) pasan a ``failed`` en lugar de reintentarse.
+        """
+        now = time.time()
+        with self._conn() as con:
+            expired = con.execute(
+                "UPDATE analysis_jobs SET status=?, error=?, image=NULL, lease_until=NULL, updated_at=? "
+                "WHERE status=? AND lease_until<? AND attempts>=?",
+                (FAILED, "El análisis no terminó antes de vencer el lease", now, RUNNING, now, self.max_attempts),
+            ).rowcount
+            row = con.execute(
+                """
+                UPDATE analysis_jobs
+                   SET status=?, attempts=attempts+1, lease_until=?, updated_at=?
+                 WHERE id = (SELECT id FROM analysis_jobs
+                              WHERE (status=? AND run_after<=?) OR (status=? AND lease_until<? AND attempts<?)
+                              ORDER BY run_after LIMIT 1)
+                RETURNING id, prompt, image, attempts
+                """,
+                (RUNNING, now + self.lease_seconds, now, QUEUED, now, RUNNING, now, self.max_attempts),
+            ).fetchone()
+        if expired:
+            logger.error("%d trabajos de análisis fallidos: lease vencido en el último intento", expired)
+        if row is None:
+            return None
+        return {"id": row[0], "prompt": row[1], "image": row[2], "attempts": row[3]}
+
+    def complete(self, job_id: str, attempts: int, result: str) -> bool:
+        """Guarda el resultado del intento ``attempts``; ``False`` si ese intento ya no tiene el trabajo"""
+        now = time.time()
+        with self._conn() as con:
+            cur = con.execute(
+                "UPDATE analysis_jobs SET status=?, result=?, error=NULL, image=NULL, lease_until=NULL, updated_at=? "
+                "WHERE id=? AND status=? AND attempts=?",
+                (DONE, result, now, job_id, RUNNING, attempts),
+            )
+            return cur.rowcount == 1
+
+    def backoff(self, attempts: int) -> float:
+        """Espera antes del siguiente intento: exponencial con jitter, acotada"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def fail(self, job_id: str, attempts: int, error: str, retry: bool = True) -> Optional[str]:
+        """Registra un intento fallido; devuelve el nuevo estado (``queued`` o ``failed``),
+        o ``None`` si el intento ``attempts`` ya no tiene el trabajo"""
+        now = time.time()
+        with self._conn() as con:
+            if retry and attempts < self.max_attempts:
+                status = QUEUED
+                cur = con.execute(
+                    "UPDATE analysis_jobs SET status=?, error=?, run_after=?, lease_until=NULL, updated_at=? "
+                    "WHERE id=? AND status=? AND attempts=?",
+                    (QUEUED, error, now + self.backoff(attempts), now, job_id, RUNNING, attempts),
+                )
+            else:
+                status = FAILED
+                cur = con.execute(
+                    "UPDATE analysis_jobs SET status=?, error=?, image=NULL, lease_until=NULL, updated_at=? "
+                    "WHERE id=? AND status=? AND attempts=?",
+                    (FAILED, error, now, job_id, RUNNING, attempts),
+                )
+            return status if cur.rowcount == 1 else None
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._conn() as con:
+            cur = con.execute(f"SELECT {_PUBLIC_COLUMNS} FROM analysis_jobs WHERE id=?", (job_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip((d[0] for d in cur.description), row))
+
+    def pending(self) -> int:
+        """Trabajos en cola o en curso"""
+        with self._conn() as con:
+            (n,) = con.execute("SELECT COUNT(1) FROM analysis_jobs WHERE status IN (?,?)", (QUEUED, RUNNING)).fetchone()
+        return n
+
+    def counts(self) -> Dict[str, int]:
+        with self._conn() as con:
+            rows = con.execute("SELECT status, COUNT(1) FROM analysis_jobs GROUP BY status").fetchall()
+        return {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)} | dict(rows)
+
+    def purge(self) -> int:
+        """Borra los trabajos terminados hace más de ``retention_seconds``"""
+        with self._conn() as con:
+            cur = con.execute(
+                "DELETE FROM analysis_jobs WHERE status IN (?,?) AND updated_at<?",
+                (*FINISHED, time.time() - self.retention_seconds),
+            )
+            return cur.rowcount
+
+
+class JobWorkerPool:
+    """Hilos que consumen la cola llamando a ``handler(prompt, image_data)``.
+
+    Sin trabajo listo, cada hilo espera ``poll_interval`` segundos o hasta que
+    ``notify()`` avise de un trabajo nuevo encolado en este mismo proceso.
+    """
+
+    def __init__(self, queue: JobQueue, handler: Callable[[str, bytes], str], workers: int = 2,
+                 poll_interval: float = 1.0, purge_interval: float = 600):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_purge = 0.0
+        self._purge_lock = threading.Lock()
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"analysis-job-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except Exception:
+                logger.exception("❌ Error reclamando trabajos de análisis")
+                job = None
+            if job is None:
+                self._maybe_purge()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            try:
+                self._process(job)
+            except Exception:
+                # Error al guardar el resultado (p. ej. "database is locked"): el
+                # hilo sigue vivo y el trabajo se recupera al vencer su lease
+                logger.exception("❌ Error registrando el trabajo de análisis %s", job["id"])
+                self._stop.wait(self.poll_interval)
+
+    def _process(self, job: Dict):
+        try:
+            result = self.handler(job["prompt"], job["image"])
+        except Exception as e:
+            retry = not isinstance(e, PermanentJobError)
+            status = self.queue.fail(job["id"], job["attempts"], f"{type(e).__name__}: {e}", retry=retry)
+            if status is None:
+                self._lost(job)
+                return
+            JOBS_PROCESSED.inc(1, "retry" if status == QUEUED else FAILED)
+            log = logger.warning if status == QUEUED else logger.error
+            log("Trabajo %s falló (intento %d): %s", job["id"], job["attempts"], e)
+            return
+        if not self.queue.complete(job["id"], job["attempts"], result):
+            self._lost(job)
+            return
+        JOBS_PROCESSED.inc(1, DONE)
+
+    def _lost(self, job: Dict):
+        JOBS_PROCESSED.inc(1, "lost")
+        logger.warning("Trabajo %s: el intento %d perdió el lease; se descarta su resultado", job["id"], job["attempts"])
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.purge_interval or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_purge = now
+            removed = self.queue.purge()
+            if removed:
+                logger.info("🧹 %d trabajos de análisis antiguos eliminados", removed)
+        except Exception:
+            logger.exception("❌ Error purgando trabajos de análisis")
+        finally:
+            self._purge_lock.release()
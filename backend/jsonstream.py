@@ -0,0 +1,174 @@
+"""Parseo incremental de cuerpos JSON y NDJSON.
+
+Lo usan ``/infer/batch`` y ``/rules/bulk`` para decodificar elementos a medida
+que llega el cuerpo, sin guardarlo entero en memoria. En NDJSON cada línea se
+decodifica por separado: una línea mal formada se devuelve como
+``InvalidItem`` en su posición y el resto del flujo sigue procesándose.
+
+Los bytes que no son UTF-8 válido se decodifican con ``surrogateescape`` y se
+detectan después: en NDJSON invalidan sólo su línea y en un array JSON cortan
+el cuerpo con un error, igual que cualquier otro fallo de sintaxis.
+"""
+import codecs
+import json
+import re
+from typing import Any, AsyncIterator, List, Optional
+
+# Caracteres que produce ``surrogateescape`` para bytes no UTF-8. Un JSON
+# válido sólo puede contener surrogates escapados (``\udc80``), nunca en bruto.
+_INVALID_UTF8 = re.compile("[\udc80-\udcff]")
+
+
+class InvalidItem:
+    """Elemento NDJSON que no es JSON válido (``line`` empieza en 1)"""
+
+    __slots__ = ("line", "error")
+
+    def __init__(self, line: int, error: str):
+        self.line = line
+        self.error = error
+
+    def __repr__(self) -> str:
+        return f"InvalidItem(line={self.line}, error={self.error!r})"
+
+
+class JSONStreamDecoder:
+    """Decodifica incrementalmente un array JSON o un flujo NDJSON.
+
+    Se le van pasando trozos de texto con ``feed()`` y devuelve los elementos
+    completos que ya se pueden decodificar, sin esperar al cuerpo entero. Si
+    un array JSON está mal formado, primero se devuelven los elementos
+    anteriores al error y el ``ValueError`` se lanza en la llamada siguiente.
+    """
+
+    def __init__(self, ndjson: Optional[bool] = None):
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._ndjson = ndjson
+        self._started = False
+        self._closed = False
+        self._expect_value = True
+        self._line = 0
+        self._error: Optional[ValueError] = None
+
+    def _skip(self, pos: int) -> int:
+        while pos < len(self._buf) and self._buf[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    def _lines(self, lines: List[str]) -> List[Any]:
+        items: List[Any] = []
+        for line in lines:
+            self._line += 1
+            line = line.strip()
+            if not line:
+                continue
+            if _INVALID_UTF8.search(line):
+                items.append(InvalidItem(self._line, f"UTF-8 inválido en la línea {self._line}"))
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(InvalidItem(self._line, f"JSON inválido en la línea {self._line}: {e}"))
+        return items
+
+    def feed(self, text: str) -> List[Any]:
+        if self._error:
+            raise self._error
+        self._buf += text
+        if self._ndjson is None:
+            pos = self._skip(0)
+            if pos == len(self._buf):
+                return []
+            self._ndjson = self._buf[pos] != "["
+        if self._ndjson:
+            *lines, self._buf = self._buf.split("\n")
+            return self._lines(lines)
+        bad = _INVALID_UTF8.search(self._buf)
+        if bad:
+            # Se devuelven los elementos completos anteriores al byte inválido
+            self._buf = self._buf[:bad.start()]
+            items = self._drain(final=False)
+            self._error = self._error or ValueError("UTF-8 inválido en el array JSON")
+            if not items:
+                raise self._error
+            return items
+        return self._drain(final=False)
+
+    def _drain(self, final: bool) -> List[Any]:
+        items: List[Any] = []
+        try:
+            self._drain_into(items, final)
+        except ValueError as e:
+            if not items:
+                raise
+            self._error = e
+        return items
+
+    def _drain_into(self, items: List[Any], final: bool) -> None:
+        pos = self._skip(0)
+        if not self._started and pos < len(self._buf):
+            if self._buf[pos] != "[":
+                raise ValueError("Se esperaba un array JSON")
+            self._started, pos = True, pos + 1
+        while self._started and not self._closed:
+            pos = self._skip(pos)
+            if pos >= len(self._buf):
+                break
+            ch = self._buf[pos]
+            if ch == "]":
+                self._closed, pos = True, pos + 1
+            elif self._expect_value:
+                try:
+                    item, end = self._decoder.raw_decode(self._buf, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise ValueError("Array JSON incompleto o inválido")
+                    break  # elemento incompleto: esperar más datos
+                if end == len(self._buf) and not final:
+                    break  # un número podría continuar en el siguiente trozo
+                items.append(item)
+                pos, self._expect_value = end, False
+            elif ch == ",":
+                pos, self._expect_value = pos + 1, True
+            else:
+                self._buf = self._buf[pos:]
+                raise ValueError(f"Carácter inesperado en el array JSON: {ch!r}")
+        self._buf = self._buf[pos:]
+
+    def close(self) -> List[Any]:
+        """Procesa lo que quede en el buffer al terminar el cuerpo"""
+        if self._error:
+            raise self._error
+        if self._ndjson:
+            rest, self._buf = self._buf, ""
+            return self._lines([rest])
+        if self._ndjson is None:
+            return []
+        items = self._drain(final=True)
+        if not self._error and (self._buf.strip() or not self._closed):
+            self._error = ValueError("Array JSON incompleto")
+        if self._error and not items:
+            raise self._error
+        return items
+
+
+async def iter_json_stream(chunks: AsyncIterator[bytes], ndjson: Optional[bool] = None) -> AsyncIterator[Any]:
+    """Elementos de un cuerpo JSON/NDJSON recibido por trozos.
+
+    Las líneas NDJSON inválidas llegan como ``InvalidItem``; un array JSON mal
+    formado lanza ``ValueError`` después de los elementos que lo preceden.
+    """
+    decoder = JSONStreamDecoder(ndjson)
+    # El decodificador incremental guarda los caracteres multibyte partidos
+    # entre trozos; los bytes inválidos los marca ``surrogateescape``.
+    utf8 = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+    async for chunk in chunks:
+        for item in decoder.feed(utf8.decode(chunk)):
+            yield item
+    for item in decoder.feed(utf8.decode(b"", final=True)):
+        yield item
+    for item in decoder.close():
+        yield item
+    if decoder._error:
+        raise decoder._error
@@ -0,0 +1,81 @@
+"""Logging estructurado y asíncrono.
+
+Los handlers de la aplicación sólo encolan el registro (``QueueHandler``); un
+hilo (``QueueListener``) lo formatea como una línea JSON y lo escribe en stdout,
+de modo que ninguna petición hace E/S síncrona para registrar. La traza de
+una excepción viaja ya formateada y aparte del mensaje (campo ``exc``). El
+nivel se configura con ``LOG_LEVEL`` (por defecto ``INFO``).
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Una línea JSON por registro; los ``extra=`` se añaden como campos"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        exc = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc:
+            entry["exc"] = exc
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """``QueueHandler`` que no mezcla la traza con el mensaje.
+
+    El ``prepare()`` de la biblioteca formatea el registro entero (traza
+    incluida) en ``msg`` y borra ``exc_info``, así que al listener le llega un
+    mensaje con el traceback dentro. Aquí ``msg`` queda sólo con el mensaje y
+    la traza, ya formateada en este hilo, viaja en ``exc_text``.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.formatter or _FORMATTER).formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+_FORMATTER = logging.Formatter()
+_listener = None
+
+
+def setup_logging(name: str = "nutriexpert") -> logging.Logger:
+    """Configura (una sola vez por proceso) el logger de la aplicación"""
+    global _listener
+    logger = logging.getLogger(name)
+    if _listener is None:
+        stream = logging.StreamHandler()
+        stream.setFormatter(JSONFormatter())
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+        _listener.start()
+        atexit.register(_listener.stop)
+        logger.addHandler(StructuredQueueHandler(log_queue))
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+    return logger
@@ -1,21 +1,46 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Dict, Any, Iterator, Optional
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from dotenv import load_dotenv
-import json, sqlite3, operator, os
-import google.generativeai as genai
-from PIL import Image
+import json, sqlite3, os, threading, asyncio, hashlib, time, gzip
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
 import base64
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from engine import RuleIndex, RuleProfiler, UnknownOperatorError, compile_when, find_assert_cycles, infer
+from jsonstream import InvalidItem, iter_json_stream
+from imaging import ImageAnalysisCache, InvalidImageError, normalize_image
+from lru import LRUCache
+from ratelimit import RateLimiter, parse_limit, retry_after_header
+from fake_gemini import FakeGenerativeModel
+from fastjson import FastJSONResponse, dumps as fast_dumps
+from history import HistoryWriter
+from simulation import FINISHED as SIMULATION_FINISHED, SimulationRunner, SimulationStore
+from jobs import DONE, FAILED, JobQueue, JobWorkerPool, PermanentJobError
+from db import ConnectionPool
+from logs import setup_logging
+from metrics import (DB_CALL_SECONDS, GEMINI_CALL_SECONDS, INFERENCE_REQUESTS, INFERENCE_RULES_FIRED, RATE_LIMITED,
+                     MetricsMiddleware, registry, timed)
+
 # Cargar variables de entorno
 load_dotenv()
 
+logger = setup_logging()
+
 app = FastAPI(
     title="NutriExpert API",
     description="Sistema Experto de Nutrición con motor de inferencia basado en reglas",
@@ -35,18 +60,18 @@ app.add_middleware(
     max_age=3600,
 )
 
-# Middleware para logging de peticiones
-@app.middleware("http")
-async def log_requests(request, call_next):
-    origin = request.headers.get('origin', 'N/A')
-    print(f"📨 {request.method} {request.url.path} - Origin: {origin}")
-    try:
-        response = await call_next(request)
-        print(f"✅ Response: {response.status_code}")
-        return response
-    except Exception as e:
-        print(f"❌ Error procesando request: {e}")
-        raise
+# Métricas de latencia por ruta (middleware ASGI, ver metrics.py)
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Métricas de este worker en formato texto de Prometheus.
+
+    Los colectores consultan SQLite (historial, cola de trabajos, cache de
+    imágenes...), así que el render va al pool de hilos y no al event loop.
+    """
+    body = await run_in_threadpool(registry.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
 # Endpoint de salud para verificar que el backend funciona
 @app.get("/health")
@@ -58,22 +83,61 @@ DB_PATH = os.getenv("DATABASE_URL", "sqlite:///./rules.db").replace("sqlite:///"
 JWT_SECRET = os.getenv("JWT_SECRET_KEY")
 if not JWT_SECRET:
     raise RuntimeError("❌ JWT_SECRET_KEY no está configurado en .env")
-print(f"🔑 JWT_SECRET cargado correctamente (primeros 10 chars): {JWT_SECRET[:10]}...")
+logger.info("🔑 JWT_SECRET cargado correctamente")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 JWT_EXPIRE_MINUTES = int(os.getenv("JWT_EXPIRE_MINUTES", "480"))
 
 # ---- CONFIGURACIÓN DE GEMINI API ----
 GEMINI_API_KEY = os.getenv("API_GEMINI_KEY")
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-2.5-flash')
-    print("✅ Gemini API configurada correctamente")
-except Exception as e:
-    print(f"⚠️ Error configurando Gemini API: {e}")
-    gemini_model = None
+# "fake" usa un modelo local con retardos (desarrollo, benchmarks y pruebas de carga)
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "gemini")
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+# google.generativeai tarda más en importarse que el resto de la app junta:
+# el modelo se importa y configura en el primer análisis, no al cargar el worker
+gemini_model = None
+_gemini_lock = threading.Lock()
+_gemini_failed = False
+
+
+def get_gemini_model():
+    """Modelo de Gemini (o el falso), creado en el primer uso; ``None`` si no se pudo configurar"""
+    global gemini_model, _gemini_failed
+    if gemini_model is not None or _gemini_failed:
+        return gemini_model
+    with _gemini_lock:
+        if gemini_model is None and not _gemini_failed:
+            if GEMINI_BACKEND == "fake":
+                gemini_model = FakeGenerativeModel.from_env()
+                logger.info("🧪 Usando el modelo Gemini falso (GEMINI_BACKEND=fake)")
+            else:
+                try:
+                    import google.generativeai as genai
+                    genai.configure(api_key=GEMINI_API_KEY)
+                    gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+                    logger.info("✅ Gemini API configurada correctamente")
+                except Exception as e:
+                    logger.warning("⚠️ Error configurando Gemini API: %s", e)
+                    _gemini_failed = True
+    return gemini_model
+
+
+async def require_gemini():
+    """503 si el modelo no está disponible; la primera carga se hace fuera del event loop"""
+    model = gemini_model if gemini_model is not None else await run_in_threadpool(get_gemini_model)
+    if not model:
+        raise HTTPException(status_code=503, detail="Servicio de análisis de imágenes no disponible")
 
 # Contexto de hashing de contraseñas con pbkdf2_sha256 (incluido en Python, muy seguro)
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Las rondas sólo afectan a los hashes nuevos; cada hash guarda las suyas.
+PBKDF2_ROUNDS = int(os.getenv("PBKDF2_ROUNDS", "29000"))
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto", pbkdf2_sha256__default_rounds=PBKDF2_ROUNDS)
+
+# El hashing consume CPU durante decenas de ms: se ejecuta en un pool propio,
+# con un máximo de operaciones pendientes por worker.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwd-hash")
+hash_slots = threading.BoundedSemaphore(HASH_MAX_PENDING)
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -96,6 +160,17 @@ class Rule(BaseModel):
     when: List[Dict[str, Any]]
     then: Dict[str, Any]
 
+class RuleDraft(BaseModel):
+    """Cambios sin publicar sobre las reglas actuales"""
+    upsert: List[Rule] = Field(default=[], description="Reglas nuevas o que reemplazan a la del mismo id")
+    delete: List[str] = Field(default=[], description="Ids de reglas a eliminar")
+
+class SimulationRequest(BaseModel):
+    draft: RuleDraft
+    population: Optional[List[Facts]] = Field(default=None, description="Pacientes; si falta se usa el historial de /infer")
+    days: int = Field(default=30, ge=1, le=366, description="Días de historial si no se envía población")
+    limit: int = Field(default=50000, ge=1, description="Máximo de pacientes tomados del historial")
+
 class UserCreate(BaseModel):
     email: EmailStr
     name: str = Field(min_length=2, max_length=100)
@@ -118,8 +193,11 @@ class ImageAnalysisRequest(BaseModel):
 
 # ---------- DB HELPERS ----------
 
+# Pool de conexiones por worker (WAL, pragmas y statements cacheados, ver db.py)
+db_pool = ConnectionPool(DB_PATH)
+
 def get_conn():
-    return sqlite3.connect(DB_PATH)
+    return db_pool.connection()
 
 
 def init_db():
@@ -149,6 +227,16 @@ def init_db():
             )
             """
         )
+        # meta: contadores compartidos entre workers (generación de reglas)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+              key TEXT PRIMARY KEY,
+              value INTEGER NOT NULL
+            )
+            """
+        )
+        cur.execute("INSERT OR IGNORE INTO meta (key,value) VALUES ('rules_generation',0)")
         con.commit()
 
 
@@ -164,6 +252,24 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def _run_hashing(fn, *args):
+    """Ejecuta una operación de hashing en ``hash_executor`` sin bloquear el event loop"""
+    if not hash_slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Servidor ocupado, inténtalo más tarde", headers={"Retry-After": "1"})
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, fn, *args)
+    finally:
+        hash_slots.release()
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_hashing(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_hashing(verify_password, plain_password, hashed_password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Crea un JWT token"""
     to_encode = data.copy()
@@ -177,15 +283,25 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
+# Tokens ya verificados, indexados por su SHA-256; caducan con el ``exp`` del token
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
+
 def decode_token(token: str) -> dict:
     """Decodifica y valida un JWT token"""
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        return dict(cached)
     try:
-        print(f"🔓 Intentando decodificar token...")
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        print(f"✅ Token decodificado exitosamente. Payload: {payload}")
+        logger.debug("✅ Token decodificado exitosamente", extra={"sub": payload.get("sub")})
+        if isinstance(payload.get("exp"), (int, float)):
+            token_cache.set(key, dict(payload), expires_at=payload["exp"])
         return payload
     except JWTError as e:
-        print(f"❌ Error JWT al decodificar: {e}")
+        logger.info("❌ Error JWT al decodificar: %s", e)
         raise HTTPException(
             status_code=401,
             detail=f"Token inválido o expirado: {str(e)}",
@@ -194,6 +310,7 @@ def decode_token(token: str) -> dict:
 
 # ---------- AUTH ----------
 
+@timed(DB_CALL_SECONDS, "get_user_by_email")
 def get_user_by_email(email: str) -> Optional[dict]:
     with get_conn() as con:
         cur = con.cursor()
@@ -204,13 +321,15 @@ def get_user_by_email(email: str) -> Optional[dict]:
         return None
 
 
-def create_user(u: UserCreate) -> UserPublic:
+@timed(DB_CALL_SECONDS, "create_user")
+def create_user(u: UserCreate, password_hash: Optional[str] = None) -> UserPublic:
+    """Crea el usuario; ``password_hash`` permite pasar el hash ya calculado"""
     with get_conn() as con:
         cur = con.cursor()
         try:
             cur.execute(
                 "INSERT INTO users (email,name,password_hash,role) VALUES (?,?,?,?)",
-                (u.email, u.name, hash_password(u.password), u.role)
+                (u.email, u.name, password_hash or hash_password(u.password), u.role)
             )
             con.commit()
             uid = cur.lastrowid
@@ -219,12 +338,12 @@ def create_user(u: UserCreate) -> UserPublic:
             raise HTTPException(status_code=400, detail="Email ya registrado")
 
 
-def authenticate_user(email: str, password: str) -> Optional[dict]:
+async def authenticate_user(email: str, password: str) -> Optional[dict]:
     """Autentica un usuario verificando email y contraseña"""
-    user = get_user_by_email(email)
+    user = await run_in_threadpool(get_user_by_email, email)
     if not user:
         return None
-    if not verify_password(password, user["password_hash"]):
+    if not await verify_password_async(password, user["password_hash"]):
         return None
     return user
 
@@ -240,7 +359,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error decodificando token: {e}")
+        logger.warning("❌ Error decodificando token: %s", e)
         raise HTTPException(status_code=401, detail=f"Error validando token: {str(e)}")
 
 
@@ -250,20 +369,92 @@ def require_nutritionist(user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Se requiere rol de nutricionista")
     return user
 
-# ---------- ENERGY UTILS ----------
-# Factores de actividad para TDEE
-ACTIVITY_FACTORS = {"sedentary":1.2,"light":1.375,"moderate":1.55,"active":1.725,"very_active":1.9}
 
-def mifflin_st_jeor(sex: str, age: int, height_cm: float, weight_kg: float, activity: str) -> float:
-    
-    # Calcular TMB (Tasa Metabólica Basal)
-    bmr = 10*weight_kg + 6.25*height_cm - 5*age + (5 if sex.upper()=="M" else -161)
-    
-    # Multiplicar por factor de actividad = TDEE
-    return bmr * ACTIVITY_FACTORS.get(activity,1.2)
+# ---------- LÍMITES DE PETICIONES ----------
+# Cubetas de tokens por usuario (``sub`` del JWT) y por IP, compartidas entre
+# workers a través de SQLite (ver ratelimit.py). Formato: capacidad/segundos.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "ratelimit.db"))
+RATE_LIMITS = {
+    scope: (parse_limit(os.getenv(f"RATE_LIMIT_{scope.upper()}_USER", user)),
+            parse_limit(os.getenv(f"RATE_LIMIT_{scope.upper()}_IP", ip)))
+    for scope, user, ip in (
+        ("infer", "120/60", "300/60"),
+        # /infer/batch consume una unidad por fila del lote
+        ("infer_batch", "20000/60", "50000/60"),
+        ("analyze", "10/60", "30/60"),
+        ("login", "10/300", "30/300"),
+    )
+}
+# Una cubeta inactiva más que el mayor tiempo de rellenado está llena y se puede borrar
+rate_limiter = RateLimiter(
+    RATE_LIMIT_DB_PATH,
+    max_idle_seconds=max((limit.refill_seconds for pair in RATE_LIMITS.values() for limit in pair if limit), default=3600.0),
+)
+
+
+def enforce_rate_limit(scope: str, request: Request, user_key: Optional[str], cost: float = 1.0,
+                       size: Optional[float] = None):
+    """429 con ``Retry-After`` si el usuario o la IP agotaron su cupo en ``scope``.
+
+    ``cost`` es lo que consume la petición de cada cubeta. Si su tamaño total
+    (``size``, por defecto ``cost``) supera la capacidad de alguna, nunca se
+    admitiría y se responde 413.
+    """
+    if not RATE_LIMIT_ENABLED or cost <= 0:
+        return
+    user_limit, ip_limit = RATE_LIMITS[scope]
+    buckets = []
+    if user_limit and user_key:
+        buckets.append((f"{scope}:user:{user_key}", user_limit))
+    if ip_limit and request.client:
+        buckets.append((f"{scope}:ip:{request.client.host}", ip_limit))
+    if not buckets:
+        return
+    capacity = min(limit.capacity for _, limit in buckets)
+    if (cost if size is None else size) > capacity:
+        RATE_LIMITED.inc(1, scope)
+        raise HTTPException(status_code=413, detail=f"La petición supera el cupo de {capacity:g} por periodo")
+    wait = rate_limiter.take(buckets, cost)
+    if wait > 0:
+        RATE_LIMITED.inc(1, scope)
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas peticiones, inténtalo más tarde",
+            headers={"Retry-After": retry_after_header(wait)},
+        )
+
+
+def _token_subject(request: Request) -> Optional[str]:
+    """``sub`` del token si la petición trae uno válido (endpoints sin autenticación obligatoria)"""
+    auth = request.headers.get("authorization", "")
+    if auth[:7].lower() != "bearer ":
+        return None
+    try:
+        return decode_token(auth[7:]).get("sub")
+    except HTTPException:
+        return None
+
+
+def limit_infer(request: Request):
+    enforce_rate_limit("infer", request, _token_subject(request))
+
+
+def limit_infer_batch(request: Request) -> Optional[str]:
+    """Primera unidad del cupo por filas de /infer/batch, antes de leer el cuerpo;
+    devuelve el ``sub`` para cobrar el resto de filas al terminar de decodificarlo"""
+    subject = _token_subject(request)
+    enforce_rate_limit("infer_batch", request, subject)
+    return subject
+
+
+def limit_analyze(request: Request, user: dict = Depends(get_current_user)):
+    enforce_rate_limit("analyze", request, user["sub"])
+
 
 # ---------- RULES DB ----------
 
+@timed(DB_CALL_SECONDS, "load_rules")
 def load_rules() -> List[Dict[str,Any]]:
     with get_conn() as con:
         cur = con.cursor()
@@ -271,164 +462,377 @@ def load_rules() -> List[Dict[str,Any]]:
         return [json.loads(r[0]) for r in cur.fetchall()]
 
 
+def _bump_rules_generation(cur):
+    """Incrementa la generación de reglas dentro de la transacción de escritura"""
+    cur.execute("UPDATE meta SET value = value + 1 WHERE key='rules_generation'")
+
+
+@timed(DB_CALL_SECONDS, "get_rules_generation")
+def get_rules_generation() -> int:
+    with get_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT value FROM meta WHERE key='rules_generation'")
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+
+@timed(DB_CALL_SECONDS, "save_rule")
 def save_rule(rule: Dict[str,Any]):
     with get_conn() as con:
         cur = con.cursor()
         cur.execute("INSERT INTO rules (id,name,priority,json) VALUES (?,?,?,?)",(rule["id"], rule.get("name"), int(rule.get("priority",0)), json.dumps(rule)))
+        _bump_rules_generation(cur)
         con.commit()
 
 
+@timed(DB_CALL_SECONDS, "update_rule")
 def update_rule(rule: Dict[str,Any]):
     with get_conn() as con:
         cur = con.cursor()
         cur.execute("UPDATE rules SET name=?, priority=?, json=? WHERE id=?", (rule.get("name"), int(rule.get("priority",0)), json.dumps(rule), rule["id"]))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Rule not found")
+        _bump_rules_generation(cur)
         con.commit()
 
 
+@timed(DB_CALL_SECONDS, "delete_rule")
 def delete_rule(rule_id: str):
     with get_conn() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM rules WHERE id=?", (rule_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Rule not found")
+        _bump_rules_generation(cur)
         con.commit()
 
-# ---------- INFERENCE ENGINE ----------
-OPS = {"==": operator.eq, "!=": operator.ne, ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
 
-def match_condition(facts: Dict[str,Any], cond: Dict[str,Any]) -> bool:
-    fact, op, value = cond.get("fact"), cond.get("op"), cond.get("value")
-    if op in OPS: return OPS[op](facts.get(fact), value)
-    if op == "in": return facts.get(fact) in value
-    if op == "not_in": return facts.get(fact) not in value
-    if op == "contains": return value in facts.get(fact, [])
-    return False
+@timed(DB_CALL_SECONDS, "upsert_rules")
+def upsert_rules(rules: List[Dict[str,Any]]) -> int:
+    """Inserta o reemplaza ``rules`` en una sola transacción; devuelve cuántas eran nuevas"""
+    with get_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT COUNT(1) FROM rules")
+        (before,) = cur.fetchone()
+        cur.executemany(
+            "INSERT INTO rules (id,name,priority,json) VALUES (?,?,?,?) "
+            "ON CONFLICT(id) DO UPDATE SET name=excluded.name, priority=excluded.priority, json=excluded.json",
+            ((r["id"], r.get("name"), int(r.get("priority",0)), json.dumps(r)) for r in rules),
+        )
+        cur.execute("SELECT COUNT(1) FROM rules")
+        (after,) = cur.fetchone()
+        _bump_rules_generation(cur)
+    return after - before
 
 
-def infer(facts: Dict[str,Any], rules: List[Dict[str,Any]]):
-    """Motor de inferencia - Forward Chaining"""
-    
-    # PASO 1: Ordenar reglas por prioridad (mayor a menor) 
-    agenda = sorted(rules, key=lambda r: r.get("priority",0), reverse=True)
+RULES_EXPORT_FETCH_SIZE = 500
+
+def iter_rules_export(as_array: bool) -> Iterator[str]:
+    """Reglas tal y como están guardadas, leídas por bloques con ``fetchmany``"""
+    with get_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT json FROM rules ORDER BY priority DESC, id")
+        first = True
+        if as_array:
+            yield "["
+        while True:
+            rows = cur.fetchmany(RULES_EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            if as_array:
+                yield ("" if first else ",") + ",".join(r[0] for r in rows)
+            else:
+                yield "".join(r[0] + "\n" for r in rows)
+            first = False
+        if as_array:
+            yield "]"
+
+
+# ---------- RULES CACHE ----------
+
+class RulesPayload:
+    """Cuerpo de ``GET /rules`` ya serializado, con su ETag y la versión gzip bajo demanda"""
+
+    def __init__(self, rules: List[Dict[str,Any]]):
+        self.body = fast_dumps({"rules": rules})
+        digest = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        # Cada codificación es una representación distinta: ETag fuerte propio
+        self.etag = f'"{digest}"'
+        self.etag_gzip = f'"{digest}-gz"'
+        self.gzip_body: Optional[bytes] = None
+        self._lock = threading.Lock()
+
+    def gzipped(self) -> bytes:
+        if self.gzip_body is None:
+            with self._lock:
+                if self.gzip_body is None:
+                    self.gzip_body = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self.gzip_body
+
+
+class RuleSnapshot:
+    """Reglas ya parseadas, ordenadas e indexadas para una generación concreta"""
+
+    def __init__(self, generation: int, rules: List[Dict[str,Any]]):
+        self.generation = generation
+        self.rules = rules
+        self.index = RuleIndex(rules)
+        self.rules_payload: Optional[RulesPayload] = None
+        self._payload_lock = threading.Lock()
+
+    def payload(self) -> RulesPayload:
+        """Se serializa en la primera petición a ``GET /rules`` de esta generación"""
+        if self.rules_payload is None:
+            with self._payload_lock:
+                if self.rules_payload is None:
+                    self.rules_payload = RulesPayload(self.rules)
+        return self.rules_payload
+
+
+class RuleCache:
+    """Cache de reglas por worker.
+
+    Cada worker conserva un ``RuleSnapshot`` en memoria y sólo recarga la tabla
+    ``rules`` cuando cambia el contador ``rules_generation`` en SQLite, que
+    incrementan ``save_rule``, ``update_rule`` y ``delete_rule``. Así una
+    edición hecha en un worker es visible en los demás en la siguiente petición.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[RuleSnapshot] = None
+
+    def get(self) -> RuleSnapshot:
+        generation = get_rules_generation()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.generation != generation:
+                # Releer hasta que la generación no cambie durante la carga
+                while True:
+                    rules = load_rules()
+                    current = get_rules_generation()
+                    if current == generation:
+                        break
+                    generation = current
+                snapshot = RuleSnapshot(generation, rules)
+                for rule_id, reason in snapshot.index.rejected.items():
+                    logger.warning("⚠️ Regla %s ignorada: %s", rule_id, reason)
+                self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+
+
+rule_cache = RuleCache()
+
+# Perfilado por regla de /infer (desactivado por defecto)
+RULE_PROFILING = os.getenv("RULE_PROFILING", "0") == "1"
+RULE_PROFILING_SAMPLE_RATE = float(os.getenv("RULE_PROFILING_SAMPLE_RATE", "1.0"))
+rule_profiler = RuleProfiler(RULE_PROFILING_SAMPLE_RATE, enabled=RULE_PROFILING)
+
+# Resultados de /infer por (generación de reglas, hechos canónicos)
+INFERENCE_CACHE_SIZE = int(os.getenv("INFERENCE_CACHE_SIZE", "2048"))
+inference_cache = LRUCache(INFERENCE_CACHE_SIZE)
+
+
+# Historial de /infer con escritura diferida y agregados diarios (ver history.py)
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "history.db"))
+history = HistoryWriter(
+    HISTORY_DB_PATH,
+    flush_interval=float(os.getenv("HISTORY_FLUSH_SECONDS", "1.0")),
+    batch_size=int(os.getenv("HISTORY_BATCH_SIZE", "500")),
+    max_pending=int(os.getenv("HISTORY_MAX_PENDING", "50000")),
+    retention_seconds=float(os.getenv("HISTORY_RETENTION_DAYS", "90")) * 86400,
+    purge_interval=float(os.getenv("HISTORY_PURGE_INTERVAL_SECONDS", "3600")),
+)
+
+
+# Simulaciones de borradores de reglas en un pool de procesos (ver simulation.py)
+SIMULATION_DB_PATH = os.getenv("SIMULATION_DB_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "simulations.db"))
+SIMULATION_MAX_PATIENTS = int(os.getenv("SIMULATION_MAX_PATIENTS", "200000"))
+simulation_store = SimulationStore(
+    SIMULATION_DB_PATH,
+    stale_seconds=float(os.getenv("SIMULATION_STALE_SECONDS", "120")),
+    retention_seconds=float(os.getenv("SIMULATION_RETENTION_HOURS", "24")) * 3600,
+)
+simulations = SimulationRunner(
+    simulation_store,
+    processes=int(os.getenv("SIMULATION_PROCESSES", str(os.cpu_count() or 1))),
+    shard_size=int(os.getenv("SIMULATION_SHARD_SIZE", "5000")),
+    max_running=int(os.getenv("SIMULATION_MAX_RUNNING", "1")),
+)
+
+def facts_key(facts: Dict[str,Any]) -> bytes:
+    """Hash canónico de los hechos: claves ordenadas y ``conditions`` como conjunto ordenado"""
+    canonical = dict(facts, conditions=sorted(facts.get("conditions") or []))
+    return hashlib.blake2b(json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode(), digest_size=16).digest()
 
-    # PASO 2: Inicializar resultados
-    diagnoses, plan, fired = [], {"kcal_target":None, "macro_split":None, "restrictions":[], "advice":[]}, []
-    
-    # PASO 3: CICLO DE INFERENCIA - Evaluar cada regla
-    for r in agenda:
-        if all(match_condition(facts, c) for c in r.get("when", [])):
-            fired.append({"id": r["id"], "name": r.get("name"), "explain": r.get("then",{}).get("explain")})
-            then = r.get("then", {})
-            for d in then.get("diagnosis", []):
-                if d not in diagnoses: diagnoses.append(d)
-            diet = then.get("diet", {})
-            if diet:
-                kcal_cfg = diet.get("kcal_target")
-                if isinstance(kcal_cfg, dict) and kcal_cfg.get("method") == "mifflin_st_jeor":
-                    tdee = mifflin_st_jeor(facts.get("sex"), facts.get("age"), facts.get("height_cm"), facts.get("weight_kg"), facts.get("activity"))
-                    plan["kcal_target"] = round(tdee * (1 - float(kcal_cfg.get("deficit_pct",0.0)) + float(kcal_cfg.get("surplus_pct",0.0))))
-                elif isinstance(kcal_cfg, (int,float)):
-                    plan["kcal_target"] = int(kcal_cfg)
-                if diet.get("macro_split"): plan["macro_split"] = diet["macro_split"]
-                plan["restrictions"] += diet.get("restrictions", [])
-                plan["advice"] += diet.get("advice", [])
-
-    # PASO 4: Limpieza de resultados (eliminar duplicados)
-    plan["restrictions"] = sorted(list(set(plan["restrictions"])))
-    plan["advice"] = sorted(list(set(plan["advice"])))
-    # return {"diagnosis": diagnoses or (["Eutrófico (sin hallazgos)"] if 18.5 <= facts.get("bmi",0) < 25 else []), "plan": plan, "fired_rules": fired}
-    # Sin diagnóstico por defecto para IMC normal
-
-    # PASO 5: Retornar resultado
-    return {"diagnosis": diagnoses, "plan": plan, "fired_rules": fired}
 # ---------- STARTUP & SEED ----------
-@app.on_event("startup")
-async def on_startup():
-    init_db()
-    # si no hay nutricionista, crear uno demo
+# Reglas iniciales (R1–R3) cargadas si la tabla está vacía
+SEED_RULES = [
+    {   
+        "id":"R1","name":"Bajo peso",
+        "priority":20,
+        "when":[{"fact":"bmi","op":"<","value":18.5}],
+        "then":{
+            "diagnosis":["Bajo peso"],
+            "diet":{
+                "kcal_target":{"method":"mifflin_st_jeor","surplus_pct":0.15},
+                "macro_split":{"carb_pct":0.50,"prot_pct":0.20,"fat_pct":0.30},
+                "advice":["Aumentar densidad calórica"],
+                "restrictions":[]
+            },
+            "explain":"IMC < 18.5"
+        }
+    },
+    {
+        "id":"R2","name":"Sobrepeso",
+        "priority":10,
+        "when":[
+            {"fact":"bmi","op":">=","value":25},
+            {"fact":"bmi","op":"<","value":30}
+        ],
+        "then":{
+            "diagnosis":["Sobrepeso"],
+            "diet":{
+                "kcal_target":{"method":"mifflin_st_jeor","deficit_pct":0.15},
+                "macro_split":{"carb_pct":0.45,"prot_pct":0.25,"fat_pct":0.30},
+                "advice":["Déficit moderado"],
+                "restrictions":["bebidas_azucaradas"]
+            },
+            "explain":"IMC 25–29.9"
+        }
+    },
+    {
+        "id":"R3","name":"Obesidad",
+        "priority":11,
+        "when":[
+            {"fact":"bmi","op":">=","value":30}
+        ],
+        "then":{
+            "diagnosis":["Obesidad"],
+            "diet":{
+                "kcal_target":{"method":"mifflin_st_jeor","deficit_pct":0.20},
+                "macro_split":{"carb_pct":0.40,"prot_pct":0.30,"fat_pct":0.30},
+                "advice":["Más proteína y fibra"],
+                "restrictions":["ultraprocesados"]
+            },
+            "explain":"IMC ≥ 30"
+        }
+    },
+]
+
+# ---------- BOOTSTRAP ----------
+# Esquemas y datos iniciales se crean una sola vez por despliegue: el primer
+# worker que arranca lo hace bajo un lock de fichero y deja una marca en
+# ``meta``; el resto (y los reinicios) sólo leen la marca.
+BOOTSTRAP_VERSION = 4  # subir al cambiar el esquema o los datos iniciales
+BOOTSTRAP_LOCK_PATH = DB_PATH + ".bootstrap.lock"
+
+
+def _bootstrap_done() -> bool:
+    if not all(os.path.exists(p) for p in (IMAGE_CACHE_PATH, JOBS_DB_PATH, HISTORY_DB_PATH, RATE_LIMIT_DB_PATH, SIMULATION_DB_PATH)):
+        return False
+    try:
+        with get_conn() as con:
+            row = con.execute("SELECT value FROM meta WHERE key='bootstrap_version'").fetchone()
+    except sqlite3.OperationalError:
+        return False  # base de datos nueva: todavía no existe la tabla meta
+    return row is not None and row[0] >= BOOTSTRAP_VERSION
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Lock exclusivo entre procesos; sin ``fcntl`` (Windows, un solo proceso) no bloquea"""
+    with open(path, "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def seed_demo_data():
     with get_conn() as con:
         cur = con.cursor()
+        # si no hay nutricionista, crear uno demo
         cur.execute("SELECT COUNT(1) FROM users WHERE role='nutritionist'")
         (c,) = cur.fetchone()
         if c == 0:
             cur.execute("INSERT INTO users (email,name,password_hash,role) VALUES (?,?,?,?)", ("pro@nutri.com","Nutricionista Pro", hash_password("nutri123"), "nutritionist"))
             con.commit()
-            # print("✅ Usuario nutricionista demo creado: pro@nutri.com / nutri123")
         # seed de reglas si vacío
         cur.execute("SELECT COUNT(1) FROM rules")
         (rc,) = cur.fetchone()
         if rc == 0:
-            base_rules = [
-                {   
-                    "id":"R1","name":"Bajo peso",
-                    "priority":20,
-                    "when":[{"fact":"bmi","op":"<","value":18.5}],
-                    "then":{
-                        "diagnosis":["Bajo peso"],
-                        "diet":{
-                            "kcal_target":{"method":"mifflin_st_jeor","surplus_pct":0.15},
-                            "macro_split":{"carb_pct":0.50,"prot_pct":0.20,"fat_pct":0.30},
-                            "advice":["Aumentar densidad calórica"],
-                            "restrictions":[]
-                        },
-                        "explain":"IMC < 18.5"
-                    }
-                },
-                {
-                    "id":"R2","name":"Sobrepeso",
-                    "priority":10,
-                    "when":[
-                        {"fact":"bmi","op":">=","value":25},
-                        {"fact":"bmi","op":"<","value":30}
-                    ],
-                    "then":{
-                        "diagnosis":["Sobrepeso"],
-                        "diet":{
-                            "kcal_target":{"method":"mifflin_st_jeor","deficit_pct":0.15},
-                            "macro_split":{"carb_pct":0.45,"prot_pct":0.25,"fat_pct":0.30},
-                            "advice":["Déficit moderado"],
-                            "restrictions":["bebidas_azucaradas"]
-                        },
-                        "explain":"IMC 25–29.9"
-                    }
-                },
-                {
-                    "id":"R3","name":"Obesidad",
-                    "priority":11,
-                    "when":[
-                        {"fact":"bmi","op":">=","value":30}
-                    ],
-                    "then":{
-                        "diagnosis":["Obesidad"],
-                        "diet":{
-                            "kcal_target":{"method":"mifflin_st_jeor","deficit_pct":0.20},
-                            "macro_split":{"carb_pct":0.40,"prot_pct":0.30,"fat_pct":0.30},
-                            "advice":["Más proteína y fibra"],
-                            "restrictions":["ultraprocesados"]
-                        },
-                        "explain":"IMC ≥ 30"
-                    }
-                },
-            ]
-            for r in base_rules:
+            for r in SEED_RULES:
                 save_rule(r)
-            print("✅ Reglas iniciales cargadas")
+            logger.info("✅ Reglas iniciales cargadas")
+
+
+def bootstrap() -> bool:
+    """Crea esquemas y datos iniciales si hace falta; devuelve si los creó este proceso"""
+    if _bootstrap_done():
+        return False
+    with _file_lock(BOOTSTRAP_LOCK_PATH):
+        if _bootstrap_done():
+            return False
+        init_db()
+        image_cache.init()
+        job_queue.init()
+        history.init()
+        rate_limiter.init()
+        simulation_store.init()
+        seed_demo_data()
+        with get_conn() as con:
+            con.execute(
+                "INSERT INTO meta (key,value) VALUES ('bootstrap_version',?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (BOOTSTRAP_VERSION,),
+            )
+    logger.info("✅ Base de datos inicializada (bootstrap v%d)", BOOTSTRAP_VERSION)
+    return True
+
+
+@app.on_event("startup")
+async def on_startup():
+    await run_in_threadpool(bootstrap)
+    if JOB_WORKERS > 0:
+        job_workers.start()
+    if HISTORY_ENABLED:
+        history.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Los trabajos a medias vuelven a la cola cuando vence su lease
+    await run_in_threadpool(job_workers.stop)
+    await run_in_threadpool(history.stop)
+    await run_in_threadpool(simulations.stop)
 
 # ---------- AUTH ENDPOINTS ----------
 @app.post("/auth/register", response_model=UserPublic)
 async def register(u: UserCreate):
     """Registra un nuevo usuario en el sistema"""
-    return create_user(u)
+    password_hash = await hash_password_async(u.password)
+    return await run_in_threadpool(create_user, u, password_hash)
 
 @app.post("/auth/login", response_model=Token)
-async def login(form: OAuth2PasswordRequestForm = Depends()):
+async def login(request: Request, form: OAuth2PasswordRequestForm = Depends()):
     """Inicia sesión y retorna un JWT token"""
-    print(f"🔐 Intento de login: {form.username}")
-    user = authenticate_user(form.username, form.password)
+    # Antes del hash: los intentos rechazados no consumen CPU
+    await run_in_threadpool(enforce_rate_limit, "login", request, form.username.strip().lower())
+    user = await authenticate_user(form.username, form.password)
     if not user:
-        print(f"❌ Login fallido para: {form.username}")
+        logger.info("❌ Login fallido", extra={"email": form.username})
         raise HTTPException(
             status_code=401,
             detail="Email o contraseña incorrectos",
@@ -443,14 +847,12 @@ async def login(form: OAuth2PasswordRequestForm = Depends()):
             "role": user["role"]
         }
     )
-    print(f"✅ Login exitoso para: {user['email']} (ID: {user['id']}, Rol: {user['role']})")
-    print(f"   Token generado (primeros 50 chars): {access_token[:50]}...")
+    logger.debug("✅ Login exitoso", extra={"user_id": user["id"], "role": user["role"]})
     return Token(access_token=access_token)
 
 @app.get("/auth/me", response_model=UserPublic)
 async def me(user: dict = Depends(get_current_user)):
     """Obtiene la información del usuario autenticado"""
-    print(f"✅ Usuario autenticado: {user.get('email')} (ID: {user.get('sub')})")
     return UserPublic(
         id=int(user["sub"]),  # ✅ Convertir de string a int
         email=user["email"], 
@@ -461,63 +863,917 @@ async def me(user: dict = Depends(get_current_user)):
 @app.get("/auth/test-token")
 async def test_token(token: str = Depends(oauth2_scheme)):
     """Endpoint de prueba para verificar que el token se recibe correctamente"""
-    print(f"🔍 Token recibido (primeros 20 chars): {token[:20]}...")
     return {"token_received": True, "token_preview": token[:50] + "..."}
 
 # ---------- RULES CRUD (nutricionista) ----------
+def chaining_errors(new_rules: List[Dict[str,Any]], current: List[Dict[str,Any]]) -> Dict[Any,str]:
+    """Errores de ``then.assert`` por id de regla: formato inválido o ciclo de encadenamiento"""
+    errors = {}
+    for r in new_rules:
+        assertion = r.get("then", {}).get("assert")
+        if assertion is not None and (not isinstance(assertion, dict) or not assertion):
+            errors[r["id"]] = "then.assert debe ser un objeto {hecho: valor}"
+    if not any(r.get("then", {}).get("assert") for r in new_rules):
+        return errors
+    ids = {r["id"] for r in new_rules}
+    rules = [r for r in current if r.get("id") not in ids] + [r for r in new_rules if r["id"] not in errors]
+    for cycle in find_assert_cycles(rules):
+        for rule_id in cycle:
+            if rule_id in ids:
+                errors.setdefault(rule_id, f"La regla crea un ciclo de encadenamiento entre: {', '.join(map(str, cycle))}")
+    return errors
+
+
+def check_conditions(rule: Dict[str,Any]):
+    """Compila el ``when`` de la regla: 400 si usa un operador desconocido"""
+    try:
+        compile_when(rule.get("when", []))
+    except UnknownOperatorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_chaining(rule: Dict[str,Any]):
+    """Valida ``then.assert`` y rechaza reglas que cierran un ciclo de encadenamiento"""
+    errors = chaining_errors([rule], rule_cache.get().rules)
+    if errors:
+        raise HTTPException(status_code=400, detail=errors[rule["id"]])
+
+RULES_GZIP_MIN_BYTES = 1024
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() == "gzip":
+            q = params.strip().lower()
+            try:
+                return not q.startswith("q=") or float(q[2:]) > 0
+            except ValueError:
+                return True
+    return False
+
+
 @app.get("/rules")
-async def get_rules():
-    return {"rules": load_rules()}
+async def get_rules(request: Request):
+    """Reglas serializadas una vez por generación; admite ``If-None-Match`` (304) y gzip"""
+    snapshot = await run_in_threadpool(rule_cache.get)
+    payload = snapshot.rules_payload or await run_in_threadpool(snapshot.payload)
+    use_gzip = len(payload.body) >= RULES_GZIP_MIN_BYTES and _accepts_gzip(request.headers.get("accept-encoding", ""))
+    etag = payload.etag_gzip if use_gzip else payload.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        if "*" in tags or payload.etag in tags or payload.etag_gzip in tags:
+            return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        body = payload.gzip_body or await run_in_threadpool(payload.gzipped)
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = payload.body
+    return Response(body, media_type="application/json", headers=headers)
 
 @app.post("/rules")
 async def add_rule(rule: Rule, _ = Depends(require_nutritionist)):
+    check_conditions(rule.model_dump())
+    await run_in_threadpool(check_chaining, rule.model_dump())
     try:
-        save_rule(rule.model_dump())
+        await run_in_threadpool(save_rule, rule.model_dump())
+        inference_cache.clear()
         return {"ok": True}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Rule ID already exists")
 
+# Las reglas válidas se guardan en memoria hasta la transacción final
+RULES_BULK_MAX_BYTES = int(float(os.getenv("RULES_BULK_MAX_MB", "16")) * 1024 * 1024)
+
+@app.post("/rules/bulk")
+async def bulk_import_rules(request: Request, strict: bool = False, _ = Depends(require_nutritionist)):
+    """Importa reglas en bloque desde un array JSON o NDJSON.
+
+    Cada entrada se valida con el modelo ``Rule`` mientras llega el cuerpo; las
+    válidas se insertan o reemplazan (por ``id``) en una única transacción y
+    los errores se devuelven por regla. En NDJSON una línea que no es JSON
+    válido es un error más de esa posición (con su número de ``line``); sólo
+    un array JSON mal formado corta la importación con 400. Con
+    ``strict=true`` no se escribe nada si alguna entrada es inválida. Los
+    cuerpos de más de ``RULES_BULK_MAX_MB`` se rechazan con 413 sin importar
+    nada.
+    """
+    content_type = request.headers.get("content-type", "")
+    ndjson = True if ("ndjson" in content_type or "jsonl" in content_type) else None
+    too_large = f"La importación supera el máximo de {RULES_BULK_MAX_BYTES // (1024*1024)} MB"
+    valid, positions, errors = [], {}, []
+    position = 0
+    try:
+        async for item in iter_json_stream(limited_stream(request, RULES_BULK_MAX_BYTES, too_large), ndjson):
+            if isinstance(item, InvalidItem):
+                errors.append({"index": position, "line": item.line, "id": None, "error": item.error})
+                position += 1
+                continue
+            rule_id = item.get("id") if isinstance(item, dict) else None
+            try:
+                rule = Rule.model_validate(item).model_dump()
+                compile_when(rule["when"])
+            except (ValidationError, UnknownOperatorError) as e:
+                errors.append({"index": position, "id": rule_id, "error": str(e)})
+            else:
+                if rule_id in positions:
+                    errors.append({"index": position, "id": rule_id, "error": f"ID duplicado en el lote (posición {positions[rule_id]})"})
+                else:
+                    positions[rule_id] = position
+                    valid.append(rule)
+            position += 1
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"message": f"JSON inválido: {e}", "index": position, "errors": errors})
+
+    snapshot = await run_in_threadpool(rule_cache.get)
+    rejected = chaining_errors(valid, snapshot.rules)
+    for rule_id, error in rejected.items():
+        errors.append({"index": positions[rule_id], "id": rule_id, "error": error})
+    errors.sort(key=lambda e: e["index"])
+    if strict and errors:
+        raise HTTPException(status_code=400, detail={"message": "Reglas inválidas: no se ha importado ninguna", "errors": errors})
+
+    valid = [r for r in valid if r["id"] not in rejected]
+    inserted = await run_in_threadpool(upsert_rules, valid) if valid else 0
+    if valid:
+        inference_cache.clear()
+    return {"imported": len(valid), "inserted": inserted, "updated": len(valid) - inserted, "errors": errors}
+
+@app.get("/rules/export")
+async def export_rules(format: str = "ndjson", _ = Depends(require_nutritionist)):
+    """Exporta todas las reglas en streaming (NDJSON o array JSON), reimportables con /rules/bulk"""
+    if format not in ("ndjson", "json"):
+        raise HTTPException(status_code=400, detail="format debe ser 'ndjson' o 'json'")
+    media_type = "application/json" if format == "json" else "application/x-ndjson"
+    return StreamingResponse(
+        iter_rules_export(format == "json"),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="rules.{format}"'},
+    )
+
 @app.put("/rules/{rule_id}")
 async def edit_rule(rule_id: str, rule: Rule, _ = Depends(require_nutritionist)):
     if rule_id != rule.id:
         raise HTTPException(status_code=400, detail="ID mismatch")
-    update_rule(rule.model_dump())
+    check_conditions(rule.model_dump())
+    await run_in_threadpool(check_chaining, rule.model_dump())
+    await run_in_threadpool(update_rule, rule.model_dump())
+    inference_cache.clear()
     return {"ok": True}
 
 @app.delete("/rules/{rule_id}")
 async def remove_rule(rule_id: str, _ = Depends(require_nutritionist)):
-    delete_rule(rule_id)
+    await run_in_threadpool(delete_rule, rule_id)
+    inference_cache.clear()
+    return {"ok": True}
+
+@app.get("/rules/stats")
+async def rules_stats(limit: int = 50, _ = Depends(require_nutritionist)):
+    """Reglas más costosas en /infer según el perfilado de este worker"""
+    snapshot = await run_in_threadpool(rule_cache.get)
+    report = rule_profiler.report(snapshot.index.key_conditions, limit=limit)
+    report["pid"] = os.getpid()
+    return report
+
+@app.post("/rules/stats/reset")
+async def reset_rules_stats(_ = Depends(require_nutritionist)):
+    rule_profiler.reset()
     return {"ok": True}
 
+# ---------- SIMULACIÓN DE BORRADORES ----------
+SIMULATION_RETRY_AFTER_SECONDS = 10
+
+
+def apply_rule_draft(current: List[Dict[str,Any]], draft: RuleDraft) -> List[Dict[str,Any]]:
+    """Reglas que resultarían de publicar el borrador; 400 con los errores por regla"""
+    existing = {r["id"] for r in current}
+    deleted = set(draft.delete)
+    upserts = [r.model_dump() for r in draft.upsert]
+    if not upserts and not deleted:
+        raise HTTPException(status_code=400, detail="El borrador no contiene cambios")
+    errors, seen = {}, set()
+    for rule_id in draft.delete:
+        if rule_id not in existing:
+            errors[rule_id] = "La regla no existe"
+    for rule in upserts:
+        if rule["id"] in seen:
+            errors.setdefault(rule["id"], "ID duplicado en el borrador")
+        elif rule["id"] in deleted:
+            errors.setdefault(rule["id"], "La regla se modifica y se elimina en el mismo borrador")
+        seen.add(rule["id"])
+        try:
+            compile_when(rule["when"])
+        except UnknownOperatorError as e:
+            errors.setdefault(rule["id"], str(e))
+    remaining = [r for r in current if r["id"] not in deleted]
+    for rule_id, error in chaining_errors(upserts, remaining).items():
+        errors.setdefault(rule_id, error)
+    if errors:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": "Borrador inválido", "errors": [{"id": k, "error": v} for k, v in errors.items()]},
+        )
+    return [r for r in remaining if r["id"] not in seen] + upserts
+
+
+def _parse_simulation_request(raw: bytes):
+    try:
+        body = SimulationRequest.model_validate_json(raw)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    population = [f.model_dump() for f in body.population] if body.population is not None else None
+    return body, population
+
+
+def _simulation_view(sim: dict) -> dict:
+    return {
+        "simulation_id": sim["id"],
+        "status": sim["status"],
+        "total": sim["total"],
+        "processed": sim["processed"],
+        "progress": round(sim["processed"] / sim["total"], 4) if sim["total"] else 1.0,
+        "cancel_requested": bool(sim["cancel_requested"]),
+        "result": sim["result"],
+        "error": sim["error"],
+        "created_at": sim["created_at"],
+        "updated_at": sim["updated_at"],
+    }
+
+
+async def _get_own_simulation(simulation_id: str, user: dict) -> dict:
+    sim = await run_in_threadpool(simulation_store.get, simulation_id)
+    if sim is None or sim["user"] != user["sub"]:
+        raise HTTPException(status_code=404, detail="Simulación no encontrada")
+    return sim
+
+
+def _simulations_busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Ya hay una simulación en curso en este servidor, inténtalo más tarde",
+        headers={"Retry-After": str(SIMULATION_RETRY_AFTER_SECONDS)},
+    )
+
+
+@app.post("/rules/simulations", status_code=202)
+async def create_rule_simulation(request: Request, user: dict = Depends(require_nutritionist)):
+    """Compara las reglas actuales con un borrador sobre una población de pacientes.
+
+    El cuerpo lleva ``draft`` (``upsert`` y ``delete``) y, opcionalmente,
+    ``population`` (lista de hechos); sin ella se usan los pacientes distintos
+    del historial de ``/infer`` de los últimos ``days`` días (hasta ``limit``).
+    La simulación se ejecuta en segundo plano: el progreso y el resumen de
+    diferencias se consultan en ``GET /rules/simulations/{id}``.
+    """
+    body, population = await run_in_threadpool(_parse_simulation_request, await request.body())
+    snapshot = await run_in_threadpool(rule_cache.get)
+    draft_rules = await run_in_threadpool(apply_rule_draft, snapshot.rules, body.draft)
+
+    if population is None:
+        await run_in_threadpool(history.flush)
+        limit = min(body.limit, SIMULATION_MAX_PATIENTS)
+        population = await run_in_threadpool(history.population, time.time() - body.days * 86400, limit)
+    if not population:
+        raise HTTPException(status_code=400, detail="No hay pacientes para simular")
+    if len(population) > SIMULATION_MAX_PATIENTS:
+        raise HTTPException(status_code=413, detail=f"La población supera el máximo de {SIMULATION_MAX_PATIENTS} pacientes")
+
+    await run_in_threadpool(simulation_store.purge)
+    sim_id = await run_in_threadpool(simulation_store.create, user["sub"], len(population), simulations.max_running)
+    if sim_id is None:
+        raise _simulations_busy()
+    simulations.start(sim_id, snapshot.rules, draft_rules, population)
+    return {
+        "simulation_id": sim_id,
+        "status": "queued",
+        "total": len(population),
+        "rules_generation": snapshot.generation,
+        "status_url": f"/rules/simulations/{sim_id}",
+    }
+
+
+@app.get("/rules/simulations/{simulation_id}")
+async def get_rule_simulation(simulation_id: str, user: dict = Depends(require_nutritionist)):
+    """Progreso de una simulación y, al terminar, el resumen de diferencias"""
+    return _simulation_view(await _get_own_simulation(simulation_id, user))
+
+
+@app.post("/rules/simulations/{simulation_id}/cancel", status_code=202)
+async def cancel_rule_simulation(simulation_id: str, user: dict = Depends(require_nutritionist)):
+    """Pide cancelar la simulación; se detiene al terminar el lote en curso"""
+    sim = await _get_own_simulation(simulation_id, user)
+    if sim["status"] in SIMULATION_FINISHED or not await run_in_threadpool(simulation_store.request_cancel, simulation_id):
+        raise HTTPException(status_code=409, detail="La simulación ya terminó")
+    return _simulation_view(await _get_own_simulation(simulation_id, user))
+
+
+@registry.collector
+def _simulation_metrics():
+    yield "# HELP nutriexpert_rule_simulations Simulaciones de borradores por estado (compartido entre workers)"
+    yield "# TYPE nutriexpert_rule_simulations gauge"
+    for status, n in simulation_store.counts().items():
+        yield f'nutriexpert_rule_simulations{{status="{status}"}} {n}'
+
+# ---------- CACHES ----------
+@app.get("/cache/stats")
+async def cache_stats(_ = Depends(require_nutritionist)):
+    """Tamaño y tasa de aciertos de las caches en memoria de este worker"""
+    return {"tokens": token_cache.stats(), "inference": inference_cache.stats()}
+
+def _in_memory_caches():
+    """Caches con contadores de aciertos, expuestas en /metrics"""
+    return {"tokens": token_cache, "inference": inference_cache, "images": image_cache}
+
+
+@registry.collector
+def _cache_metrics():
+    caches = _in_memory_caches()
+    for kind, attr in (("hits", "hits"), ("misses", "misses")):
+        yield f"# HELP nutriexpert_cache_{kind}_total {kind} de las caches de este worker"
+        yield f"# TYPE nutriexpert_cache_{kind}_total counter"
+        for name, cache in caches.items():
+            yield f'nutriexpert_cache_{kind}_total{{cache="{name}"}} {getattr(cache, attr)}'
+
 # ---------- INFERENCE ----------
 @app.post("/infer")
-async def do_infer(f: Facts):
-    """Ejecuta el motor de inferencia con los hechos proporcionados"""
-    return infer(f.model_dump(), load_rules())
+async def do_infer(f: Facts, _ = Depends(limit_infer)):
+    """Ejecuta el motor de inferencia con los hechos proporcionados.
+
+    Los resultados se memorizan por generación de reglas y hechos canónicos;
+    la cabecera ``X-Inference-Cache`` indica si vienen de la cache.
+    """
+    snapshot = await run_in_threadpool(rule_cache.get)
+    facts = f.model_dump()
+    key = (snapshot.generation, facts_key(facts))
+    cached = inference_cache.get(key)
+    if cached is None:
+        result = infer(facts, snapshot.index, rule_profiler)
+        body = fast_dumps(result)
+        inference_cache.set(key, (result, body))
+    else:
+        # La cache guarda también el JSON ya codificado
+        result, body = cached
+    if HISTORY_ENABLED:
+        history.record(facts, result)
+    INFERENCE_REQUESTS.inc(1, "infer")
+    INFERENCE_RULES_FIRED.inc(len(result["fired_rules"]), "infer")
+    return FastJSONResponse(body, headers={"X-Inference-Cache": "miss" if cached is None else "hit"})
     #       ⬆️              ⬆️          ⬆️
     #    Motor          Hechos    Base de conocimiento
 
+# ---------- ESTADÍSTICAS DE POBLACIÓN ----------
+# Se sirven desde las tablas de agregados; reflejan /infer con el retraso del
+# buffer de escritura (HISTORY_FLUSH_SECONDS).
+
+def _since_day(days: int) -> str:
+    if not 1 <= days <= 366:
+        raise HTTPException(status_code=400, detail="days debe estar entre 1 y 366")
+    return time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+
+
+@app.get("/stats/daily")
+async def stats_daily(days: int = 30, _ = Depends(require_nutritionist)):
+    """Inferencias, IMC medio y kcal objetivo media por día"""
+    return {"days": await run_in_threadpool(history.daily, _since_day(days))}
+
+
+@app.get("/stats/diagnoses")
+async def stats_diagnoses(days: int = 30, _ = Depends(require_nutritionist)):
+    """Número de diagnósticos por día"""
+    return {"diagnoses": await run_in_threadpool(history.diagnoses, _since_day(days))}
+
+
+@app.get("/stats/bmi")
+async def stats_bmi(days: int = 30, width: int = 1, _ = Depends(require_nutritionist)):
+    """Histograma de IMC de los pacientes evaluados (cubetas de ``width`` puntos)"""
+    if not 1 <= width <= 10:
+        raise HTTPException(status_code=400, detail="width debe estar entre 1 y 10")
+    return {"width": width, "histogram": await run_in_threadpool(history.bmi_histogram, _since_day(days), width)}
+
+
+@registry.collector
+def _history_metrics():
+    stats = history.stats()
+    yield "# HELP nutriexpert_history_pending Inferencias en el buffer del historial de este worker"
+    yield "# TYPE nutriexpert_history_pending gauge"
+    yield f"nutriexpert_history_pending {stats['pending']}"
+    for kind, text in (("written", "escritas en el historial"), ("dropped", "descartadas con el buffer lleno"),
+                       ("purged", "borradas del historial por antigüedad")):
+        yield f"# HELP nutriexpert_history_{kind}_total Inferencias {text} por este worker"
+        yield f"# TYPE nutriexpert_history_{kind}_total counter"
+        yield f"nutriexpert_history_{kind}_total {stats[kind]}"
+
+BATCH_CHUNK_SIZE = int(os.getenv("INFER_BATCH_CHUNK_SIZE", "2048"))
+# El lote se guarda entero antes de responder: límites de filas y de tamaño del cuerpo
+BATCH_MAX_ROWS = int(os.getenv("INFER_BATCH_MAX_ROWS", "100000"))
+BATCH_MAX_BYTES = int(float(os.getenv("INFER_BATCH_MAX_MB", "32")) * 1024 * 1024)
+
+
+def check_content_length(request: Request, max_bytes: int, detail: str):
+    """413 sin leer el cuerpo si ``Content-Length`` ya supera el máximo"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=detail)
+
+
+async def limited_stream(request: Request, max_bytes: int, detail: str):
+    """``request.stream()`` que corta con 413 en cuanto se superan ``max_bytes``.
+
+    Cubre los cuerpos sin ``Content-Length`` (``Transfer-Encoding: chunked``)
+    o con una longitud declarada falsa: se cuentan los bytes según llegan.
+    """
+    check_content_length(request, max_bytes, detail)
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise HTTPException(status_code=413, detail=detail)
+        yield chunk
+
+
+def limited_request(request: Request, max_bytes: int, detail: str) -> Request:
+    """Copia de ``request`` cuyo cuerpo corta con 413 al pasar de ``max_bytes``.
+
+    Para cuerpos que lee Starlette por su cuenta (p. ej. ``request.form()``):
+    los bytes se cuentan en cada mensaje ASGI, así que un multipart sin
+    ``Content-Length`` no llega a recibirse entero antes de rechazarlo.
+    """
+    check_content_length(request, max_bytes, detail)
+    receive, received = request.receive, 0
+
+    async def limited_receive():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise HTTPException(status_code=413, detail=detail)
+        return message
+
+    return Request(request.scope, limited_receive)
+
+@app.post("/infer/batch")
+async def do_infer_batch(request: Request, subject: Optional[str] = Depends(limit_infer_batch)):
+    """Inferencia por lotes: recibe un array JSON o NDJSON de hechos y responde NDJSON.
+
+    Cada línea de la respuesta es el resultado de ``infer()`` para la fila de la
+    misma posición, o ``{"index": i, "error": ...}`` si la fila no es válida.
+    Los lotes de más de ``INFER_BATCH_MAX_ROWS`` filas o ``INFER_BATCH_MAX_MB``
+    se rechazan con 413 antes de empezar a responder. El límite de peticiones
+    cuenta filas: la primera al llegar la petición y el resto al terminar de
+    leer el cuerpo, también antes de responder (429).
+    """
+    content_type = request.headers.get("content-type", "")
+    ndjson = True if ("ndjson" in content_type or "jsonl" in content_type) else None
+    index = (await run_in_threadpool(rule_cache.get)).index
+
+    def run_chunk(chunk):
+        from batch import infer_batch  # NumPy se importa con el primer lote
+        valid = [(i, f) for i, f in chunk if not isinstance(f, str)]
+        batch_results = infer_batch([f for _, f in valid], index)
+        INFERENCE_REQUESTS.inc(len(batch_results), "infer_batch")
+        INFERENCE_RULES_FIRED.inc(sum(len(r["fired_rules"]) for r in batch_results), "infer_batch")
+        results = iter(batch_results)
+        lines = []
+        for i, f in chunk:
+            out = {"index": i, "error": f} if isinstance(f, str) else next(results)
+            lines.append(json.dumps(out, ensure_ascii=False) + "\n")
+        return "".join(lines)
+
+    # El cuerpo se decodifica y valida fila a fila mientras llega (sin guardar el
+    # texto completo); la respuesta se emite por trozos a medida que se calculan.
+    too_large = f"El lote supera el máximo de {BATCH_MAX_ROWS} filas o {BATCH_MAX_BYTES // (1024*1024)} MB"
+    rows, error = [], None
+    try:
+        async for item in iter_json_stream(limited_stream(request, BATCH_MAX_BYTES, too_large), ndjson):
+            if len(rows) >= BATCH_MAX_ROWS:
+                raise HTTPException(status_code=413, detail=too_large)
+            if isinstance(item, InvalidItem):
+                rows.append((len(rows), item.error))
+                continue
+            try:
+                rows.append((len(rows), Facts.model_validate(item).model_dump()))
+            except ValidationError as e:
+                rows.append((len(rows), str(e)))
+    except ValueError as e:
+        error = {"index": len(rows), "error": f"JSON inválido: {e}"}
+    await run_in_threadpool(enforce_rate_limit, "infer_batch", request, subject, len(rows) - 1, len(rows))
+
+    async def generate():
+        for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+            yield await run_in_threadpool(run_chunk, rows[start:start + BATCH_CHUNK_SIZE])
+        if error:
+            # JSON mal formado: se informa como última línea del stream
+            yield json.dumps(error, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 # ---------- IMAGE ANALYSIS ----------
+# Las llamadas a Gemini son síncronas: se ejecutan en un pool de hilos propio
+# para no bloquear el event loop del worker, con un límite de concurrencia y
+# un timeout por llamada.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+GEMINI_RETRY_AFTER_SECONDS = int(os.getenv("GEMINI_RETRY_AFTER_SECONDS", "5"))
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024)
+# Margen del cuerpo multipart sobre la imagen: cabeceras de las partes y el prompt
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Cache de resultados (SQLite junto a rules.db)
+IMAGE_CACHE_PATH = os.getenv("IMAGE_CACHE_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "image_cache.db"))
+image_cache = ImageAnalysisCache(
+    IMAGE_CACHE_PATH,
+    ttl_seconds=float(os.getenv("IMAGE_CACHE_TTL_HOURS", "72")) * 3600,
+    max_bytes=int(float(os.getenv("IMAGE_CACHE_MAX_MB", "50")) * 1024 * 1024),
+)
+
+# Cola de análisis en segundo plano (SQLite junto a rules.db, ver jobs.py)
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "200"))
+JOB_EVENTS_POLL_SECONDS = float(os.getenv("JOB_EVENTS_POLL_SECONDS", "0.5"))
+job_queue = JobQueue(
+    JOBS_DB_PATH,
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "300")),
+    backoff_base=float(os.getenv("JOB_BACKOFF_SECONDS", "2")),
+    retention_seconds=float(os.getenv("JOB_RETENTION_HOURS", "24")) * 3600,
+)
+
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY, thread_name_prefix="gemini")
+# El cupo se libera cuando termina el hilo, no al expirar el timeout
+gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+
+def _generate_analysis(prompt: str, image_data: bytes) -> str:
+    """Llamada bloqueante a Gemini (se ejecuta en ``gemini_executor``).
+
+    ``image_data`` es la imagen ya normalizada con ``normalize_image``.
+    """
+    from PIL import Image
+    image = Image.open(BytesIO(image_data))
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        response = get_gemini_model().generate_content([prompt, image])
+        outcome = "ok"
+        return response.text
+    finally:
+        GEMINI_CALL_SECONDS.observe(time.perf_counter() - start, outcome)
+
+
+def _acquire_gemini_slot():
+    if not gemini_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiados análisis de imagen en curso, inténtalo más tarde",
+            headers={"Retry-After": str(GEMINI_RETRY_AFTER_SECONDS)},
+        )
+
+
+async def run_gemini(prompt: str, image_data: bytes) -> str:
+    """Ejecuta el análisis fuera del event loop respetando el cupo y el timeout"""
+    _acquire_gemini_slot()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(gemini_executor, _generate_analysis, prompt, image_data)
+    except BaseException:
+        gemini_slots.release()
+        raise
+    future.add_done_callback(lambda _: gemini_slots.release())
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), GEMINI_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="El análisis de la imagen tardó demasiado")
+
+
+async def analyze_normalized_image(prompt: str, image_data: bytes, user: dict) -> dict:
+    """Resultado desde la cache o, si no está, llamando a Gemini y guardándolo"""
+    analysis = await run_in_threadpool(image_cache.get, image_data, prompt)
+    cached = analysis is not None
+    if not cached:
+        analysis = await run_gemini(prompt, image_data)
+        await run_in_threadpool(image_cache.put, image_data, prompt, analysis)
+    return {
+        "success": True,
+        "analysis": analysis,
+        "cached": cached,
+        "user": user.get("email")
+    }
+
+
 @app.post("/analyze-image")
-async def analyze_image(request: ImageAnalysisRequest, user: dict = Depends(get_current_user)):
+async def analyze_image(request: ImageAnalysisRequest, user: dict = Depends(get_current_user), _ = Depends(limit_analyze)):
     """Analiza una imagen de comida y retorna información nutricional detallada"""
-    if not gemini_model:
-        raise HTTPException(status_code=503, detail="Servicio de análisis de imágenes no disponible")
+    await require_gemini()
     
     try:
-        # Decodificar la imagen base64
-        image_data = base64.b64decode(request.image_base64.split(',')[1] if ',' in request.image_base64 else request.image_base64)
-        image = Image.open(BytesIO(image_data))
-        
-        # Generar análisis con Gemini
-        contents = [request.prompt, image]
-        response = gemini_model.generate_content(contents)
+        # Decodificar la imagen base64 y reducirla antes de enviarla al modelo
+        raw = base64.b64decode(request.image_base64.split(',')[1] if ',' in request.image_base64 else request.image_base64)
+        image_data = await run_in_threadpool(normalize_image, raw)
+        del raw
         
-        return {
-            "success": True,
-            "analysis": response.text,
-            "user": user.get("email")
-        }
+        # Generar análisis con Gemini (o recuperarlo de la cache)
+        return await analyze_normalized_image(request.prompt, image_data, user)
+    except HTTPException:
+        raise
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        print(f"❌ Error analizando imagen: {e}")
-        raise HTTPException(status_code=500, detail=f"Error al analizar la imagen: {str(e)}")
\ No newline at end of file
+        logger.exception("❌ Error analizando imagen: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error al analizar la imagen: {str(e)}")
+
+
+async def read_image_upload(request: Request):
+    """Lee el multipart (``file``, ``prompt``) y devuelve el prompt y la imagen normalizada.
+
+    El tamaño se comprueba mientras llega el cuerpo (también sin
+    ``Content-Length``), sin esperar a tenerlo entero en el temporal.
+    """
+    too_large = f"La imagen supera el máximo de {MAX_UPLOAD_BYTES // (1024*1024)} MB"
+    request = limited_request(request, MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES, too_large)
+
+    async with request.form(max_files=1, max_fields=4, max_part_size=MULTIPART_OVERHEAD_BYTES) as form:
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=422, detail="Falta el archivo 'file'")
+        if upload.size is not None and upload.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=too_large)
+        prompt = form.get("prompt") or ImageAnalysisRequest.model_fields["prompt"].default
+        try:
+            image_data = await run_in_threadpool(normalize_image, upload.file)
+        except InvalidImageError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return prompt, image_data
+
+
+@app.post("/analyze-image/upload")
+async def analyze_image_upload(request: Request, user: dict = Depends(get_current_user), _ = Depends(limit_analyze)):
+    """Analiza una foto enviada como multipart/form-data (campos ``file`` y ``prompt``).
+
+    El archivo se recibe en un temporal (``SpooledTemporaryFile``) en lugar de
+    viajar en base64 dentro de un JSON, y se reduce antes de llamar al modelo.
+    """
+    await require_gemini()
+    prompt, image_data = await read_image_upload(request)
+    try:
+        return await analyze_normalized_image(prompt, image_data, user)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("❌ Error analizando imagen: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error al analizar la imagen: {str(e)}")
+
+
+def _stream_analysis(prompt: str, image_data: bytes, emit, cancelled: threading.Event, upstream: dict) -> Optional[str]:
+    """Llamada bloqueante a Gemini en streaming (se ejecuta en ``gemini_executor``).
+
+    Llama a ``emit(texto)`` por cada trozo recibido y devuelve el texto completo,
+    o ``None`` si el cliente se desconectó. ``upstream["response"]`` expone la
+    respuesta para poder cerrarla desde el event loop.
+    """
+    from PIL import Image
+    image = Image.open(BytesIO(image_data))
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        response = upstream["response"] = get_gemini_model().generate_content([prompt, image], stream=True)
+        parts = []
+        for chunk in response:
+            if cancelled.is_set():
+                break
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # trozo sin texto (p. ej. sólo metadatos de seguridad)
+            parts.append(text)
+            emit(text)
+        if cancelled.is_set():
+            outcome = "cancelled"
+            return None
+        outcome = "ok"
+        return "".join(parts)
+    except Exception:
+        if cancelled.is_set():
+            # La llamada cancelada lanza su error (CANCELLED) al seguir iterando
+            outcome = "cancelled"
+            return None
+        raise
+    finally:
+        GEMINI_CALL_SECONDS.observe(time.perf_counter() - start, outcome)
+
+
+def _close_upstream(upstream: dict):
+    """Cancela el stream de Gemini para que el hilo deje de esperar trozos.
+
+    ``GenerateContentResponse`` (google-generativeai 0.8) no tiene ``cancel()``
+    ni ``close()``: la llamada en curso es ``response._iterator``, el stream
+    gRPC, que se corta con ``cancel()`` (con transporte REST, ``close()``).
+    """
+    response = upstream.get("response")
+    if response is None:
+        return  # aún sin respuesta: el hilo ve ``cancelled`` al recibir el primer trozo
+    for target in (response, getattr(response, "_iterator", None)):
+        for name in ("cancel", "close"):
+            close = getattr(target, name, None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    logger.debug("No se pudo cerrar el stream de Gemini", exc_info=True)
+                return
+    logger.warning("⚠️ No se pudo cancelar el stream de Gemini (%s)", type(response).__name__)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.post("/analyze-image/stream")
+async def analyze_image_stream(request: Request, user: dict = Depends(get_current_user), _ = Depends(limit_analyze)):
+    """Analiza una foto (multipart ``file``, ``prompt``) y envía el texto por Server-Sent Events.
+
+    Emite un evento ``chunk`` por cada trozo que devuelve Gemini y un ``done``
+    final con el análisis completo (o ``error``). Si el cliente se desconecta
+    se cancela la llamada a Gemini y se libera su cupo.
+    """
+    await require_gemini()
+    # El cuerpo se lee entero antes de responder: StreamingResponse escucha la
+    # desconexión consumiendo los mensajes de ``receive``
+    prompt, image_data = await read_image_upload(request)
+
+    cached = await run_in_threadpool(image_cache.get, image_data, prompt)
+    if cached is not None:
+        async def replay():
+            yield _sse("done", {"analysis": cached, "cached": True, "user": user.get("email")})
+        return StreamingResponse(replay(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    _acquire_gemini_slot()
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    cancelled, upstream = threading.Event(), {}
+    emit = lambda text: loop.call_soon_threadsafe(queue.put_nowait, text)
+    try:
+        future = loop.run_in_executor(gemini_executor, _stream_analysis, prompt, image_data, emit, cancelled, upstream)
+    except BaseException:
+        gemini_slots.release()
+        raise
+    future.add_done_callback(lambda _: gemini_slots.release())
+    future.add_done_callback(lambda _: queue.put_nowait(None))
+
+    async def events():
+        deadline = loop.time() + GEMINI_TIMEOUT_SECONDS
+        try:
+            while True:
+                try:
+                    text = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    yield _sse("error", {"detail": "El análisis de la imagen tardó demasiado"})
+                    return
+                if text is not None:
+                    yield _sse("chunk", {"text": text})
+                    continue
+                try:
+                    analysis = future.result()
+                except Exception as e:
+                    logger.exception("❌ Error analizando imagen: %s", e)
+                    yield _sse("error", {"detail": f"Error al analizar la imagen: {str(e)}"})
+                    return
+                await run_in_threadpool(image_cache.put, image_data, prompt, analysis)
+                yield _sse("done", {"analysis": analysis, "cached": False, "user": user.get("email")})
+                return
+        finally:
+            if not future.done():
+                # Desconexión del cliente o timeout: cortar la llamada a Gemini
+                cancelled.set()
+                _close_upstream(upstream)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# ---------- ANÁLISIS EN SEGUNDO PLANO ----------
+# Los trabajos los consume un pool de hilos de cada worker (JOB_WORKERS=0 para
+# sólo encolar). Esas llamadas no ocupan el cupo de las peticiones síncronas.
+
+def _run_analysis_job(prompt: str, image_data: bytes) -> str:
+    """Handler de la cola: resultado desde la cache o llamando al modelo"""
+    if get_gemini_model() is None:
+        raise PermanentJobError("Servicio de análisis de imágenes no disponible")
+    analysis = image_cache.get(image_data, prompt)
+    if analysis is None:
+        analysis = _generate_analysis(prompt, image_data)
+        image_cache.put(image_data, prompt, analysis)
+    return analysis
+
+
+job_workers = JobWorkerPool(job_queue, _run_analysis_job, workers=JOB_WORKERS,
+                            poll_interval=float(os.getenv("JOB_POLL_SECONDS", "1.0")))
+
+
+def _job_view(job: dict) -> dict:
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "analysis": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
+async def _get_own_job(job_id: str, user: dict) -> dict:
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if job is None or job["user"] != user["sub"]:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+
+@app.post("/analyze-image/jobs", status_code=202)
+async def create_analysis_job(request: Request, user: dict = Depends(get_current_user), _ = Depends(limit_analyze)):
+    """Encola el análisis de una foto (multipart ``file``, ``prompt``) y devuelve el id del trabajo.
+
+    El resultado se consulta en ``GET /analyze-image/jobs/{id}`` o se espera
+    con ``GET /analyze-image/jobs/{id}/events`` (Server-Sent Events).
+    """
+    await require_gemini()
+    if await run_in_threadpool(job_queue.pending) >= JOB_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiados análisis en cola, inténtalo más tarde",
+            headers={"Retry-After": str(GEMINI_RETRY_AFTER_SECONDS)},
+        )
+    prompt, image_data = await read_image_upload(request)
+    cached = await run_in_threadpool(image_cache.get, image_data, prompt)
+    job_id = await run_in_threadpool(job_queue.enqueue, user["sub"], prompt, image_data, cached)
+    if cached is None:
+        job_workers.notify()
+    return {
+        "job_id": job_id,
+        "status": DONE if cached is not None else "queued",
+        "status_url": f"/analyze-image/jobs/{job_id}",
+        "events_url": f"/analyze-image/jobs/{job_id}/events",
+    }
+
+
+@app.get("/analyze-image/jobs/{job_id}")
+async def get_analysis_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Estado de un trabajo de análisis (``queued``, ``running``, ``done`` o ``failed``)"""
+    return _job_view(await _get_own_job(job_id, user))
+
+
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+
+@app.get("/analyze-image/jobs/{job_id}/events")
+async def analysis_job_events(job_id: str, user: dict = Depends(get_current_user)):
+    """Sigue un trabajo por Server-Sent Events.
+
+    Emite ``status`` en cada cambio de estado o de intento y termina con
+    ``done`` (incluye el análisis) o ``error``. El estado se lee de SQLite, así
+    que funciona aunque el trabajo lo procese otro worker.
+    """
+    await _get_own_job(job_id, user)
+    loop = asyncio.get_running_loop()
+
+    async def events():
+        last, last_sent = None, loop.time()
+        while True:
+            job = await run_in_threadpool(job_queue.get, job_id)
+            if job is None:
+                yield _sse("error", {"job_id": job_id, "detail": "Trabajo no encontrado"})
+                return
+            view = _job_view(job)
+            if job["status"] == DONE:
+                yield _sse("done", view)
+                return
+            if job["status"] == FAILED:
+                yield _sse("error", {**view, "detail": f"Error al analizar la imagen: {job['error']}"})
+                return
+            if (job["status"], job["attempts"]) != last:
+                last, last_sent = (job["status"], job["attempts"]), loop.time()
+                yield _sse("status", view)
+            elif loop.time() - last_sent >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                last_sent = loop.time()
+                yield ": keepalive\n\n"
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@registry.collector
+def _job_metrics():
+    yield "# HELP nutriexpert_analysis_jobs Trabajos de análisis por estado (compartido entre workers)"
+    yield "# TYPE nutriexpert_analysis_jobs gauge"
+    for status, n in job_queue.counts().items():
+        yield f'nutriexpert_analysis_jobs{{status="{status}"}} {n}'
+
+
+@app.get("/analyze-image/cache/stats")
+async def image_cache_stats(_ = Depends(get_current_user)):
+    """Contadores de aciertos y fallos de la cache de análisis de imágenes"""
+    return await run_in_threadpool(image_cache.stats)
@@ -0,0 +1,193 @@
+"""Métricas en memoria con exposición en formato texto de Prometheus.
+
+Contadores e histogramas mínimos (sin dependencias) pensados para el camino
+caliente: registrar una observación cuesta un ``bisect`` y un incremento bajo un
+lock sin contención. Las métricas son por worker; cada proceso de gunicorn
+expone las suyas con la etiqueta ``pid`` en ``nutriexpert_worker_info``.
+"""
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# Buckets en segundos: de 0.5 ms a 30 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [contadores por bucket..., +Inf, suma]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return int(sum(series[:-1])) if series else 0
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = f'le="{le}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le_label)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-1]}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Registra una función que devuelve líneas ya formateadas (gauges calculados al vuelo)"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = [
+            "# HELP nutriexpert_worker_info Worker que atiende el scrape",
+            "# TYPE nutriexpert_worker_info gauge",
+            f'nutriexpert_worker_info{{pid="{os.getpid()}"}} 1',
+        ]
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for fn in self._collectors:
+            lines.extend(fn())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "nutriexpert_http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta", ("method", "route", "status"))
+INFERENCE_REQUESTS = registry.counter(
+    "nutriexpert_inference_requests_total", "Pacientes evaluados por el motor de inferencia", ("endpoint",))
+INFERENCE_RULES_FIRED = registry.counter(
+    "nutriexpert_inference_rules_fired_total", "Reglas disparadas por el motor de inferencia", ("endpoint",))
+DB_CALL_SECONDS = registry.histogram(
+    "nutriexpert_db_call_duration_seconds", "Duración de las operaciones de base de datos", ("operation",))
+GEMINI_CALL_SECONDS = registry.histogram(
+    "nutriexpert_gemini_call_duration_seconds", "Duración de las llamadas a Gemini", ("outcome",))
+RATE_LIMITED = registry.counter(
+    "nutriexpert_rate_limited_total", "Peticiones rechazadas con 429 por el limitador", ("scope",))
+JOBS_PROCESSED = registry.counter(
+    "nutriexpert_analysis_jobs_total", "Intentos de trabajos de análisis de imagen por resultado", ("outcome",))
+RULE_SIMULATIONS = registry.counter(
+    "nutriexpert_rule_simulations_total", "Simulaciones de borradores de reglas terminadas por resultado", ("outcome",))
+
+
+def timed(histogram: Histogram, *labels: str):
+    """Decorador que registra la duración de la función en ``histogram``"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Middleware ASGI que mide la latencia por plantilla de ruta (``/rules/{rule_id}``).
+
+    Es ASGI puro (no ``BaseHTTPMiddleware``) para no añadir una tarea ni copiar
+    la respuesta en cada petición.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status[0]),
+            )
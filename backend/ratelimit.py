@@ -0,0 +1,131 @@
+"""Límites de peticiones por usuario e IP compartidos entre workers.
+
+Cubetas de tokens (token bucket) guardadas en SQLite: cada worker de gunicorn
+lee y actualiza las mismas cubetas, sin Redis ni otro servicio. Una
+comprobación es una transacción corta ``BEGIN IMMEDIATE`` que lee las cubetas
+de la petición, las rellena según el tiempo transcurrido y sólo si todas
+alcanzan escribe el consumo en cada una: una petición rechazada por una cubeta
+no gasta el cupo de las demás.
+
+Un límite se escribe ``capacidad/segundos``: ``120/60`` permite ráfagas de 120
+peticiones y recupera 2 por segundo. ``0`` o vacío desactiva ese límite.
+
+Una cubeta sin uso durante más que el mayor tiempo de rellenado está llena y
+equivale a no tenerla: cada worker borra esas filas cada ``purge_interval``
+segundos para que la tabla no crezca con claves que no vuelven.
+"""
+import logging
+import math
+import time
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from db import ConnectionPool
+
+logger = logging.getLogger("nutriexpert.ratelimit")
+
+
+class Limit(NamedTuple):
+    capacity: float
+    rate: float  # tokens por segundo
+
+    @property
+    def refill_seconds(self) -> float:
+        return self.capacity / self.rate
+
+
+def parse_limit(spec: Optional[str]) -> Optional[Limit]:
+    """``"120/60"`` → ``Limit(120, 2.0)``; ``None`` si está desactivado"""
+    spec = (spec or "").strip()
+    if spec in ("", "0"):
+        return None
+    try:
+        capacity, seconds = (float(x) for x in spec.split("/"))
+    except ValueError:
+        raise RuntimeError(f"❌ Límite de peticiones inválido: {spec!r} (formato capacidad/segundos)")
+    if capacity <= 0 or seconds <= 0:
+        return None
+    return Limit(capacity, capacity / seconds)
+
+
+_SELECT_SQL = "SELECT tokens, updated FROM rate_buckets WHERE key=?"
+
+_UPSERT_SQL = """
+INSERT INTO rate_buckets (key, tokens, updated, allowed) VALUES (?, ?, ?, 1)
+ON CONFLICT(key) DO UPDATE SET tokens=excluded.tokens, updated=excluded.updated, allowed=1
+"""
+
+
+class RateLimiter:
+    """Cubetas de tokens en SQLite; ``take()`` devuelve 0 si se admite o los segundos a esperar"""
+
+    def __init__(self, path: str, max_idle_seconds: float = 3600.0, purge_interval: float = 60.0):
+        self.path = path
+        self.max_idle_seconds = max_idle_seconds
+        self.purge_interval = purge_interval
+        self._pool = ConnectionPool(path)
+        self._next_purge = 0.0
+
+    def _conn(self):
+        return self._pool.connection()
+
+    def init(self):
+        with self._conn() as con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                  key TEXT PRIMARY KEY,
+                  tokens REAL NOT NULL,
+                  updated REAL NOT NULL,
+                  allowed INTEGER NOT NULL
+                )
+                """
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS idx_rate_buckets_updated ON rate_buckets (updated)")
+
+    def take(self, buckets: Iterable[Tuple[str, Limit]], cost: float = 1.0) -> float:
+        """Consume ``cost`` de cada cubeta si todas alcanzan; si no, no consume de
+        ninguna y devuelve la mayor espera.
+
+        Si SQLite falla se admite la petición: el limitador no debe tumbar la API.
+        """
+        now = time.time()
+        retry_after = 0.0
+        refilled = []
+        try:
+            with self._conn() as con:
+                # Bloqueo de escritura desde la lectura: otro worker no puede
+                # consumir de estas cubetas entre la comprobación y el cobro
+                con.execute("BEGIN IMMEDIATE")
+                for key, limit in buckets:
+                    self.max_idle_seconds = max(self.max_idle_seconds, limit.refill_seconds)
+                    row = con.execute(_SELECT_SQL, (key,)).fetchone()
+                    tokens, updated = row if row else (limit.capacity, now)
+                    tokens = min(limit.capacity, tokens + max(0.0, now - updated) * limit.rate)
+                    if tokens < cost:
+                        retry_after = max(retry_after, (cost - tokens) / limit.rate)
+                    refilled.append((key, tokens, max(updated, now)))
+                if retry_after == 0:
+                    con.executemany(_UPSERT_SQL, [(key, tokens - cost, updated) for key, tokens, updated in refilled])
+                if now >= self._next_purge:
+                    self._next_purge = now + self.purge_interval
+                    self._purge(con, now)
+        except Exception:
+            logger.exception("❌ Error en el limitador de peticiones; se admite la petición")
+            return 0.0
+        return retry_after
+
+    def _purge(self, con, now: float) -> int:
+        return con.execute("DELETE FROM rate_buckets WHERE updated<?", (now - self.max_idle_seconds,)).rowcount
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Borra las cubetas sin uso desde hace ``max_idle_seconds``; devuelve cuántas"""
+        with self._conn() as con:
+            return self._purge(con, time.time() if now is None else now)
+
+    def reset(self):
+        with self._conn() as con:
+            con.execute("DELETE FROM rate_buckets")
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
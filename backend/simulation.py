@@ -0,0 +1,456 @@
+"""Simulación de borradores de reglas sobre una población de pacientes.
+
+Antes de publicar cambios en las reglas, ``POST /rules/simulations`` evalúa las
+reglas actuales y el borrador sobre la misma población (subida en la petición
+o tomada del historial de ``/infer``) y resume qué cambiaría: reglas que pasan
+a dispararse o dejan de hacerlo, diagnósticos ganados y perdidos y la
+distribución del cambio de kcal objetivo.
+
+La población se reparte en lotes de ``shard_size`` pacientes que se evalúan en
+un ``ProcessPoolExecutor`` (``infer()`` con el ``RuleIndex`` de cada base de
+reglas, igual que ``/infer``), de modo que la simulación usa todos los núcleos
+sin ocupar el event loop ni el GIL del worker. Cada lote devuelve un resumen
+parcial y el worker los va sumando. El estado, el progreso y la petición de cancelación se guardan en
+SQLite (``SimulationStore``), así que cualquier worker de gunicorn puede
+consultar o cancelar una simulación que ejecuta otro.
+
+Las dos bases de reglas se serializan una vez por simulación y se guardan en
+SQLite junto a su estado: a los procesos sólo viajan los pacientes del lote y
+la clave de cada base, y cada proceso lee las reglas la primera vez que las
+necesita. El máximo de simulaciones simultáneas también se comprueba en SQLite
+al crearlas, así que vale para todo el servidor y no para cada worker.
+"""
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+from db import ConnectionPool
+from metrics import RULE_SIMULATIONS
+
+logger = logging.getLogger("nutriexpert.simulation")
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+KCAL_BUCKET_WIDTH = 50
+MAX_EXAMPLES = 20
+
+_PUBLIC_COLUMNS = "id, user, status, total, processed, cancel_requested, result, error, created_at, updated_at"
+
+
+# ---------- EVALUACIÓN (procesos del pool) ----------
+
+def rules_key(rules_json: bytes) -> str:
+    return hashlib.sha1(rules_json).hexdigest()
+
+
+# Índices ya construidos en este proceso: todos los lotes de una simulación
+# comparten las mismas dos bases de reglas
+_INDEXES: "OrderedDict[str, Any]" = OrderedDict()
+
+
+def _load_rules(store_path: str, sim_id: str, column: str) -> bytes:
+    con = sqlite3.connect(store_path)
+    try:
+        row = con.execute(f"SELECT {column} FROM rule_simulations WHERE id=?", (sim_id,)).fetchone()
+    finally:
+        con.close()
+    if row is None or row[0] is None:
+        raise RuntimeError(f"Las reglas de la simulación {sim_id} ya no están disponibles")
+    return row[0]
+
+
+def _index(store_path: str, sim_id: str, column: str, key: str):
+    from engine import RuleIndex
+    index = _INDEXES.get(key)
+    if index is None:
+        index = _INDEXES[key] = RuleIndex(json.loads(_load_rules(store_path, sim_id, column)))
+        while len(_INDEXES) > 4:
+            _INDEXES.popitem(last=False)
+    return index
+
+
+def evaluate_shard(store_path: str, sim_id: str, keys: tuple, start: int, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Evalúa un lote con ambas bases de reglas y devuelve su resumen parcial.
+
+    ``keys`` son las claves (``rules_key``) de las reglas actuales y del
+    borrador; si el proceso aún no tiene su ``RuleIndex``, las lee de la
+    simulación ``sim_id`` en ``store_path``.
+    """
+    from engine import infer
+    current_index = _index(store_path, sim_id, "current_rules", keys[0])
+    draft_index = _index(store_path, sim_id, "draft_rules", keys[1])
+    before = [infer(row, current_index) for row in rows]
+    after = [infer(row, draft_index) for row in rows]
+    return diff_results(start, before, after)
+
+
+def empty_summary() -> Dict[str, Any]:
+    return {
+        "patients": 0,
+        "changed": 0,
+        "diagnosis_changed": 0,
+        "kcal_changed": 0,
+        "kcal_target_added": 0,
+        "kcal_target_removed": 0,
+        "rules_newly_fired": Counter(),
+        "rules_no_longer_fired": Counter(),
+        "diagnoses_gained": Counter(),
+        "diagnoses_lost": Counter(),
+        "kcal_delta_buckets": Counter(),
+        "kcal_delta_sum": 0,
+        "kcal_delta_min": None,
+        "kcal_delta_max": None,
+        "examples": [],
+    }
+
+
+def diff_results(start: int, before: List[Dict[str, Any]], after: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Resumen de diferencias entre dos listas de resultados de ``infer()`` para los mismos pacientes"""
+    s = empty_summary()
+    s["patients"] = len(before)
+    for i, (b, a) in enumerate(zip(before, after)):
+        fired_b = {r["id"] for r in b["fired_rules"]}
+        fired_a = {r["id"] for r in a["fired_rules"]}
+        diag_b, diag_a = set(b["diagnosis"]), set(a["diagnosis"])
+        kcal_b, kcal_a = b["plan"].get("kcal_target"), a["plan"].get("kcal_target")
+
+        s["rules_newly_fired"].update(fired_a - fired_b)
+        s["rules_no_longer_fired"].update(fired_b - fired_a)
+        s["diagnoses_gained"].update(diag_a - diag_b)
+        s["diagnoses_lost"].update(diag_b - diag_a)
+        if diag_a != diag_b:
+            s["diagnosis_changed"] += 1
+        if kcal_b is None and kcal_a is not None:
+            s["kcal_target_added"] += 1
+        elif kcal_b is not None and kcal_a is None:
+            s["kcal_target_removed"] += 1
+        elif kcal_b is not None and kcal_a != kcal_b:
+            delta = kcal_a - kcal_b
+            s["kcal_changed"] += 1
+            s["kcal_delta_buckets"][math.floor(delta / KCAL_BUCKET_WIDTH) * KCAL_BUCKET_WIDTH] += 1
+            s["kcal_delta_sum"] += delta
+            s["kcal_delta_min"] = delta if s["kcal_delta_min"] is None else min(s["kcal_delta_min"], delta)
+            s["kcal_delta_max"] = delta if s["kcal_delta_max"] is None else max(s["kcal_delta_max"], delta)
+
+        if b["diagnosis"] != a["diagnosis"] or b["plan"] != a["plan"] or fired_a != fired_b:
+            s["changed"] += 1
+            if len(s["examples"]) < MAX_EXAMPLES:
+                s["examples"].append({
+                    "index": start + i,
+                    "diagnosis": {"current": b["diagnosis"], "draft": a["diagnosis"]},
+                    "kcal_target": {"current": kcal_b, "draft": kcal_a},
+                    "fired_rules": {"current": sorted(fired_b, key=str), "draft": sorted(fired_a, key=str)},
+                })
+    return s
+
+
+def merge_summary(total: Dict[str, Any], part: Dict[str, Any]):
+    """Suma un resumen parcial sobre ``total`` (en el sitio)"""
+    for key in ("patients", "changed", "diagnosis_changed", "kcal_changed", "kcal_target_added",
+                "kcal_target_removed", "kcal_delta_sum"):
+        total[key] += part[key]
+    for key in ("rules_newly_fired", "rules_no_longer_fired", "diagnoses_gained", "diagnoses_lost", "kcal_delta_buckets"):
+        total[key].update(part[key])
+    for key, pick in (("kcal_delta_min", min), ("kcal_delta_max", max)):
+        if part[key] is not None:
+            total[key] = part[key] if total[key] is None else pick(total[key], part[key])
+    room = MAX_EXAMPLES - len(total["examples"])
+    if room > 0:
+        total["examples"].extend(part["examples"][:room])
+
+
+def finalize_summary(s: Dict[str, Any]) -> Dict[str, Any]:
+    """Resumen listo para JSON: contadores ordenados por frecuencia y ejemplos por posición"""
+    def ranked(counter):
+        return [{"id": k, "patients": n} for k, n in sorted(counter.items(), key=lambda kv: (-kv[1], str(kv[0])))]
+
+    def ranked_diagnoses(counter):
+        return [{"diagnosis": k, "patients": n} for k, n in sorted(counter.items(), key=lambda kv: (-kv[1], kv[0]))]
+
+    n = s["kcal_changed"]
+    return {
+        "patients": s["patients"],
+        "changed": s["changed"],
+        "diagnosis_changed": s["diagnosis_changed"],
+        "rules_newly_fired": ranked(s["rules_newly_fired"]),
+        "rules_no_longer_fired": ranked(s["rules_no_longer_fired"]),
+        "diagnoses_gained": ranked_diagnoses(s["diagnoses_gained"]),
+        "diagnoses_lost": ranked_diagnoses(s["diagnoses_lost"]),
+        "kcal_target": {
+            "changed": n,
+            "added": s["kcal_target_added"],
+            "removed": s["kcal_target_removed"],
+            "delta_mean": round(s["kcal_delta_sum"] / n, 1) if n else None,
+            "delta_min": s["kcal_delta_min"],
+            "delta_max": s["kcal_delta_max"],
+            # Sólo pacientes cuyo kcal objetivo cambia
+            "delta_histogram": [
+                {"delta_from": b, "delta_to": b + KCAL_BUCKET_WIDTH, "patients": c}
+                for b, c in sorted(s["kcal_delta_buckets"].items())
+            ],
+        },
+        "examples": sorted(s["examples"], key=lambda e: e["index"])[:MAX_EXAMPLES],
+    }
+
+
+# ---------- ESTADO COMPARTIDO (SQLite) ----------
+
+class SimulationStore:
+    """Estado y progreso de las simulaciones, compartido entre workers.
+
+    Estados: ``queued`` → ``running`` → ``done`` | ``failed`` | ``cancelled``.
+    Una simulación ``running`` cuyo progreso no se actualiza en
+    ``stale_seconds`` (el worker que la ejecutaba murió) se marca ``failed``
+    al consultarla o al crear otra. Las reglas de una simulación en curso se
+    guardan en ``current_rules``/``draft_rules`` y se borran al terminar.
+    """
+
+    def __init__(self, path: str, stale_seconds: float = 120, retention_seconds: float = 86400):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = retention_seconds
+        self._pool = ConnectionPool(path)
+
+    def _conn(self):
+        return self._pool.connection()
+
+    def init(self):
+        with self._conn() as con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rule_simulations (
+                  id TEXT PRIMARY KEY,
+                  user TEXT NOT NULL,
+                  status TEXT NOT NULL,
+                  total INTEGER NOT NULL,
+                  processed INTEGER NOT NULL DEFAULT 0,
+                  cancel_requested INTEGER NOT NULL DEFAULT 0,
+                  result TEXT,
+                  error TEXT,
+                  current_rules BLOB,
+                  draft_rules BLOB,
+                  created_at REAL NOT NULL,
+                  updated_at REAL NOT NULL
+                )
+                """
+            )
+            columns = {row[1] for row in con.execute("PRAGMA table_info(rule_simulations)")}
+            for column in ("current_rules", "draft_rules"):
+                if column not in columns:  # bases creadas antes de guardar las reglas con la simulación
+                    con.execute(f"ALTER TABLE rule_simulations ADD COLUMN {column} BLOB")
+            con.execute("CREATE INDEX IF NOT EXISTS idx_rule_simulations_status ON rule_simulations (status, updated_at)")
+
+    def _expire_stale(self, con, now: float, sim_id: Optional[str] = None):
+        """Marca ``failed`` las simulaciones sin latido en ``stale_seconds`` (una o todas)"""
+        con.execute(
+            "UPDATE rule_simulations SET status=?, error=?, current_rules=NULL, draft_rules=NULL, updated_at=? "
+            "WHERE status IN (?,?) AND updated_at<?" + (" AND id=?" if sim_id else ""),
+            (FAILED, "Simulación interrumpida: el worker que la ejecutaba terminó", now,
+             QUEUED, RUNNING, now - self.stale_seconds) + ((sim_id,) if sim_id else ()),
+        )
+
+    def create(self, user: str, total: int, max_running: int = 0) -> Optional[str]:
+        """Crea la simulación en ``queued`` y devuelve su id.
+
+        Con ``max_running`` devuelve ``None`` si ya hay esas simulaciones en
+        curso en el servidor, sumando las de todos los workers: la cuenta y el
+        alta van en la misma transacción ``BEGIN IMMEDIATE``.
+        """
+        sim_id = uuid.uuid4().hex
+        now = time.time()
+        with self._conn() as con:
+            con.execute("BEGIN IMMEDIATE")
+            self._expire_stale(con, now)
+            if max_running > 0:
+                (active,) = con.execute(
+                    "SELECT COUNT(1) FROM rule_simulations WHERE status IN (?,?)", (QUEUED, RUNNING)
+                ).fetchone()
+                if active >= max_running:
+                    return None
+            con.execute(
+                "INSERT INTO rule_simulations (id,user,status,total,created_at,updated_at) VALUES (?,?,?,?,?,?)",
+                (sim_id, user, QUEUED, total, now, now),
+            )
+        return sim_id
+
+    def save_rules(self, sim_id: str, current_rules: bytes, draft_rules: bytes):
+        """Guarda las reglas serializadas que leen los procesos del pool"""
+        with self._conn() as con:
+            con.execute(
+                "UPDATE rule_simulations SET current_rules=?, draft_rules=? WHERE id=?",
+                (current_rules, draft_rules, sim_id),
+            )
+
+    def progress(self, sim_id: str, processed: int, status: str = RUNNING) -> bool:
+        """Guarda el progreso (sirve de latido) y devuelve si se pidió cancelar"""
+        with self._conn() as con:
+            row = con.execute(
+                "UPDATE rule_simulations SET status=?, processed=?, updated_at=? WHERE id=? RETURNING cancel_requested",
+                (status, processed, time.time(), sim_id),
+            ).fetchone()
+        return bool(row and row[0])
+
+    def finish(self, sim_id: str, status: str, processed: int, result: Optional[dict] = None, error: Optional[str] = None):
+        with self._conn() as con:
+            con.execute(
+                "UPDATE rule_simulations SET status=?, processed=?, result=?, error=?, current_rules=NULL, draft_rules=NULL, "
+                "updated_at=? WHERE id=?",
+                (status, processed, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, time.time(), sim_id),
+            )
+
+    def request_cancel(self, sim_id: str) -> bool:
+        """Marca la simulación para cancelar; ``False`` si ya había terminado"""
+        with self._conn() as con:
+            cur = con.execute(
+                "UPDATE rule_simulations SET cancel_requested=1, updated_at=? WHERE id=? AND status IN (?,?)",
+                (time.time(), sim_id, QUEUED, RUNNING),
+            )
+            return cur.rowcount > 0
+
+    def get(self, sim_id: str) -> Optional[Dict[str, Any]]:
+        with self._conn() as con:
+            self._expire_stale(con, time.time(), sim_id)
+            cur = con.execute(f"SELECT {_PUBLIC_COLUMNS} FROM rule_simulations WHERE id=?", (sim_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            sim = dict(zip((d[0] for d in cur.description), row))
+        sim["result"] = json.loads(sim["result"]) if sim["result"] else None
+        return sim
+
+    def counts(self) -> Dict[str, int]:
+        with self._conn() as con:
+            rows = con.execute("SELECT status, COUNT(1) FROM rule_simulations GROUP BY status").fetchall()
+        return {status: 0 for status in (QUEUED, RUNNING, *FINISHED)} | dict(rows)
+
+    def purge(self) -> int:
+        """Borra las simulaciones terminadas hace más de ``retention_seconds``"""
+        with self._conn() as con:
+            cur = con.execute(
+                "DELETE FROM rule_simulations WHERE status IN (?,?,?) AND updated_at<?",
+                (*FINISHED, time.time() - self.retention_seconds),
+            )
+            return cur.rowcount
+
+
+# ---------- EJECUCIÓN ----------
+
+class SimulationRunner:
+    """Ejecuta simulaciones en un pool de procesos compartido por el worker.
+
+    Cada simulación la coordina un hilo que mantiene como mucho
+    ``2 * processes`` lotes en vuelo, suma los resúmenes parciales a medida que
+    llegan y, tras cada lote, guarda el progreso y comprueba si se pidió
+    cancelar. Con ``processes=0`` los lotes se evalúan en el propio hilo (sin
+    procesos hijos). ``max_running`` es el máximo de simulaciones simultáneas
+    en todo el servidor: se aplica al crearlas con ``SimulationStore.create``,
+    así que como mucho ``max_running`` pools de ``processes`` procesos
+    trabajan a la vez aunque cada worker tenga el suyo.
+    """
+
+    def __init__(self, store: SimulationStore, processes: int = 0, shard_size: int = 5000, max_running: int = 1):
+        self.store = store
+        self.processes = processes
+        self.shard_size = shard_size
+        self.max_running = max_running
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._threads: Dict[str, threading.Thread] = {}
+        self._stop = threading.Event()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # spawn: el worker tiene hilos (uvicorn, colas) y fork no es seguro
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def running(self) -> int:
+        return len(self._threads)
+
+    def start(self, sim_id: str, current_rules: List[Dict[str, Any]], draft_rules: List[Dict[str, Any]],
+              population: List[Dict[str, Any]]):
+        """Lanza en segundo plano una simulación ya creada con ``store.create``"""
+        thread = threading.Thread(
+            target=self._run, args=(sim_id, current_rules, draft_rules, population),
+            name=f"simulation-{sim_id[:8]}", daemon=True,
+        )
+        self._threads[sim_id] = thread
+        thread.start()
+
+    def _run(self, sim_id, current_rules, draft_rules, population):
+        processed = 0
+        try:
+            current_json = json.dumps(current_rules).encode()
+            draft_json = json.dumps(draft_rules).encode()
+            self.store.save_rules(sim_id, current_json, draft_json)
+            args = (self.store.path, sim_id, (rules_key(current_json), rules_key(draft_json)))
+            shards = [(start, population[start:start + self.shard_size]) for start in range(0, len(population), self.shard_size)]
+            summary = empty_summary()
+            cancelled = self.store.progress(sim_id, 0)
+
+            if self.processes <= 0:
+                for start, rows in shards:
+                    if cancelled or self._stop.is_set():
+                        break
+                    merge_summary(summary, evaluate_shard(*args, start, rows))
+                    processed += len(rows)
+                    cancelled = self.store.progress(sim_id, processed)
+            else:
+                executor = self._get_executor()
+                pending = {}
+                queue = iter(shards)
+                while not cancelled and not self._stop.is_set():
+                    while len(pending) < 2 * self.processes:
+                        shard = next(queue, None)
+                        if shard is None:
+                            break
+                        pending[executor.submit(evaluate_shard, *args, *shard)] = len(shard[1])
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        merge_summary(summary, future.result())
+                        processed += pending.pop(future)
+                    cancelled = self.store.progress(sim_id, processed)
+                for future in pending:
+                    future.cancel()
+
+            if cancelled:
+                self.store.finish(sim_id, CANCELLED, processed)
+                RULE_SIMULATIONS.inc(1, CANCELLED)
+            elif self._stop.is_set():
+                self.store.finish(sim_id, FAILED, processed, error="Simulación interrumpida: el worker se está deteniendo")
+                RULE_SIMULATIONS.inc(1, FAILED)
+            else:
+                self.store.finish(sim_id, DONE, processed, result=finalize_summary(summary))
+                RULE_SIMULATIONS.inc(1, DONE)
+        except Exception as e:
+            logger.exception("❌ Error en la simulación %s", sim_id)
+            self.store.finish(sim_id, FAILED, processed, error=str(e))
+            RULE_SIMULATIONS.inc(1, FAILED)
+        finally:
+            self._threads.pop(sim_id, None)
+
+    def stop(self, timeout: float = 5.0):
+        """Interrumpe las simulaciones en curso y cierra el pool de procesos"""
+        self._stop.set()
+        for thread in list(self._threads.values()):
+            thread.join(timeout)
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,39 @@
+"""Configuración común de los tests del backend.
+
+``main`` lee su configuración del entorno al importarse, así que las
+variables se fijan aquí antes de importarlo y cada sesión de tests usa un
+directorio temporal propio para rules.db y las bases auxiliares.
+"""
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+os.environ["RATE_LIMIT_ENABLED"] = "0"
+os.environ["GEMINI_BACKEND"] = "fake"
+os.environ.setdefault("FAKE_GEMINI_LATENCY_SECONDS", "0")
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    os.environ["DATABASE_URL"] = "sqlite:///" + str(tmp_path_factory.mktemp("data") / "rules.db")
+    import main as app_module
+    return app_module
+
+
+@pytest.fixture(scope="session")
+def client(main):
+    from fastapi.testclient import TestClient
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture(scope="session")
+def auth_headers(client):
+    r = client.post("/auth/login", data={"username": "pro@nutri.com", "password": "nutri123"})
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
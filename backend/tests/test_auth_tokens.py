@@ -0,0 +1,72 @@
+import base64
+import json
+import time
+from datetime import timedelta
+
+import pytest
+from jose import jwt
+
+
+def b64(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+
+
+@pytest.fixture
+def patient_token(client):
+    email = "tokens@test.com"
+    client.post("/auth/register", json={"email": email, "name": "Tokens", "password": "secret1"})
+    r = client.post("/auth/login", data={"username": email, "password": "secret1"})
+    assert r.status_code == 200, r.text
+    return r.json()["access_token"]
+
+
+def me(client, token):
+    return client.get("/auth/me", headers={"Authorization": f"Bearer {token}"})
+
+
+def test_expired_token_is_rejected(client, main):
+    token = main.create_access_token({"sub": "1", "email": "pro@nutri.com", "name": "Pro", "role": "nutritionist"},
+                                     expires_delta=timedelta(seconds=-10))
+    assert me(client, token).status_code == 401
+
+
+def test_cached_token_is_rejected_once_expired(client, main):
+    token = main.create_access_token({"sub": "1", "email": "pro@nutri.com", "name": "Pro", "role": "nutritionist"},
+                                     expires_delta=timedelta(seconds=1))
+    hits = main.token_cache.hits
+    assert me(client, token).status_code == 200
+    assert me(client, token).status_code == 200
+    assert main.token_cache.hits > hits  # la segunda verificación sale de la cache
+    exp = jwt.get_unverified_claims(token)["exp"]
+    # python-jose acepta el token durante todo el segundo ``exp`` (compara segundos enteros)
+    time.sleep(max(0.0, exp + 1 - time.time()) + 0.05)
+    assert me(client, token).status_code == 401
+
+
+def test_tampered_payload_is_rejected_with_warm_cache(client, main, patient_token):
+    assert me(client, patient_token).status_code == 200  # token válido ya en la cache
+    header, payload, signature = patient_token.split(".")
+    claims = jwt.get_unverified_claims(patient_token)
+    forged = ".".join([header, b64(dict(claims, role="nutritionist")), signature])
+    assert me(client, forged).status_code == 401
+    rule = {"id": "FORGED", "name": "x", "priority": 1, "when": [], "then": {"diagnosis": ["x"]}}
+    r = client.post("/rules", json=rule, headers={"Authorization": f"Bearer {forged}"})
+    assert r.status_code == 401
+
+
+def test_tampered_signature_is_rejected_with_warm_cache(client, patient_token):
+    assert me(client, patient_token).status_code == 200
+    head, _, signature = patient_token.rpartition(".")
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert me(client, f"{head}.{flipped}").status_code == 401
+
+
+def test_token_signed_with_another_secret_is_rejected(client, patient_token):
+    claims = jwt.get_unverified_claims(patient_token)
+    assert me(client, jwt.encode(claims, "otro-secreto", algorithm="HS256")).status_code == 401
+
+
+def test_alg_none_is_rejected(client, patient_token):
+    claims = jwt.get_unverified_claims(patient_token)
+    token = ".".join([b64({"alg": "none", "typ": "JWT"}), b64(claims), ""])
+    assert me(client, token).status_code == 401
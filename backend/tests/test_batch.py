@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from batch import infer_batch
+from engine import RuleIndex, infer
+
+CONDITIONS = [
+    {"fact": "bmi", "op": ">=", "value": 25},
+    {"fact": "bmi", "op": "<", "value": 18.5},
+    {"fact": "age", "op": "==", "value": 40},
+    {"fact": "age", "op": "!=", "value": 40},
+    {"fact": "sex", "op": "==", "value": "M"},
+    {"fact": "sex", "op": "!=", "value": "F"},
+    {"fact": "activity", "op": "in", "value": ["light", "moderate"]},
+    {"fact": "activity", "op": "not_in", "value": ["sedentary"]},
+    {"fact": "activity", "op": "in", "value": "very_active"},
+    {"fact": "conditions", "op": "contains", "value": "diabetes"},
+    {"fact": "conditions", "op": "contains", "value": "hta"},
+    {"fact": "smoker", "op": "==", "value": True},
+    {"fact": "risk", "op": ">", "value": 1},
+    {"fact": "tags", "op": "contains", "value": "x"},
+]
+
+
+def make_rules(n, rng):
+    rules = []
+    for i in range(n):
+        kcal = rng.choice([{"method": "mifflin_st_jeor", "deficit_pct": 0.1}, 1800, None])
+        diet = {"restrictions": [f"r{i % 5}"]}
+        if kcal is not None:
+            diet["kcal_target"] = kcal
+        rules.append({"id": f"T{i}", "name": f"T{i}", "priority": rng.randint(0, 5),
+                      "when": rng.sample(CONDITIONS, rng.randint(0, 3)),
+                      "then": {"diagnosis": [f"D{i}"], "diet": diet}})
+    return rules
+
+
+def make_rows(n, rng):
+    rows = []
+    for _ in range(n):
+        row = {
+            "age": rng.choice([30, 40, 40.0, 55]),
+            "sex": rng.choice(["M", "F"]),
+            "height_cm": 170, "weight_kg": 80,
+            "activity": rng.choice(["sedentary", "light", "moderate", "very_active"]),
+            "conditions": rng.sample(["diabetes", "hta", "celiaquia"], rng.randint(0, 2)),
+            "bmi": rng.choice([17.0, 22.5, 25, 31.2]),
+        }
+        # Valores ausentes o de otro tipo, que infer() trata con TypeError -> False
+        row["smoker"] = rng.choice([True, False, 1, None])
+        if rng.random() < 0.5:
+            row["risk"] = rng.choice([0, 2, "alto", None])
+        if rng.random() < 0.5:
+            row["tags"] = rng.choice([["x"], [], "xyz", None])
+        rows.append(row)
+    return rows
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_infer_batch_matches_infer(seed):
+    rng = random.Random(seed)
+    index = RuleIndex(make_rules(40, rng))
+    rows = make_rows(300, rng)
+    assert infer_batch(rows, index) == [infer(row, index) for row in rows]
+
+
+def test_batch_candidates_cover_every_row():
+    rng = random.Random(0)
+    index = RuleIndex(make_rules(60, rng))
+    rows = make_rows(100, rng)
+    union = set(index.batch_candidate_positions(rows))
+    for row in rows:
+        assert set(index.candidate_positions(row)) <= union
@@ -0,0 +1,92 @@
+import random
+
+from engine import RuleIndex, _infer_chaining, find_assert_cycles, infer
+
+FACTS = {"age": 30, "sex": "M", "height_cm": 175, "weight_kg": 100, "activity": "moderate", "bmi": 32.7}
+
+# La regla de dieta tiene la mayor prioridad: en una sola pasada no se
+# dispararía, porque ``diet_type`` aún no existe cuando se evalúa
+CHAIN = [
+    {"id": "C1", "name": "Obesidad", "priority": 1,
+     "when": [{"fact": "bmi", "op": ">=", "value": 30}],
+     "then": {"diagnosis": ["Obesidad"], "assert": {"risk_level": "high"}}},
+    {"id": "C2", "name": "Riesgo alto", "priority": 2,
+     "when": [{"fact": "risk_level", "op": "==", "value": "high"}],
+     "then": {"assert": {"diet_type": "hypocaloric"}}},
+    {"id": "C3", "name": "Dieta hipocalórica", "priority": 3,
+     "when": [{"fact": "diet_type", "op": "==", "value": "hypocaloric"}],
+     "then": {"diet": {"kcal_target": {"method": "mifflin_st_jeor", "deficit_pct": 0.2},
+                       "advice": ["Déficit moderado"]}}},
+]
+
+
+def test_derived_facts_chain():
+    for rules in (CHAIN, RuleIndex(CHAIN)):
+        result = infer(FACTS, rules)
+        assert [r["id"] for r in result["fired_rules"]] == ["C1", "C2", "C3"]
+        assert result["derived_facts"] == {"risk_level": "high", "diet_type": "hypocaloric"}
+        assert result["plan"]["advice"] == ["Déficit moderado"]
+        assert result["plan"]["kcal_target"] is not None
+
+
+def test_chain_does_not_start_without_trigger():
+    result = infer({**FACTS, "bmi": 24}, RuleIndex(CHAIN))
+    assert result["fired_rules"] == [] and "derived_facts" not in result
+
+
+def random_patient(rng):
+    height, weight = rng.uniform(150, 195), rng.uniform(40, 140)
+    return {"age": rng.randint(18, 90), "sex": rng.choice("MF"), "height_cm": round(height),
+            "weight_kg": round(weight, 1), "activity": rng.choice(["sedentary", "light", "moderate", "active"]),
+            "bmi": round(weight / (height / 100) ** 2, 1)}
+
+
+def test_without_asserts_matches_single_pass(client, main):
+    rules = main.load_rules()
+    assert rules and not any(r.get("then", {}).get("assert") for r in rules)
+    index = RuleIndex(rules)
+    assert not index.chaining
+    rng = random.Random(14)
+    for _ in range(300):
+        facts = random_patient(rng)
+        single = infer(facts, rules)
+        assert infer(facts, index) == single
+        assert _infer_chaining(facts, index) == single
+
+
+def test_add_rule_rejects_cycle(client, auth_headers):
+    a = {"id": "CY1", "name": "Ciclo A", "priority": 1,
+         "when": [{"fact": "cy_x", "op": "==", "value": 1}], "then": {"assert": {"cy_y": 1}}}
+    b = {"id": "CY2", "name": "Ciclo B", "priority": 1,
+         "when": [{"fact": "cy_y", "op": "==", "value": 1}], "then": {"assert": {"cy_x": 1}}}
+    assert client.post("/rules", json=a, headers=auth_headers).status_code == 200
+    try:
+        r = client.post("/rules", json=b, headers=auth_headers)
+        assert r.status_code == 400
+        assert "ciclo" in r.json()["detail"] and "CY1" in r.json()["detail"]
+        assert "CY2" not in {rule["id"] for rule in client.get("/rules").json()["rules"]}
+    finally:
+        client.delete("/rules/CY1", headers=auth_headers)
+
+
+def test_malformed_assert_is_rejected_on_load():
+    rules = CHAIN + [{"id": "BAD", "name": "Assert mal guardado", "priority": 5,
+                      "when": [{"fact": "bmi", "op": ">=", "value": 30}],
+                      "then": {"diagnosis": ["Nunca"], "assert": ["risk_level"]}}]
+    index = RuleIndex(rules)
+    assert "BAD" in index.rejected
+    assert find_assert_cycles(rules) == []
+    result = infer(FACTS, index)
+    assert [r["id"] for r in result["fired_rules"]] == ["C1", "C2", "C3"]
+
+
+def test_malformed_assert_in_db_does_not_break_infer(client, main, auth_headers):
+    main.save_rule({"id": "BADDB", "name": "Assert mal guardado", "priority": 1,
+                    "when": [{"fact": "bmi", "op": ">=", "value": 30}],
+                    "then": {"diagnosis": ["Nunca"], "assert": "risk_level"}})
+    try:
+        r = client.post("/infer", json={**FACTS, "bmi": 33.1})
+        assert r.status_code == 200, r.text
+        assert "Nunca" not in r.json()["diagnosis"]
+    finally:
+        client.delete("/rules/BADDB", headers=auth_headers)
@@ -0,0 +1,93 @@
+import threading
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from fake_gemini import FakeGenerativeModel
+
+
+def png_bytes():
+    buf = BytesIO()
+    Image.new("RGB", (8, 8), (200, 40, 40)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class BlockingCall:
+    """Llamada gRPC en streaming: da dos trozos y espera hasta que la cancelan
+
+    (el SDK lee un trozo por adelantado antes de entregar el anterior)
+    """
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.cancelled = threading.Event()
+        self.sent = 0
+
+    def cancel(self):
+        self.cancelled.set()
+        return True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.sent < 2:
+            self.sent += 1
+            return self.chunk
+        if self.cancelled.wait(10):
+            raise RuntimeError("Locally cancelled by application!")
+        raise StopIteration
+
+
+class SDKModel:
+    """``generate_content(stream=True)`` que devuelve el ``GenerateContentResponse`` real del SDK"""
+
+    def __init__(self):
+        self.call = None
+
+    def generate_content(self, contents, stream=False):
+        generation_types = pytest.importorskip("google.generativeai.types.generation_types")
+        protos = pytest.importorskip("google.generativeai.protos")
+        chunk = protos.GenerateContentResponse(candidates=[{"content": {"parts": [{"text": "Arroz"}], "role": "model"}}])
+        self.call = BlockingCall(chunk)
+        return generation_types.GenerateContentResponse.from_iterator(self.call)
+
+
+def run_and_cancel(main, monkeypatch, model):
+    monkeypatch.setattr(main, "gemini_model", model)
+    cancelled, upstream = threading.Event(), {}
+    first_chunk = threading.Event()
+    result = {}
+
+    def target():
+        result["analysis"] = main._stream_analysis("prompt", png_bytes(), lambda text: first_chunk.set(),
+                                                   cancelled, upstream)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    assert first_chunk.wait(5)
+    # Lo que hace el endpoint SSE al desconectarse el cliente
+    cancelled.set()
+    main._close_upstream(upstream)
+    thread.join(2)
+    assert not thread.is_alive(), "el hilo sigue esperando trozos del stream cancelado"
+    return result["analysis"], upstream["response"]
+
+
+def test_close_upstream_cancels_sdk_response(main, monkeypatch):
+    pytest.importorskip("google.generativeai")
+    model = SDKModel()
+    response_type = pytest.importorskip("google.generativeai.types.generation_types").GenerateContentResponse
+    assert not hasattr(response_type, "cancel") and not hasattr(response_type, "close")
+    analysis, response = run_and_cancel(main, monkeypatch, model)
+    assert analysis is None
+    assert isinstance(response, response_type)
+    assert model.call.cancelled.is_set()
+
+
+def test_close_upstream_cancels_fake_stream(main, monkeypatch):
+    model = FakeGenerativeModel(chunks=8, first_chunk_delay=0.01, chunk_delay=5)
+    analysis, response = run_and_cancel(main, monkeypatch, model)
+    assert analysis is None
+    assert response.closed and response.chunks_sent == 1
@@ -0,0 +1,48 @@
+import time
+
+import history as history_module
+from history import HistoryWriter
+
+FACTS = {"age": 40, "sex": "F", "bmi": 27.0, "activity": "light", "conditions": []}
+RESULT = {"diagnosis": ["Sobrepeso"], "plan": {"kcal_target": 1800}, "fired_rules": [{"id": "R2"}]}
+
+
+def test_purge_keeps_recent_rows_and_daily_aggregates(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_module, "PURGE_BATCH_SIZE", 7)  # varias tandas
+    writer = HistoryWriter(str(tmp_path / "history.db"), retention_seconds=10 * 86400)
+    writer.init()
+    now = time.time()
+    old = [(now - 30 * 86400 + i, FACTS, RESULT) for i in range(20)]
+    recent = [(now - 86400 + i, FACTS, RESULT) for i in range(5)]
+    writer._write(old + recent)
+
+    assert writer.purge(now=now) == 20
+    assert writer.stats()["purged"] == 20
+    with writer._conn() as con:
+        (rows,) = con.execute("SELECT COUNT(*) FROM inference_history").fetchone()
+    assert rows == 5
+    # Los agregados diarios de los días purgados siguen ahí
+    assert sum(d["inferences"] for d in writer.daily("1970-01-01")) == 25
+    assert writer.purge(now=now) == 0
+
+
+def test_no_retention_keeps_everything(tmp_path):
+    writer = HistoryWriter(str(tmp_path / "history.db"))
+    writer.init()
+    writer._write([(time.time() - 400 * 86400, FACTS, RESULT)])
+    assert writer.purge() == 0
+
+
+def test_writer_thread_purges_periodically(tmp_path):
+    writer = HistoryWriter(str(tmp_path / "history.db"), flush_interval=0.01,
+                           retention_seconds=86400, purge_interval=0.01)
+    writer.init()
+    writer._write([(time.time() - 2 * 86400, FACTS, RESULT)])
+    writer.start()
+    try:
+        deadline = time.monotonic() + 2
+        while writer.purged == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        writer.stop()
+    assert writer.purged == 1
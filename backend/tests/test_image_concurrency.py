@@ -0,0 +1,65 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from fake_gemini import FakeGenerativeModel
+
+FACTS = {"age": 30, "sex": "M", "height_cm": 175, "weight_kg": 90, "activity": "moderate", "bmi": 29.4}
+
+
+class SleepingModel(FakeGenerativeModel):
+    """Modelo falso que tarda ``delay`` segundos y cuenta las llamadas en curso"""
+
+    def __init__(self, delay):
+        super().__init__(chunks=1, first_chunk_delay=delay, chunk_delay=0)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, stream=False):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return super().generate_content(contents, stream=stream)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def jpeg_bytes():
+    buf = BytesIO()
+    Image.new("RGB", (64, 64), (180, 120, 60)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def test_infer_latency_unaffected_by_slow_image_calls(client, main, auth_headers, monkeypatch):
+    model = SleepingModel(delay=1.5)
+    monkeypatch.setattr(main, "gemini_model", model)
+    image = jpeg_bytes()
+
+    def analyze(i):
+        # Prompt distinto en cada llamada para no acertar en la cache de análisis
+        return client.post("/analyze-image/upload", headers=auth_headers,
+                           files={"file": ("plato.jpg", image, "image/jpeg")}, data={"prompt": f"Analiza {i}"})
+
+    with ThreadPoolExecutor(main.GEMINI_MAX_CONCURRENCY) as pool:
+        futures = [pool.submit(analyze, i) for i in range(main.GEMINI_MAX_CONCURRENCY)]
+        deadline = time.monotonic() + 5
+        while model.in_flight < main.GEMINI_MAX_CONCURRENCY and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert model.in_flight == main.GEMINI_MAX_CONCURRENCY
+
+        latencies = []
+        for _ in range(20):
+            t0 = time.perf_counter()
+            r = client.post("/infer", json=FACTS)
+            latencies.append(time.perf_counter() - t0)
+            assert r.status_code == 200
+        # Las llamadas a Gemini siguen en curso mientras se mide /infer
+        assert model.in_flight == main.GEMINI_MAX_CONCURRENCY
+        responses = [f.result() for f in futures]
+
+    assert all(r.status_code == 200 and not r.json()["cached"] for r in responses)
+    assert max(latencies) < 0.25, latencies
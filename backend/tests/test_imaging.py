@@ -0,0 +1,77 @@
+import random
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from imaging import ImageAnalysisCache, dhash
+
+
+def jpeg(img, quality=90):
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def photo(seed=0, size=(320, 240)):
+    """Imagen con estructura (bloques aleatorios suavizados), como una foto"""
+    rng = random.Random(seed)
+    small = Image.new("RGB", (16, 12))
+    small.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16 * 12)])
+    return small.resize(size, Image.BILINEAR)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    c = ImageAnalysisCache(str(tmp_path / "image_cache.db"), ttl_seconds=3600, max_bytes=10 * 1024 * 1024)
+    c.init()
+    return c
+
+
+def test_uniform_images_do_not_collide(cache):
+    red, blue = jpeg(Image.new("RGB", (200, 200), (220, 30, 30))), jpeg(Image.new("RGB", (200, 200), (30, 30, 220)))
+    assert dhash(red) == dhash(blue) == 0
+    cache.put(red, "p", "tomate")
+    assert cache.get(blue, "p") is None
+    # Mismo color uniforme recodificado: sin coincidencia exacta tampoco hay casi-duplicado
+    assert cache.get(jpeg(Image.new("RGB", (200, 200), (220, 30, 30)), quality=60), "p") is None
+    assert cache.get(red, "p") == "tomate"
+
+
+def test_reencoded_photo_is_a_near_hit(cache):
+    cache.put(jpeg(photo()), "p", "plato")
+    assert cache.get(jpeg(photo(), quality=60), "p") == "plato"
+    assert cache.near_hits == 1
+
+
+def test_same_structure_different_colors_is_a_miss(cache):
+    img = photo()
+    tinted = Image.merge("RGB", [band.point(lambda v, k=k: min(255, v + 70 * (k == 2))) for k, band in enumerate(img.split())])
+    cache.put(jpeg(img), "p", "plato")
+    assert cache.get(jpeg(tinted), "p") is None
+
+
+def test_different_aspect_ratio_is_a_miss(cache):
+    cache.put(jpeg(photo()), "p", "plato")
+    assert cache.get(jpeg(photo(size=(320, 180))), "p") is None
+
+
+def test_different_prompt_is_a_miss(cache):
+    data = jpeg(photo())
+    cache.put(data, "p", "plato")
+    assert cache.get(data, "otro") is None
+
+
+def test_migrates_cache_without_signature_columns(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.db")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE image_cache (key TEXT PRIMARY KEY, prompt_hash TEXT NOT NULL, phash INTEGER NOT NULL, "
+                + ", ".join(f"band{b} INTEGER NOT NULL" for b in range(8))
+                + ", result TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)")
+    con.close()
+    cache = ImageAnalysisCache(path, ttl_seconds=3600, max_bytes=1024 * 1024)
+    cache.init()
+    data = jpeg(photo())
+    cache.put(data, "p", "plato")
+    assert cache.get(data, "p") == "plato"
@@ -0,0 +1,52 @@
+import json
+
+
+def batch_lines(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+FACTS = {"age": 30, "sex": "M", "height_cm": 175, "weight_kg": 90, "activity": "moderate", "bmi": 29.4}
+
+
+def test_malformed_ndjson_line_is_reported_in_place(client):
+    body = "\n".join([json.dumps(FACTS), '{"age": 30,', json.dumps(FACTS)]) + "\n"
+    r = client.post("/infer/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200
+    lines = batch_lines(r)
+    assert len(lines) == 3
+    assert lines[0]["diagnosis"] == lines[2]["diagnosis"] == ["Sobrepeso"]
+    assert lines[1]["index"] == 1 and "JSON inválido" in lines[1]["error"]
+
+
+def test_too_many_rows_is_rejected_before_streaming(client, main, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_ROWS", 2)
+    body = "\n".join(json.dumps(FACTS) for _ in range(3)) + "\n"
+    r = client.post("/infer/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 413
+
+
+def test_oversized_body_is_rejected(client, main, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_BYTES", 1000)
+    body = "\n".join(json.dumps(FACTS) for _ in range(20)) + "\n"
+    r = client.post("/infer/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 413
+
+    # Sin Content-Length (chunked): se corta al contar los bytes recibidos
+    def chunks():
+        for _ in range(20):
+            yield (json.dumps(FACTS) + "\n").encode()
+
+    r = client.post("/infer/batch", content=chunks(), headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 413
+
+
+def test_invalid_utf8_line_keeps_one_result_per_row(client):
+    rows = [json.dumps(FACTS).encode()] * 4
+    rows[1] = b'{"age": "\xff"}'
+    r = client.post("/infer/batch", content=b"\n".join(rows) + b"\n",
+                    headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200
+    lines = batch_lines(r)
+    assert len(lines) == 4
+    assert lines[1]["index"] == 1 and "UTF-8" in lines[1]["error"]
+    assert lines[3]["diagnosis"] == ["Sobrepeso"]
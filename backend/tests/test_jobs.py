@@ -0,0 +1,126 @@
+import sqlite3
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from fake_gemini import FAKE_ANALYSIS, FakeGenerativeModel
+from jobs import DONE, FAILED, FINISHED, JobQueue, JobWorkerPool
+
+
+def make_queue(tmp_path, queue_class=JobQueue, **kwargs):
+    queue = queue_class(str(tmp_path / "jobs.db"), backoff_base=0.001, backoff_max=0.001, **kwargs)
+    queue.init()
+    return queue
+
+
+def model_handler(model):
+    return lambda prompt, image: model.generate_content([prompt, image]).text
+
+
+def fake_model(failures=0):
+    return FakeGenerativeModel(chunks=1, first_chunk_delay=0, chunk_delay=0, failures=failures)
+
+
+def wait_finished(get, job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = get(job_id)
+        if job["status"] in FINISHED:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"el trabajo {job_id} no terminó: {get(job_id)}")
+
+
+def run_pool(queue, handler, job_ids):
+    pool = JobWorkerPool(queue, handler, workers=1, poll_interval=0.01)
+    pool.start()
+    try:
+        return [wait_finished(queue.get, job_id) for job_id in job_ids], pool
+    finally:
+        pool.stop()
+
+
+def test_transient_failures_are_retried(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=3)
+    model = fake_model(failures=2)
+    (job,), _ = run_pool(queue, model_handler(model), [queue.enqueue("u", "Analiza", b"img")])
+    assert job["status"] == DONE and job["attempts"] == 3
+    assert job["result"] == FAKE_ANALYSIS and job["error"] is None
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    model = fake_model(failures=10)
+    (job,), _ = run_pool(queue, model_handler(model), [queue.enqueue("u", "Analiza", b"img")])
+    assert job["status"] == FAILED and job["attempts"] == 2
+    assert "FakeUnavailableError" in job["error"]
+    assert model.calls == 2
+
+
+def test_expired_lease_is_reclaimed_and_stale_worker_cannot_overwrite(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.05)
+    job_id = queue.enqueue("u", "Analiza", b"img")
+    stale = queue.claim()
+    assert stale["attempts"] == 1
+    assert queue.claim() is None  # lease vigente
+    time.sleep(0.1)
+    fresh = queue.claim()
+    assert fresh["id"] == job_id and fresh["attempts"] == 2
+    # El worker que perdió el lease termina tarde: no toca el trabajo
+    assert not queue.complete(job_id, stale["attempts"], "viejo")
+    assert queue.fail(job_id, stale["attempts"], "boom") is None
+    assert queue.get(job_id)["status"] == "running"
+    assert queue.complete(job_id, fresh["attempts"], "nuevo")
+    assert not queue.complete(job_id, stale["attempts"], "viejo")
+    assert queue.get(job_id)["result"] == "nuevo"
+
+
+def test_expired_lease_on_last_attempt_fails(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2, lease_seconds=0.05)
+    job_id = queue.enqueue("u", "Analiza", b"img")
+    for attempt in (1, 2):
+        assert queue.claim()["attempts"] == attempt
+        time.sleep(0.1)
+    assert queue.claim() is None
+    job = queue.get(job_id)
+    assert job["status"] == FAILED and job["attempts"] == 2 and "lease" in job["error"]
+
+
+class LockedOnceQueue(JobQueue):
+    """``complete()`` falla la primera vez como una base de datos bloqueada"""
+
+    locked = False
+
+    def complete(self, job_id, attempts, result):
+        if not self.locked:
+            self.locked = True
+            raise sqlite3.OperationalError("database is locked")
+        return super().complete(job_id, attempts, result)
+
+
+def test_worker_survives_storage_errors(tmp_path):
+    queue = make_queue(tmp_path, LockedOnceQueue, lease_seconds=0.2)
+    job_ids = [queue.enqueue("u", f"Analiza {i}", b"img") for i in range(2)]
+    jobs, pool = run_pool(queue, model_handler(fake_model()), job_ids)
+    assert [job["status"] for job in jobs] == [DONE, DONE]
+    # El primero se perdió al guardar y se recuperó al vencer su lease
+    assert sorted(job["attempts"] for job in jobs) == [1, 2]
+
+
+def test_job_endpoint_retries_with_fake_backend(client, main, auth_headers, monkeypatch):
+    monkeypatch.setattr(main, "gemini_model", fake_model(failures=1))
+    monkeypatch.setattr(main.job_queue, "backoff_base", 0.001)
+    buf = BytesIO()
+    Image.new("RGB", (32, 32), (30, 160, 90)).save(buf, format="JPEG")
+    r = client.post("/analyze-image/jobs", headers=auth_headers,
+                    files={"file": ("plato.jpg", buf.getvalue(), "image/jpeg")},
+                    data={"prompt": "Analiza el plato (reintentos)"})
+    assert r.status_code == 202, r.text
+    job_id = r.json()["job_id"]
+
+    def get(job_id):
+        return client.get(f"/analyze-image/jobs/{job_id}", headers=auth_headers).json()
+
+    job = wait_finished(get, job_id)
+    assert job["status"] == DONE and job["attempts"] == 2
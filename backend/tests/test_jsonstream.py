@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from jsonstream import InvalidItem, JSONStreamDecoder, iter_json_stream
+
+
+def collect(body: bytes, ndjson=None, chunk_size=7):
+    async def chunks():
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+    async def run():
+        items = []
+        try:
+            async for item in iter_json_stream(chunks(), ndjson):
+                items.append(item)
+        except ValueError as e:
+            return items, e
+        return items, None
+
+    return asyncio.run(run())
+
+
+def test_ndjson_malformed_line_does_not_drop_neighbours():
+    body = b'{"a": 1}\n{"a": 2}\n{"a": \n\n{"a": 4}\n'
+    items, error = collect(body)
+    assert error is None
+    assert items[:2] == [{"a": 1}, {"a": 2}]
+    assert isinstance(items[2], InvalidItem) and items[2].line == 3
+    assert "línea 3" in items[2].error
+    assert items[3] == {"a": 4}
+
+
+def test_ndjson_malformed_last_line_without_newline():
+    items, error = collect(b'{"a": 1}\n{"a"', ndjson=True)
+    assert error is None
+    assert items[0] == {"a": 1}
+    assert isinstance(items[1], InvalidItem) and items[1].line == 2
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64])
+def test_json_array_keeps_items_before_error(chunk_size):
+    items, error = collect(b'[{"a": 1}, {"a": 2}, {"a": }]', chunk_size=chunk_size)
+    assert items == [{"a": 1}, {"a": 2}]
+    assert isinstance(error, ValueError)
+
+
+def test_json_array_incomplete():
+    items, error = collect(b'[{"a": 1}, {"a": 2}')
+    assert items == [{"a": 1}, {"a": 2}]
+    assert isinstance(error, ValueError)
+
+
+def test_multibyte_split_between_chunks():
+    items, error = collect('{"n": "ñandú"}\n'.encode(), chunk_size=1)
+    assert error is None and items == [{"n": "ñandú"}]
+
+
+def test_decoder_feed_by_lines():
+    decoder = JSONStreamDecoder(ndjson=True)
+    assert decoder.feed('{"a": 1}\n{"a"') == [{"a": 1}]
+    out = decoder.feed(': 2}\nnope\n')
+    assert out[0] == {"a": 2} and isinstance(out[1], InvalidItem) and out[1].line == 3
+    assert decoder.close() == []
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 64])
+def test_ndjson_invalid_utf8_only_invalidates_its_line(chunk_size):
+    body = b'{"a": 1}\n{"a": "\xff"}\n{"a": 3}\n{"a": "\xc3\xb1"}\n'
+    items, error = collect(body, chunk_size=chunk_size)
+    assert error is None
+    assert items[0] == {"a": 1}
+    assert isinstance(items[1], InvalidItem) and items[1].line == 2
+    assert "UTF-8" in items[1].error
+    assert items[2:] == [{"a": 3}, {"a": "ñ"}]
+
+
+def test_ndjson_truncated_multibyte_at_end():
+    items, error = collect(b'{"a": 1}\n{"a": "\xc3', chunk_size=4)
+    assert error is None
+    assert items[0] == {"a": 1}
+    assert isinstance(items[1], InvalidItem) and items[1].line == 2
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64])
+def test_json_array_invalid_utf8(chunk_size):
+    items, error = collect(b'[{"a": 1}, {"a": "\xff"}, {"a": 3}]', chunk_size=chunk_size)
+    assert items == [{"a": 1}]
+    assert isinstance(error, ValueError) and "UTF-8" in str(error)
@@ -0,0 +1,53 @@
+import json
+import logging
+import logging.handlers
+import queue
+
+from logs import JSONFormatter, StructuredQueueHandler
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def log_through_queue(emit):
+    """Pasa los registros por la cola y el listener como ``setup_logging``"""
+    log_queue = queue.SimpleQueue()
+    sink = ListHandler()
+    sink.setFormatter(JSONFormatter())
+    listener = logging.handlers.QueueListener(log_queue, sink)
+    logger = logging.getLogger("nutriexpert.test_logs")
+    handler = StructuredQueueHandler(log_queue)
+    logger.addHandler(handler)
+    logger.propagate = False
+    listener.start()
+    try:
+        emit(logger)
+    finally:
+        listener.stop()
+        logger.removeHandler(handler)
+    return [json.loads(line) for line in sink.lines]
+
+
+def test_exception_is_a_separate_field():
+    def emit(logger):
+        try:
+            {}["falta"]
+        except KeyError:
+            logger.exception("Fallo al procesar %s", "abc", extra={"job_id": "j1"})
+
+    (entry,) = log_through_queue(emit)
+    assert entry["msg"] == "Fallo al procesar abc"
+    assert entry["level"] == "ERROR" and entry["job_id"] == "j1"
+    assert entry["exc"].startswith("Traceback") and "KeyError: 'falta'" in entry["exc"]
+    assert "Traceback" not in entry["msg"]
+
+
+def test_record_without_exception_has_no_exc_field():
+    (entry,) = log_through_queue(lambda logger: logger.warning("Sin %s", "traza"))
+    assert entry["msg"] == "Sin traza" and "exc" not in entry
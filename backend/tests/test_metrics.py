@@ -0,0 +1,20 @@
+import asyncio
+
+
+def test_metrics_render_runs_off_the_event_loop(client, main, monkeypatch):
+    calls = []
+    render = main.registry.render
+
+    def spy():
+        try:
+            asyncio.get_running_loop()
+            calls.append("event loop")
+        except RuntimeError:
+            calls.append("thread")
+        return render()
+
+    monkeypatch.setattr(main.registry, "render", spy)
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert "nutriexpert_worker_info" in r.text
+    assert calls == ["thread"]
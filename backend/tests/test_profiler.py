@@ -0,0 +1,50 @@
+import engine
+from engine import RuleIndex, RuleProfiler, infer
+
+RULES = [
+    {"id": "P1", "name": "Obesidad sedentaria", "priority": 2,
+     "when": [{"fact": "bmi", "op": ">=", "value": 30}, {"fact": "activity", "op": "==", "value": "sedentary"}],
+     "then": {"diagnosis": ["Obesidad sedentaria"]}},
+    {"id": "P2", "name": "Sobrepeso", "priority": 1,
+     "when": [{"fact": "bmi", "op": ">=", "value": 25}],
+     "then": {"diagnosis": ["Sobrepeso"]}},
+]
+
+PATIENTS = [
+    {"bmi": 32.0, "activity": "sedentary"},
+    {"bmi": 31.0, "activity": "moderate"},
+    {"bmi": 26.0, "activity": "sedentary"},
+    {"bmi": 22.0, "activity": "light"},
+]
+
+
+def test_profiler_times_compiled_predicates(monkeypatch):
+    index = RuleIndex(RULES)
+    expected = [infer(facts, index) for facts in PATIENTS]
+
+    def interpreted(facts, cond):
+        raise AssertionError("el perfilado debe usar los predicados compilados")
+
+    monkeypatch.setattr(engine, "match_condition", interpreted)
+    profiler = RuleProfiler()
+    assert [infer(facts, index, profiler) for facts in PATIENTS] == expected
+
+    rules = {r["id"]: r for r in profiler.report(index.key_conditions, min_samples=1)["rules"]}
+    p1, p2 = rules["P1"], rules["P2"]
+    assert (p1["evaluations"], p1["matches"]) == (2, 1)  # el índice sólo la propone con bmi >= 30
+    assert p1["first_condition_reject_rate"] == 0.0
+    assert [c["pass_rate"] for c in p1["conditions"]] == [1.0, 0.5]
+    assert (p2["evaluations"], p2["matches"]) == (3, 3)
+    assert all(r["total_ms"] > 0 for r in (p1, p2))
+
+
+def test_profiler_in_chaining_matches_unprofiled():
+    chain = RULES + [{"id": "P3", "name": "Riesgo", "priority": 0,
+                      "when": [{"fact": "risk", "op": "==", "value": "high"}],
+                      "then": {"diagnosis": ["Riesgo alto"]}}]
+    chain[1] = {**chain[1], "then": {"diagnosis": ["Sobrepeso"], "assert": {"risk": "high"}}}
+    index = RuleIndex(chain)
+    profiler = RuleProfiler()
+    for facts in PATIENTS:
+        assert infer(facts, index, profiler) == infer(facts, index)
+    assert profiler.calls == len(PATIENTS)
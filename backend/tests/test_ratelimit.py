@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from ratelimit import Limit, RateLimiter
+
+FACTS = {"age": 30, "sex": "M", "height_cm": 175, "weight_kg": 90, "activity": "moderate", "bmi": 29.4}
+
+
+def ndjson(n):
+    return "".join(json.dumps(FACTS) + "\n" for _ in range(n))
+
+
+@pytest.fixture
+def batch_limits(main, monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setitem(main.RATE_LIMITS, "infer_batch", (None, Limit(10, 10 / 3600)))
+    main.rate_limiter.reset()
+    yield
+    main.rate_limiter.reset()
+
+
+def post_batch(client, n):
+    return client.post("/infer/batch", content=ndjson(n), headers={"Content-Type": "application/x-ndjson"})
+
+
+def test_batch_is_charged_per_row(client, batch_limits):
+    r = post_batch(client, 6)
+    assert r.status_code == 200 and len(r.text.splitlines()) == 6
+    r = post_batch(client, 5)  # quedan 4 filas de cupo
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    assert r.headers["content-type"].startswith("application/json")  # antes de empezar el stream NDJSON
+    # La primera fila del lote rechazado se cobró al llegar la petición
+    assert post_batch(client, 3).status_code == 200
+    assert post_batch(client, 1).status_code == 429  # cupo agotado: se rechaza antes de leer el cuerpo
+
+
+def test_batch_larger_than_bucket_is_413(client, batch_limits):
+    assert post_batch(client, 11).status_code == 413
+
+
+def test_single_infer_does_not_use_batch_bucket(client, batch_limits):
+    assert post_batch(client, 10).status_code == 200
+    assert client.post("/infer", json=FACTS).status_code == 200
+
+
+def test_new_bucket_rejects_cost_above_capacity(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "ratelimit.db"))
+    limiter.init()
+    limit = Limit(5, 1.0)
+    assert limiter.take([("k", limit)], cost=6) > 0
+    assert limiter.take([("k", limit)], cost=5) == 0
+    assert limiter.take([("k", limit)], cost=1) > 0
+
+
+def test_denied_request_does_not_consume_other_buckets(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "ratelimit.db"))
+    limiter.init()
+    user, ip = ("infer:user:a", Limit(10, 10 / 3600)), ("infer:ip:1.2.3.4", Limit(1, 1 / 3600))
+    results = [limiter.take([user, ip]) for _ in range(5)]
+    assert results[0] == 0 and all(wait > 0 for wait in results[1:])
+    with limiter._conn() as con:
+        tokens = dict(con.execute("SELECT key, tokens FROM rate_buckets").fetchall())
+    assert tokens["infer:user:a"] == pytest.approx(9, abs=0.01)
+    # Desde otra IP el usuario conserva el cupo que no gastaron los rechazos
+    other_ip = ("infer:ip:5.6.7.8", Limit(1, 1 / 3600))
+    assert limiter.take([user, other_ip]) == 0
+
+
+def test_idle_buckets_are_purged(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "ratelimit.db"), max_idle_seconds=60)
+    limiter.init()
+    limit = Limit(5, 5 / 60)
+    for i in range(3):
+        assert limiter.take([(f"infer:ip:10.0.0.{i}", limit)]) == 0
+    with limiter._conn() as con:
+        con.execute("UPDATE rate_buckets SET updated=updated-120 WHERE key<>'infer:ip:10.0.0.0'")
+    assert limiter.purge() == 2
+    with limiter._conn() as con:
+        assert [k for k, in con.execute("SELECT key FROM rate_buckets")] == ["infer:ip:10.0.0.0"]
@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import httpx
+
+
+def rule(rule_id, bmi):
+    return {"id": rule_id, "name": f"Bulk {rule_id}", "priority": 1,
+            "when": [{"fact": "bmi", "op": ">=", "value": bmi}],
+            "then": {"diagnosis": [f"Bulk {rule_id}"]}}
+
+
+def test_malformed_ndjson_lines_are_reported_per_line(client, auth_headers):
+    body = "\n".join([
+        json.dumps(rule("BK1", 60)),
+        '{"id": "BK2", "name": ',
+        "",
+        json.dumps(rule("BK3", 61)),
+        json.dumps({"id": "BK4"}),
+    ]) + "\n"
+    r = client.post("/rules/bulk", content=body,
+                    headers={**auth_headers, "Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200, r.text
+    data = r.json()
+    assert data["imported"] == 2
+    errors = data["errors"]
+    assert [e["index"] for e in errors] == [1, 3]
+    assert errors[0]["line"] == 2 and "JSON inválido" in errors[0]["error"]
+    assert errors[1]["id"] == "BK4"
+    ids = {r["id"] for r in client.get("/rules").json()["rules"]}
+    assert {"BK1", "BK3"} <= ids and "BK2" not in ids
+    for rule_id in ("BK1", "BK3"):
+        assert client.delete(f"/rules/{rule_id}", headers=auth_headers).status_code == 200
+
+
+def test_strict_rejects_malformed_line(client, auth_headers):
+    body = json.dumps(rule("BK5", 60)) + "\nnope\n"
+    r = client.post("/rules/bulk?strict=true", content=body,
+                    headers={**auth_headers, "Content-Type": "application/x-ndjson"})
+    assert r.status_code == 400
+    assert r.json()["detail"]["errors"][0]["line"] == 2
+
+
+def test_body_over_limit_is_rejected(client, main, auth_headers, monkeypatch):
+    monkeypatch.setattr(main, "RULES_BULK_MAX_BYTES", 1024)
+    lines = [json.dumps(rule(f"BKL{i}", 60 + i)) + "\n" for i in range(20)]
+    headers = {**auth_headers, "Content-Type": "application/x-ndjson"}
+    r = client.post("/rules/bulk", content="".join(lines), headers=headers)
+    assert r.status_code == 413
+
+    # Sin Content-Length el cuerpo se corta al pasar del máximo
+    async def body():
+        for line in lines:
+            yield line.encode()
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.post("/rules/bulk", content=body(), headers=headers)
+
+    assert asyncio.run(run()).status_code == 413
+    ids = {r["id"] for r in client.get("/rules").json()["rules"]}
+    assert not any(rule_id.startswith("BKL") for rule_id in ids)
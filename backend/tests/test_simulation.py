@@ -0,0 +1,145 @@
+import random
+import time
+
+from engine import RuleIndex, infer
+from simulation import CANCELLED, DONE, FAILED, RUNNING, SimulationRunner, SimulationStore, diff_results, finalize_summary
+
+RULES = [
+    {"id": "S1", "name": "Sobrepeso", "priority": 2,
+     "when": [{"fact": "bmi", "op": ">=", "value": 25}],
+     "then": {"diagnosis": ["Sobrepeso"], "diet": {"kcal_target": {"method": "mifflin_st_jeor", "deficit_pct": 0.1}}}},
+    {"id": "S2", "name": "Bajo peso", "priority": 1,
+     "when": [{"fact": "bmi", "op": "<", "value": 18.5}],
+     "then": {"diagnosis": ["Bajo peso"], "diet": {"kcal_target": {"method": "mifflin_st_jeor", "surplus_pct": 0.1}}}},
+    {"id": "S3", "name": "Mayor", "priority": 0,
+     "when": [{"fact": "age", "op": ">=", "value": 65}],
+     "then": {"diagnosis": ["Adulto mayor"]}},
+]
+DRAFT = [
+    {**RULES[0], "when": [{"fact": "bmi", "op": ">=", "value": 27}],
+     "then": {"diagnosis": ["Sobrepeso"], "diet": {"kcal_target": {"method": "mifflin_st_jeor", "deficit_pct": 0.2}}}},
+    RULES[1],
+    {"id": "S4", "name": "Sedentario", "priority": 0,
+     "when": [{"fact": "activity", "op": "==", "value": "sedentary"}],
+     "then": {"diagnosis": ["Sedentarismo"]}},
+]
+
+
+def make_population(n, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        height, weight = rng.uniform(150, 195), rng.uniform(40, 130)
+        rows.append({"age": rng.randint(18, 90), "sex": rng.choice("MF"), "height_cm": round(height),
+                     "weight_kg": round(weight, 1), "activity": rng.choice(["sedentary", "light", "moderate"]),
+                     "bmi": round(weight / (height / 100) ** 2, 1)})
+    return rows
+
+
+def expected_result(population):
+    current, draft = RuleIndex(RULES), RuleIndex(DRAFT)
+    return finalize_summary(diff_results(0, [infer(f, current) for f in population],
+                                         [infer(f, draft) for f in population]))
+
+
+def make_store(tmp_path, store_class=SimulationStore, **kwargs):
+    store = store_class(str(tmp_path / "simulations.db"), **kwargs)
+    store.init()
+    return store
+
+
+def run_simulation(store, runner, population, timeout=30.0):
+    sim_id = store.create("u", len(population))
+    runner.start(sim_id, RULES, DRAFT, population)
+    deadline = time.monotonic() + timeout
+    while runner.running() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not runner.running()
+    return store.get(sim_id)
+
+
+def stored_rules(store, sim_id):
+    with store._conn() as con:
+        return con.execute("SELECT current_rules, draft_rules FROM rule_simulations WHERE id=?", (sim_id,)).fetchone()
+
+
+class RecordingStore(SimulationStore):
+    """Guarda cada progreso; con ``cancel_at`` pide cancelar al alcanzar ese progreso"""
+
+    cancel_at = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def progress(self, sim_id, processed, status=RUNNING):
+        self.calls.append(processed)
+        if self.cancel_at is not None and processed >= self.cancel_at:
+            self.request_cancel(sim_id)
+        return super().progress(sim_id, processed, status)
+
+
+def test_sharded_result_matches_single_pass(tmp_path):
+    store = make_store(tmp_path, RecordingStore)
+    population = make_population(50)
+    sim = run_simulation(store, SimulationRunner(store, processes=0, shard_size=7), population)
+    assert sim["status"] == DONE and sim["processed"] == 50
+    assert sim["result"] == expected_result(population)
+    assert sim["result"]["changed"] > 0
+    # Un latido al empezar y otro tras cada lote de 7
+    assert store.calls == [0, 7, 14, 21, 28, 35, 42, 49, 50]
+    assert stored_rules(store, sim["id"]) == (None, None)
+
+
+def test_cancel_stops_after_current_shard(tmp_path):
+    store = make_store(tmp_path, RecordingStore)
+    store.cancel_at = 10
+    sim = run_simulation(store, SimulationRunner(store, processes=0, shard_size=10), make_population(50))
+    assert sim["status"] == CANCELLED and sim["processed"] == 10 and sim["result"] is None
+    assert store.calls == [0, 10]
+    assert stored_rules(store, sim["id"]) == (None, None)
+
+
+def test_process_pool_matches_serial(tmp_path):
+    store = make_store(tmp_path)
+    population = make_population(120, seed=1)
+    runner = SimulationRunner(store, processes=2, shard_size=10)
+    try:
+        sim = run_simulation(store, runner, population)
+    finally:
+        runner.stop()
+    assert sim["status"] == DONE, sim["error"]
+    expected = expected_result(population)
+    # Los lotes llegan en cualquier orden: los ejemplos pueden ser otros pacientes cambiados
+    examples = sim["result"].pop("examples")
+    assert len(examples) == len(expected.pop("examples"))
+    assert sim["result"] == expected
+
+
+def test_max_running_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "simulations.db")
+    worker_a, worker_b = SimulationStore(path), SimulationStore(path)
+    worker_a.init()
+    first = worker_a.create("u", 10, max_running=1)
+    assert first is not None
+    assert worker_b.create("u", 10, max_running=1) is None
+    worker_a.finish(first, DONE, 10, result={})
+    second = worker_b.create("u", 10, max_running=1)
+    assert second is not None
+    # Una simulación sin latido (su worker murió) no ocupa el cupo para siempre
+    time.sleep(0.1)
+    worker_c = SimulationStore(path, stale_seconds=0.05)
+    assert worker_c.create("u", 10, max_running=1) is not None
+    assert worker_c.get(second)["status"] == FAILED
+
+
+def test_endpoint_is_busy_while_another_worker_simulates(client, main, auth_headers):
+    other = main.simulation_store.create("otro worker", 10, max_running=main.simulations.max_running)
+    assert other is not None
+    try:
+        rule_id = client.get("/rules").json()["rules"][0]["id"]
+        r = client.post("/rules/simulations", headers=auth_headers,
+                        json={"draft": {"delete": [rule_id]}, "population": make_population(3)})
+        assert r.status_code == 503 and "Retry-After" in r.headers
+    finally:
+        main.simulation_store.finish(other, CANCELLED, 0)
@@ -0,0 +1,67 @@
+import asyncio
+from io import BytesIO
+
+import httpx
+from PIL import Image
+
+BOUNDARY = "nutriexpertboundary"
+CHUNK = 64 * 1024
+
+
+def jpeg_bytes():
+    buf = BytesIO()
+    Image.new("RGB", (32, 32), (10, 120, 30)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def multipart_head(filename="plato.jpg"):
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            "Content-Type: image/jpeg\r\n\r\n").encode()
+
+
+def multipart_tail():
+    return f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def post_chunked(main, headers, chunks):
+    """POST sin Content-Length; devuelve la respuesta y cuántos trozos llegó a pedir la app"""
+    sent = 0
+
+    async def body():
+        nonlocal sent
+        for chunk in chunks:
+            sent += 1
+            yield chunk
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.post("/analyze-image/upload", content=body(), headers={
+                **headers, "Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+
+    response = asyncio.run(run())
+    return response, sent
+
+
+def test_chunked_upload_is_cut_once_over_the_limit(client, main, auth_headers, monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 4 * CHUNK)
+    chunks = [multipart_head()] + [b"\xff" * CHUNK for _ in range(100)] + [multipart_tail()]
+    r, sent = post_chunked(main, auth_headers, chunks)
+    assert r.status_code == 413
+    # Se corta al pasar del límite (más el margen del multipart), no al final del cuerpo
+    limit_chunks = (main.MAX_UPLOAD_BYTES + main.MULTIPART_OVERHEAD_BYTES) // CHUNK + 2
+    assert sent <= limit_chunks < len(chunks)
+
+
+def test_content_length_over_limit_is_rejected_up_front(client, main, auth_headers, monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 1024)
+    body = multipart_head() + b"\xff" * (200 * 1024) + multipart_tail()
+    r = client.post("/analyze-image/upload", content=body, headers={
+        **auth_headers, "Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+    assert r.status_code == 413
+
+
+def test_chunked_upload_within_limit_is_accepted(client, main, auth_headers):
+    chunks = [multipart_head(), jpeg_bytes(), multipart_tail()]
+    r, _ = post_chunked(main, auth_headers, chunks)
+    assert r.status_code == 200, r.text
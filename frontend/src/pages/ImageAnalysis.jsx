@@ -9,6 +9,7 @@ export default function ImageAnalysis() {
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
   const fileInputRef = useRef(null);
+  const abortRef = useRef(null);
 
   const handleImageSelect = (e) => {
     const file = e.target.files?.[0];
@@ -50,15 +51,10 @@ export default function ImageAnalysis() {
         throw new Error('No estás autenticado. Por favor inicia sesión.');
       }
 
-      const response = await fetch(`${API}/analyze-image`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
-        },
-        body: JSON.stringify({
-          image_base64: imagePreview,
-          prompt: `Analiza esta imagen de comida y proporciona la información EXACTAMENTE en este formato estructurado:
+      // Se envía el archivo original como multipart (sin base64 ni JSON)
+      const formData = new FormData();
+      formData.append('file', selectedImage);
+      formData.append('prompt', `Analiza esta imagen de comida y proporciona la información EXACTAMENTE en este formato estructurado:
 
 ALIMENTOS IDENTIFICADOS:
 - [Nombre del alimento 1] ([porción en gramos]g)
@@ -86,8 +82,18 @@ DESGLOSE POR ALIMENTO:
    - Carbohidratos: [número]g
    - Grasas: [número]g
 
-Proporciona SOLO números y datos, sin explicaciones adicionales. Se preciso y conciso.`
-        })
+Proporciona SOLO números y datos, sin explicaciones adicionales. Se preciso y conciso.`);
+
+      // El análisis llega por Server-Sent Events: se muestra a medida que se genera
+      const controller = new AbortController();
+      abortRef.current = controller;
+      const response = await fetch(`${API}/analyze-image/stream`, {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${token}`
+        },
+        body: formData,
+        signal: controller.signal
       });
 
       if (!response.ok) {
@@ -95,17 +101,41 @@ Proporciona SOLO números y datos, sin explicaciones adicionales. Se preciso y c
         throw new Error(errorData.detail || 'Error al analizar la imagen');
       }
 
-      const data = await response.json();
-      setAnalysis(data.analysis);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let text = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const block of events) {
+          const event = block.match(/^event: (.*)$/m)?.[1];
+          const data = JSON.parse(block.match(/^data: (.*)$/m)?.[1] || '{}');
+          if (event === 'chunk') {
+            text += data.text;
+            setAnalysis(text);
+          } else if (event === 'done') {
+            setAnalysis(data.analysis);
+          } else if (event === 'error') {
+            throw new Error(data.detail || 'Error al analizar la imagen');
+          }
+        }
+      }
     } catch (err) {
+      if (err.name === 'AbortError') return;
       console.error('Error:', err);
       setError(err.message || 'No se pudo analizar la imagen. Verifica tu conexión.');
     } finally {
+      abortRef.current = null;
       setLoading(false);
     }
   };
 
   const handleReset = () => {
+    abortRef.current?.abort();
     setSelectedImage(null);
     setImagePreview(null);
     setAnalysis(null);
@@ -471,7 +501,7 @@ Proporciona SOLO números y datos, sin explicaciones adicionales. Se preciso y c
               </div>
             )}
 
-            {loading && (
+            {loading && !analysis && (
               <div className="flex flex-col items-center justify-center h-full py-12">
                 <div className="relative">
                   <svg className="animate-spin h-16 w-16 text-emerald-500" fill="none" viewBox="0 0 24 24">